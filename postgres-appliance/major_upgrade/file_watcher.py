@@ -0,0 +1,75 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+
+
+class DirectoryWatcher(object):
+    """Reports names of files written to the directory using inotify, with the fallback to polling"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1')
+            if libc.inotify_add_watch(fd, directory.encode('utf-8'), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch')
+            self.fd = fd
+        except Exception as e:
+            logger.warning('inotify is not available, falling back to polling of %s: %r', directory, e)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _drain(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            length = _EVENT.unpack_from(data, offset)[3]
+            offset += _EVENT.size + length
+
+    def wait(self, timeout):
+        """Sleeps until something is written to the directory or the timeout expires"""
+        if self.fd is None:
+            time.sleep(min(timeout, 1))
+        elif select.select([self.fd], [], [], timeout)[0]:
+            self._drain()
+
+    def wait_for(self, names, timeout):
+        """Waits until all files exist. The existence is checked after every event and the check goes
+           before the wait, therefore files written before the watch started aren't missed.
+           Returns names of the files which exist"""
+        end_time = time.time() + timeout
+        while True:
+            existing = set(n for n in names if os.path.exists(os.path.join(self.directory, n)))
+            remaining = end_time - time.time()
+            if len(existing) == len(names) or remaining <= 0:
+                return existing
+            self.wait(remaining)
@@ -8,17 +8,31 @@ import shlex
 import shutil
 import subprocess
 import sys
+import tempfile
 import time
 import yaml
 
 from collections import defaultdict
-from threading import Thread
+from contextlib import contextmanager
+from threading import Lock, Thread
 from multiprocessing.pool import ThreadPool
 from patroni import global_config
 
 logger = logging.getLogger(__name__)
 
 RSYNC_PORT = 5432
+# upper limit of concurrent rsync streams per replica, the network is usually the bottleneck
+RSYNC_MAX_STREAMS = int(os.environ.get('UPGRADE_RSYNC_STREAMS', 4))
+# carry over optimizer statistics to the new cluster instead of rebuilding them from scratch
+TRANSPLANT_STATISTICS = os.environ.get('UPGRADE_TRANSPLANT_STATISTICS', 'true') != 'false'
+# shared buffers are carried over only if prewarming is enabled, it creates extensions in databases
+PREWARM = bool(os.environ.get('PREWARM_SCHEDULE'))
+# how pg_upgrade transfers relation files: auto (clone if supported, otherwise link), link, clone,
+# copy-file-range or copy
+TRANSFER_MODE = os.environ.get('UPGRADE_TRANSFER_MODE', 'auto')
+# if the old cluster is intact, the upgrade is rolled back when the new one doesn't start in time or
+# doesn't accept connections to all databases
+HEALTH_CHECK_TIMEOUT = 60
 
 
 def patch_wale_prefix(value, new_version):
@@ -75,11 +89,108 @@ def update_configs(new_version):
             return envdir
 
 
+class UpgradeTimeline(object):
+    """Collects durations of upgrade phases and stores them into PGROOT, so that they could be
+       compared between upgrades of different clusters and used to estimate the downtime"""
+
+    TIMELINE_FILE = 'upgrade_timeline.json'
+    HISTORY_FILE = 'upgrade_history.json'
+
+    def __init__(self, data_dir, cluster_version, desired_version, replicas):
+        self.pgroot = os.path.dirname(os.path.abspath(data_dir))
+        self.start = time.time()
+        self.phases = []
+        self.info = {'cluster_version': cluster_version, 'desired_version': desired_version, 'replicas': replicas}
+        self.finished = False
+        self._downtime = [None, None]
+        self._lock = Lock()
+
+    def record(self, name, seconds, **kwargs):
+        import spilo_metrics
+
+        with self._lock:
+            self.phases.append(dict(name=name, seconds=round(seconds, 3),
+                                    offset=round(time.time() - seconds - self.start, 3), **kwargs))
+            spilo_metrics.write(spilo_metrics.UPGRADE_PROGRESS, {'running': not self.finished, 'phase': name,
+                                                                 'completed_phases': len(self.phases),
+                                                                 'elapsed': time.time() - self.start})
+
+    @contextmanager
+    def phase(self, name, **kwargs):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start, **kwargs)
+
+    def downtime_start(self):
+        self._downtime[0] = time.time()
+        return self._downtime[0]
+
+    def downtime_end(self):
+        self._downtime[1] = time.time()
+
+    def summary(self):
+        """flat {phase: seconds} mapping, per-member phases are reported as phase[member]"""
+        ret = {}
+        with self._lock:
+            for p in self.phases:
+                name = p['name'] if 'member' not in p else '{0}[{1}]'.format(p['name'], p['member'])
+                ret[name] = round(ret.get(name, 0) + p['seconds'], 3)
+        return ret
+
+    def finish(self, success, manifest_summary=None):
+        from spilo_commons import append_history
+        import spilo_metrics
+
+        self.finished = True
+        now = time.time()
+        downtime_start, downtime_end = self._downtime
+        record = dict(self.info, timestamp=int(now), success=bool(success), total=round(now - self.start, 3),
+                      downtime=downtime_start and round((downtime_end or now) - downtime_start, 3),
+                      phases=self.summary())
+        if manifest_summary:
+            record.update(files=manifest_summary['files'] + manifest_summary['links'],
+                          bytes=manifest_summary['file_bytes'] + manifest_summary['linked_bytes'],
+                          transferred_files=manifest_summary['files'],
+                          transferred_bytes=manifest_summary['file_bytes'])
+
+        logger.info('Upgrade timeline: %s', json.dumps(record['phases'], separators=(',', ':')))
+        logger.info('Upgrade downtime: %s seconds, total time: %s seconds', record['downtime'], record['total'])
+        spilo_metrics.write(spilo_metrics.UPGRADE_PROGRESS, {'running': False, 'completed_phases': len(self.phases),
+                                                             'elapsed': record['total']})
+        spilo_metrics.record('inplace_upgrade', self.start, success, downtime=record['downtime'] or 0)
+        try:
+            with open(os.path.join(self.pgroot, self.TIMELINE_FILE), 'w') as f:
+                json.dump(dict(record, phases=self.phases), f, indent=2)
+            append_history(os.path.join(self.pgroot, self.HISTORY_FILE), record)
+        except Exception as e:
+            logger.error('Failed to save upgrade timeline: %r', e)
+        return record
+
+
+def backoff_loop(timeout, interval=0.05, max_interval=1):
+    """The same as ``polling_loop()``, but the interval grows from a small value, so that a condition
+       which becomes true quickly is noticed without a delay."""
+    end_time = time.time() + timeout
+    iteration = 0
+    while time.time() < end_time:
+        yield iteration
+        iteration += 1
+        time.sleep(min(interval, max(0, end_time - time.time())))
+        interval = min(interval * 2, max_interval)
+
+
 def kill_patroni():
     logger.info('Restarting patroni')
     patroni = next(iter(filter(lambda p: p.info['name'] == 'patroni', psutil.process_iter(['name']))), None)
     if patroni:
         patroni.kill()
+        # the REST API of the killed process must not be mistaken for the API of the new one
+        try:
+            patroni.wait(10)
+        except psutil.TimeoutExpired:
+            logger.warning('Patroni did not exit after 10 seconds')
 
 
 class InplaceUpgrade(object):
@@ -102,6 +213,14 @@ class InplaceUpgrade(object):
         self.upgrade_complete = False
         self.rsyncd_configs_created = False
         self.rsyncd_started = False
+        self.timeline = None
+        self.manifest_summary = None
+        self.statistics_dump_dir = None
+        self._statistics = {}
+        self._transplant = None
+        self._refresh = None
+        self._scans = None
+        self._prewarm_snapshot = None
 
         if self.upgrade_required:
             # we want to reduce tcp timeouts and keepalives and therefore tune loop_wait, retry_timeout, and ttl
@@ -131,8 +250,6 @@ class InplaceUpgrade(object):
             return logger.error('API request to %s name failed: %r', member.name, e)
 
     def toggle_pause(self, paused):
-        from patroni.utils import polling_loop
-
         cluster = self.dcs.get_cluster()
         config = cluster.config.data.copy()
         if global_config.from_cluster(cluster).is_paused == paused:
@@ -146,7 +263,9 @@ class InplaceUpgrade(object):
 
         old = {m.name: m.index for m in cluster.members if m.api_url}
         ttl = config.get('ttl', self.dcs.ttl)
-        for _ in polling_loop(ttl + 1):
+        # members report the pause state in their keys, Patroni doesn't signal changes of member keys,
+        # therefore they are polled, frequently at first
+        for _ in backoff_loop(ttl + 1):
             cluster = self.dcs.get_cluster()
             if all(m.data.get('pause', False) == paused for m in cluster.members if m.name in old):
                 logger.info('Maintenance mode %s', ('enabled' if paused else 'disabled'))
@@ -220,9 +339,7 @@ class InplaceUpgrade(object):
         return self.ensure_replicas_state(cluster)
 
     def remove_initialize_key(self):
-        from patroni.utils import polling_loop
-
-        for _ in polling_loop(10):
+        for _ in backoff_loop(10):
             cluster = self.dcs.get_cluster()
             if cluster.initialize is None:
                 return True
@@ -232,8 +349,6 @@ class InplaceUpgrade(object):
         logger.error('Failed to remove initialize key')
 
     def wait_for_replicas(self, checkpoint_lsn):
-        from patroni.utils import polling_loop
-
         logger.info('Waiting for replica nodes to catch up with primary')
 
         query = ("SELECT pg_catalog.pg_{0}_{1}_diff(pg_catalog.pg_last_{0}_replay_{1}(),"
@@ -241,7 +356,7 @@ class InplaceUpgrade(object):
 
         status = {}
 
-        for _ in polling_loop(60):
+        for _ in backoff_loop(60):
             synced = True
             for name, (_, cur) in self.replica_connections.items():
                 prev = status.get(name)
@@ -265,34 +380,53 @@ class InplaceUpgrade(object):
                 logger.error('Node %s did not catched up. Lag=%s', name, checkpoint_lsn - lsn)
 
     def create_rsyncd_configs(self):
+        from spilo_commons import get_cpu_count
+
         self.rsyncd_configs_created = True
         self.rsyncd_conf_dir = '/run/rsync'
         self.rsyncd_feedback_dir = os.path.join(self.rsyncd_conf_dir, 'feedback')
+        self.rsyncd_manifest_dir = os.path.join(self.rsyncd_conf_dir, 'manifest')
+
+        self.rsyncd_ready_dir = os.path.join(self.rsyncd_conf_dir, 'ready')
 
-        if not os.path.exists(self.rsyncd_feedback_dir):
-            os.makedirs(self.rsyncd_feedback_dir)
+        for d in (self.rsyncd_feedback_dir, self.rsyncd_manifest_dir, self.rsyncd_ready_dir):
+            if not os.path.exists(d):
+                os.makedirs(d)
 
         self.rsyncd_conf = os.path.join(self.rsyncd_conf_dir, 'rsyncd.conf')
         secrets_file = os.path.join(self.rsyncd_conf_dir, 'rsyncd.secrets')
 
         auth_users = ','.join(self.replica_connections.keys())
         replica_ips = ','.join(str(v[0]) for v in self.replica_connections.values())
+        pgroot = os.path.dirname(self.postgresql.data_dir)
 
-        with open(self.rsyncd_conf, 'w') as f:
-            f.write("""port = {0}
-use chroot = false
-
-[pgroot]
+        module = """
+[{0}]
 path = {1}
 read only = true
 timeout = 300
-post-xfer exec = echo $RSYNC_EXIT_STATUS > {2}/$RSYNC_USER_NAME
-auth users = {3}
+{2}auth users = {3}
 secrets file = {4}
 hosts allow = {5}
 hosts deny = *
-""".format(RSYNC_PORT, os.path.dirname(self.postgresql.data_dir),
-                self.rsyncd_feedback_dir, auth_users, secrets_file, replica_ips))
+"""
+        feedback = 'post-xfer exec = echo $RSYNC_EXIT_STATUS > {0}/$RSYNC_USER_NAME{{0}}\n'\
+            .format(self.rsyncd_feedback_dir)
+        # replicas fetch this empty module when they are done with the new PGDATA
+        ready = feedback.format('.ready')
+
+        # files from the manifest are transferred by concurrent streams, each stream uses own module (shard),
+        # which reports its exit status to the feedback/$RSYNC_USER_NAME.shardN file
+        self.rsync_shards = max(1, min(get_cpu_count(), RSYNC_MAX_STREAMS))
+
+        with open(self.rsyncd_conf, 'w') as f:
+            f.write('port = {0}\nuse chroot = false\n'.format(RSYNC_PORT))
+            f.write(module.format('pgroot', pgroot, feedback.format(''), auth_users, secrets_file, replica_ips))
+            f.write(module.format('manifest', self.rsyncd_manifest_dir, '', auth_users, secrets_file, replica_ips))
+            f.write(module.format('ready', self.rsyncd_ready_dir, ready, auth_users, secrets_file, replica_ips))
+            for shard in range(self.rsync_shards):
+                name = 'shard{0}'.format(shard)
+                f.write(module.format(name, pgroot, feedback.format('.' + name), auth_users, secrets_file, replica_ips))
 
         with open(secrets_file, 'w') as f:
             for name in self.replica_connections.keys():
@@ -323,14 +457,48 @@ hosts deny = *
     def checkpoint(self, member):
         name, (_, cur) = member
         try:
-            cur.execute('CHECKPOINT')
+            with self.timeline.phase('replica_checkpoint', member=name):
+                cur.execute('CHECKPOINT')
             return name, True
         except Exception as e:
             logger.error('CHECKPOINT on % failed: %r', name, e)
             return name, False
 
+    def build_manifest(self):
+        from transfer_mode import SAME_PATHS_VERSION
+        from upgrade_manifest import build_manifest
+
+        data_dir = os.path.abspath(self.postgresql.data_dir)
+        # copied files could be matched with old ones only if pg_upgrade preserved their paths
+        match_paths = self.postgresql.transfer_mode != 'link' and float(self.desired_version) >= SAME_PATHS_VERSION
+        try:
+            # replicas fall back to the full rsync if the manifest is missing
+            self.manifest_summary = build_manifest(os.path.dirname(data_dir), os.path.basename(data_dir),
+                                                   os.path.basename(data_dir) + '_old', self.rsyncd_manifest_dir,
+                                                   self.rsync_shards, match_paths)
+        except Exception as e:
+            logger.error('Failed to build manifest: %r', e)
+            shutil.rmtree(self.rsyncd_manifest_dir, ignore_errors=True)
+
+    def read_rsync_feedback(self, name):
+        """Returns the exit status of the full rsync or of the first failed shard,
+           or None if the replica didn't finish yet"""
+        feedback = os.path.join(self.rsyncd_feedback_dir, name)
+        files = [feedback] if os.path.exists(feedback) else\
+            ['{0}.shard{1}'.format(feedback, shard) for shard in range(self.rsync_shards)]
+        if not all(os.path.exists(f) for f in files):
+            return None
+
+        results = []
+        for filename in files:
+            with open(filename) as f:
+                results.append(f.read().strip())
+        if not all(results):  # the file is created, but not written yet
+            return None
+        return next((r for r in results if not r.startswith('0')), results[0])
+
     def rsync_replicas(self, primary_ip):
-        from patroni.utils import polling_loop
+        from file_watcher import DirectoryWatcher
 
         logger.info('Notifying replicas %s to start rsync', ','.join(self.replica_connections.keys()))
         ret = True
@@ -363,18 +531,19 @@ hosts deny = *
 
         logger.info('Waiting for replicas rsync to complete')
         status.clear()
-        for _ in polling_loop(300):
-            synced = True
-            for name in self.replica_connections.keys():
-                feedback = os.path.join(self.rsyncd_feedback_dir, name)
-                if name not in status and os.path.exists(feedback):
-                    with open(feedback) as f:
-                        status[name] = f.read().strip()
-
-                if name not in status:
-                    synced = False
-            if synced:
-                break
+        start = time.time()
+        # rsyncd reports exit statuses of transfers by writing files into the feedback directory
+        with DirectoryWatcher(self.rsyncd_feedback_dir) as watcher:
+            while time.time() < start + 300:
+                for name in self.replica_connections.keys():
+                    if name not in status:
+                        result = self.read_rsync_feedback(name)
+                        if result is not None:
+                            status[name] = result
+                            self.timeline.record('replica_rsync', time.time() - start, member=name)
+                if len(status) == len(self.replica_connections):
+                    break
+                watcher.wait(start + 300 - time.time())
 
         for name in self.replica_connections.keys():
             result = status.get(name)
@@ -386,10 +555,19 @@ hosts deny = *
                 ret = False
         return ret
 
-    def wait_replica_restart(self, member):
-        from patroni.utils import polling_loop
+    def wait_replicas_ready(self, timeout=10):
+        """Replicas which finished rsync successfully report that they don't need rsyncd anymore"""
+        from file_watcher import DirectoryWatcher
+
+        names = [name + '.ready' for name in self.replica_connections.keys()]
+        with DirectoryWatcher(self.rsyncd_feedback_dir) as watcher:
+            ready = watcher.wait_for(names, timeout)
+        if len(ready) < len(names):
+            logger.warning('Replicas %s did not report readiness after %s seconds',
+                           [n[:-6] for n in names if n not in ready], timeout)
 
-        for _ in polling_loop(10):
+    def wait_replica_restart(self, member):
+        for _ in backoff_loop(10):
             try:
                 response = self.request(member, timeout=2, retries=0)
                 if response.status == 200:
@@ -412,77 +590,261 @@ hosts deny = *
         return all(results)
 
     def reset_custom_statistics_target(self):
-        from patroni.postgresql.connection import get_connection_cursor
-
         logger.info('Resetting non-default statistics target before analyze')
-        self._statistics = defaultdict(lambda: defaultdict(dict))
-
-        conn_kwargs = self.postgresql.local_conn_kwargs
-
-        for d in self.postgresql.query('SELECT datname FROM pg_catalog.pg_database WHERE datallowconn'):
-            conn_kwargs['dbname'] = d[0]
-            with get_connection_cursor(**conn_kwargs) as cur:
-                cur.execute('SELECT attrelid::regclass, quote_ident(attname), attstattarget '
-                            'FROM pg_catalog.pg_attribute WHERE attnum > 0 AND NOT attisdropped AND attstattarget > 0')
-                for table, column, target in cur.fetchall():
-                    query = 'ALTER TABLE {0} ALTER COLUMN {1} SET STATISTICS -1'.format(table, column)
-                    logger.info("Executing '%s' in the database=%s. Old value=%s", query, d[0], target)
-                    cur.execute(query)
-                    self._statistics[d[0]][table][column] = target
+        self._statistics = defaultdict(dict)
+
+        def reset_statistics_target(cur, dbname):
+            cur.execute('SELECT attrelid::regclass, quote_ident(attname), attstattarget '
+                        'FROM pg_catalog.pg_attribute WHERE attnum > 0 AND NOT attisdropped AND attstattarget > 0')
+            statistics = defaultdict(dict)
+            for table, column, target in cur.fetchall():
+                statistics[table][column] = target
+
+            for table, columns in statistics.items():
+                query = 'ALTER TABLE {0} {1}'.format(table, ', '.join('ALTER COLUMN {0} SET STATISTICS -1'
+                                                                      .format(column) for column in columns))
+                logger.info("Executing '%s' in the database=%s. Old values=%s", query, dbname, columns)
+                cur.execute(query)
+                self._statistics[dbname][table] = columns
 
-    def restore_custom_statistics_target(self):
-        from patroni.postgresql.connection import get_connection_cursor
+        # a failure stops the reset, targets which were already reset are restored after analyze
+        self.postgresql.for_each_database('Resetting statistics targets', reset_statistics_target,
+                                          raise_on_error=True)
 
+    def restore_custom_statistics_target(self):
         if not self._statistics:
             return
 
-        conn_kwargs = self.postgresql.local_conn_kwargs
-
         logger.info('Restoring default statistics targets after upgrade')
-        for db, val in self._statistics.items():
-            conn_kwargs['dbname'] = db
-            with get_connection_cursor(**conn_kwargs) as cur:
-                for table, val in val.items():
-                    for column, target in val.items():
-                        query = 'ALTER TABLE {0} ALTER COLUMN {1} SET STATISTICS {2}'.format(table, column, target)
-                        logger.info("Executing '%s' in the database=%s", query, db)
-                        try:
-                            cur.execute(query)
-                        except Exception:
-                            logger.error("Failed to execute '%s'", query)
 
-    def reanalyze(self):
-        from patroni.postgresql.connection import get_connection_cursor
+        def restore_statistics_target(cur, dbname):
+            for table, columns in self._statistics[dbname].items():
+                query = 'ALTER TABLE {0} {1}'.format(table, ', '.join('ALTER COLUMN {0} SET STATISTICS {1}'
+                                                                      .format(c, t) for c, t in columns.items()))
+                logger.info("Executing '%s' in the database=%s", query, dbname)
+                try:
+                    cur.execute(query)
+                except Exception:
+                    logger.error("Failed to execute '%s'", query)
+
+        self.postgresql.for_each_database('Restoring statistics targets', restore_statistics_target,
+                                          list(self._statistics.keys()))
+
+    @staticmethod
+    def analyze_tables(cur, dbname, tables):
+        query = 'ANALYZE {0}'.format(', '.join(tables))
+        logger.info("Executing '%s' in the database=%s", query, dbname)
+        try:
+            cur.execute(query)
+            return
+        except Exception:
+            logger.error("Failed to execute '%s', analyzing tables one by one", query)
+
+        for table in tables:
+            query = 'ANALYZE {0}'.format(table)
+            logger.info("Executing '%s' in the database=%s", query, dbname)
+            try:
+                cur.execute(query)
+            except Exception:
+                logger.error("Failed to execute '%s'", query)
 
+    def reanalyze(self):
         if not self._statistics:
             return
 
-        conn_kwargs = self.postgresql.local_conn_kwargs
+        def reanalyze(cur, dbname):
+            self.analyze_tables(cur, dbname, list(self._statistics[dbname].keys()))
 
-        for db, val in self._statistics.items():
-            conn_kwargs['dbname'] = db
-            with get_connection_cursor(**conn_kwargs) as cur:
-                for table in val.keys():
-                    query = 'ANALYZE {0}'.format(table)
-                    logger.info("Executing '%s' in the database=%s", query, db)
-                    try:
-                        cur.execute(query)
-                    except Exception:
-                        logger.error("Failed to execute '%s'", query)
+        self.postgresql.for_each_database('Reanalyzing tables with custom statistics targets', reanalyze,
+                                          list(self._statistics.keys()))
+
+    def dump_statistics(self):
+        from statistics_transplant import dump_statistics
+
+        dump_dir = self.statistics_dump_dir = os.path.abspath(self.postgresql.data_dir) + '_statistics'
+        shutil.rmtree(dump_dir, ignore_errors=True)
+        os.makedirs(dump_dir)
+
+        databases = self.postgresql._get_all_databases()
+        names = {dbname: str(i) for i, dbname in enumerate(databases)}
+
+        def dump(cur, dbname):
+            return names[dbname], dump_statistics(cur, dump_dir, names[dbname])
+
+        try:
+            self._transplant = self.postgresql.for_each_database('Dumping statistics', dump, databases,
+                                                                 raise_on_error=True)
+        except Exception as e:
+            logger.error('Failed to dump statistics, they will be rebuilt after upgrade: %r', e)
+            shutil.rmtree(dump_dir, ignore_errors=True)
+
+    def restore_statistics(self):
+        """Loads statistics dumped from the old cluster and remembers relations to be analyzed.
+           Databases where the restore failed are analyzed completely."""
+        from statistics_transplant import restore_statistics
+
+        def restore(cur, dbname):
+            name, unknown = self._transplant[dbname]
+            return restore_statistics(cur, dbname, self.statistics_dump_dir, name) + unknown
+
+        self._refresh = dict.fromkeys(self._transplant.keys())
+        self._refresh.update(self.postgresql.for_each_database('Restoring statistics', restore,
+                                                               list(self._transplant.keys())))
+        shutil.rmtree(self.statistics_dump_dir, ignore_errors=True)
+
+        self.timeline.info['refreshed_relations'] = sum(len(t) for t in self._refresh.values() if t is not None)
+        self.timeline.info['refreshed_databases'] = sum(1 for t in self._refresh.values() if t is None)
+
+    def save_scan_counts(self):
+        """Scan counters are lost during pg_upgrade, but they are used to decide what to analyze first"""
+        from analyze_scheduler import get_scan_counts
+
+        self._scans = self.postgresql.for_each_database('Saving scan counts', lambda cur, _: get_scan_counts(cur))
+
+    def take_prewarm_snapshot(self):
+        """Relfilenodes could change during pg_upgrade, therefore autoprewarm can't restore shared buffers"""
+        from prewarm import take_snapshot
+
+        try:
+            self._prewarm_snapshot = take_snapshot(self.postgresql.local_conn_kwargs)
+        except Exception as e:
+            logger.error('Failed to take a snapshot of shared buffers: %r', e)
+
+    def prewarm(self):
+        from prewarm import load
+
+        with self.timeline.phase('prewarm'):
+            try:
+                self.timeline.info['prewarmed_blocks'] = load(self.postgresql.local_conn_kwargs, self._prewarm_snapshot)
+            except Exception as e:
+                logger.error('Failed to prewarm shared buffers: %r', e)
 
     def analyze(self):
+        from statistics_transplant import NATIVE_STATISTICS_VERSION
+
+        # only relations without transplanted statistics, databases where the restore failed completely
+        if self._refresh is not None:
+            with self.timeline.phase('analyze'):
+                return self.postgresql.analyze(only=self._refresh, scans=self._scans)
+
+        if float(self.desired_version) >= NATIVE_STATISTICS_VERSION:
+            with self.timeline.phase('analyze'):
+                return self.postgresql.analyze(True, missing_stats_only=True, scans=self._scans)
+
         try:
-            self.reset_custom_statistics_target()
+            with self.timeline.phase('reset_statistics_target'):
+                self.reset_custom_statistics_target()
         except Exception as e:
             logger.error('Failed to reset custom statistics targets: %r', e)
-        self.postgresql.analyze(True)
+        with self.timeline.phase('analyze'):
+            self.postgresql.analyze(True, scans=self._scans, boost=self._statistics)
         try:
-            self.restore_custom_statistics_target()
+            with self.timeline.phase('restore_statistics_target'):
+                self.restore_custom_statistics_target()
         except Exception as e:
             logger.error('Failed to restore custom statistics targets: %r', e)
 
+    def choose_transfer_mode(self):
+        from transfer_mode import choose
+
+        data_dir = os.path.abspath(self.postgresql.data_dir)
+        mode, throughput = choose(TRANSFER_MODE, self.desired_version, os.path.dirname(data_dir),
+                                  len(self.replica_connections))
+        logger.info('Using %s transfer mode', mode)
+        self.postgresql.transfer_mode = self.timeline.info['transfer_mode'] = mode
+        if throughput:
+            self.timeline.info['clone_throughput'] = round(throughput)
+
+    def wait_patroni_api(self, member):
+        for _ in backoff_loop(10):
+            if self.check_patroni_api(member):
+                return True
+        logger.error('Patroni REST API on primary is not accessible after 10 seconds')
+
+    def start_primary(self, member):
+        for _ in backoff_loop(10):
+            try:
+                result = self.request(member, 'post', 'restart', {})
+                logger.info('   %s %s', result.status, result.data.decode('utf-8'))
+                if result.status < 300:
+                    return True
+            except Exception as e:
+                logger.error('POST /restart failed: %r', e)
+        logger.error('Failed to start primary')
+
+    def rollback(self, member):
+        """Switches back to the old cluster. Possible only before replicas were resynced and only
+           if pg_upgrade didn't link files, otherwise the old cluster was modified by the new one."""
+        logger.warning('Rolling back to the old cluster')
+        if not self.postgresql.stop(block_callbacks=True):
+            return logger.error('Failed to stop the new cluster, rollback is not possible')
+
+        self.postgresql.switch_back_pgdata()
+        self.upgrade_complete = False
+        update_configs(self.cluster_version)
+
+        self.dcs.initialize(create_new=False, sysid=self._old_sysid)
+        kill_patroni()
+        if self.wait_patroni_api(member) and self.start_primary(member):
+            logger.warning('Rolled back to %s', self.cluster_version)
+
+    def collect_statistics(self):
+        from upgrade_estimator import count_relation_files
+
+        statistics = self.postgresql.get_upgrade_statistics()
+        statistics['relation_files'], statistics['relation_bytes'] = count_relation_files(self.postgresql.data_dir)
+        return statistics
+
+    def dry_run(self, replica_count, history_file=None):
+        """Executes sanity checks and pg_upgrade --check and estimates the duration of the upgrade.
+           The cluster is neither paused nor stopped."""
+        from spilo_commons import read_history
+        from upgrade_estimator import estimate
+
+        if not self.upgrade_required:
+            logger.info('Current version=%s, desired version=%s. Upgrade is not required',
+                        self.cluster_version, self.desired_version)
+            return True
+
+        if not (self.postgresql.is_running() and self.postgresql.is_primary()):
+            return logger.error('PostgreSQL is not running or in recovery')
+
+        self.replica_count = replica_count
+        ret = bool(self.sanity_checks(self.dcs.get_cluster()))
+
+        statistics = self.collect_statistics()
+        logger.info('Databases: %s, relations: %s, relation files: %s (%s bytes), large objects: %s, '
+                    'unlogged tables: %s', statistics['databases'], statistics['relations'],
+                    statistics['relation_files'], statistics['relation_bytes'], statistics['large_objects'],
+                    statistics['unlogged_tables'])
+
+        try:
+            if not self.postgresql.prepare_new_pgdata(self.desired_version):
+                ret = logger.error('initdb failed')
+            elif not self.postgresql.pg_upgrade(check=True):
+                # the real upgrade drops pg_repack and a few other objects before running pg_upgrade --check
+                ret = logger.error('pg_upgrade --check failed, more details in the %s_upgrade',
+                                   self.postgresql.data_dir)
+        finally:
+            self.postgresql.cleanup_new_pgdata()
+
+        history = read_history(os.path.join(os.path.dirname(os.path.abspath(self.postgresql.data_dir)),
+                                            UpgradeTimeline.HISTORY_FILE))
+        if history_file:
+            history = read_history(history_file) + history
+        report = estimate(statistics, history, replica_count - 1)
+        report.update(success=bool(ret), statistics=statistics,
+                      cluster_version=self.cluster_version, desired_version=self.desired_version)
+
+        logger.info('Estimated pg_upgrade: %s seconds, rsync: %s seconds, analyze: %s seconds',
+                    report['phases']['pg_upgrade'], report['phases'].get('rsync', 0), report['phases']['analyze'])
+        logger.info('Estimated downtime: %s seconds, total time: %s seconds (calibrated on %s past upgrades)',
+                    report['downtime'], report['total'], report['calibrated_on']['pg_upgrade'])
+        print(json.dumps(report))
+        return ret
+
     def do_upgrade(self):
-        from patroni.utils import polling_loop
+        from statistics_transplant import NATIVE_STATISTICS_VERSION
 
         if not self.upgrade_required:
             logger.info('Current version=%s, desired version=%s. Upgrade is not required',
@@ -492,59 +854,93 @@ hosts deny = *
         if not (self.postgresql.is_running() and self.postgresql.is_primary()):
             return logger.error('PostgreSQL is not running or in recovery')
 
-        cluster = self.dcs.get_cluster()
+        timeline = self.timeline = UpgradeTimeline(self.postgresql.data_dir, self.cluster_version,
+                                                   self.desired_version, self.replica_count)
+
+        with timeline.phase('sanity_checks'):
+            cluster = self.dcs.get_cluster()
 
-        if not self.sanity_checks(cluster):
-            return False
+            if not self.sanity_checks(cluster):
+                return False
+
+            timeline.info['replicas'] = len(self.replica_connections)
+
+        with timeline.phase('collect_statistics'):
+            try:
+                timeline.info.update(self.collect_statistics())
+            except Exception as e:
+                logger.error('Failed to collect statistics: %r', e)
 
         self._old_sysid = self.postgresql.sysid  # remember old sysid
 
         logger.info('Cluster %s is ready to be upgraded', self.postgresql.scope)
-        if not self.postgresql.prepare_new_pgdata(self.desired_version):
-            return logger.error('initdb failed')
+        with timeline.phase('initdb'):
+            if not self.postgresql.prepare_new_pgdata(self.desired_version):
+                return logger.error('initdb failed')
 
-        try:
-            self.postgresql.drop_possibly_incompatible_extensions()
-        except Exception:
-            return logger.error('Failed to drop possibly incompatible extensions')
+        with timeline.phase('transfer_mode'):
+            self.choose_transfer_mode()
+
+        with timeline.phase('drop_incompatible_extensions'):
+            try:
+                self.postgresql.drop_possibly_incompatible_extensions()
+            except Exception:
+                return logger.error('Failed to drop possibly incompatible extensions')
 
-        if not self.postgresql.pg_upgrade(check=True):
-            return logger.error('pg_upgrade --check failed, more details in the %s_upgrade', self.postgresql.data_dir)
+        with timeline.phase('pg_upgrade_check'):
+            if not self.postgresql.pg_upgrade(check=True):
+                return logger.error('pg_upgrade --check failed, more details in the %s_upgrade',
+                                    self.postgresql.data_dir)
 
-        try:
-            self.postgresql.drop_possibly_incompatible_objects()
-        except Exception:
-            return logger.error('Failed to drop possibly incompatible objects')
+        with timeline.phase('drop_incompatible_objects'):
+            try:
+                self.postgresql.drop_possibly_incompatible_objects()
+            except Exception:
+                return logger.error('Failed to drop possibly incompatible objects')
+
+        if TRANSPLANT_STATISTICS and float(self.desired_version) < NATIVE_STATISTICS_VERSION:
+            with timeline.phase('dump_statistics'):
+                self.dump_statistics()
+
+        with timeline.phase('save_scan_counts'):
+            self.save_scan_counts()
+
+        if PREWARM:
+            with timeline.phase('prewarm_snapshot'):
+                self.take_prewarm_snapshot()
 
         logging.info('Enabling maintenance mode')
-        if not self.toggle_pause(True):
-            return False
+        with timeline.phase('pause'):
+            if not self.toggle_pause(True):
+                return False
 
         logger.info('Doing a clean shutdown of the cluster before pg_upgrade')
-        downtime_start = time.time()
-        if not self.postgresql.stop(block_callbacks=True):
-            return logger.error('Failed to stop the cluster before pg_upgrade')
+        downtime_start = timeline.downtime_start()
+        with timeline.phase('shutdown'):
+            if not self.postgresql.stop(block_callbacks=True):
+                return logger.error('Failed to stop the cluster before pg_upgrade')
 
         if self.replica_connections:
             from patroni.postgresql.misc import parse_lsn
 
-            controldata = self.postgresql.controldata()
+            with timeline.phase('wait_for_replicas'):
+                controldata = self.postgresql.controldata()
 
-            checkpoint_lsn = controldata.get('Latest checkpoint location')
-            if controldata.get('Database cluster state') != 'shut down' or not checkpoint_lsn:
-                return logger.error("Cluster wasn't shut down cleanly")
+                checkpoint_lsn = controldata.get('Latest checkpoint location')
+                if controldata.get('Database cluster state') != 'shut down' or not checkpoint_lsn:
+                    return logger.error("Cluster wasn't shut down cleanly")
 
-            checkpoint_lsn = parse_lsn(checkpoint_lsn)
-            logger.info('Latest checkpoint location: %s', checkpoint_lsn)
+                checkpoint_lsn = parse_lsn(checkpoint_lsn)
+                logger.info('Latest checkpoint location: %s', checkpoint_lsn)
 
-            logger.info('Starting rsyncd')
-            self.start_rsyncd()
+                logger.info('Starting rsyncd')
+                self.start_rsyncd()
 
-            if not self.wait_for_replicas(checkpoint_lsn):
-                return False
+                if not self.wait_for_replicas(checkpoint_lsn):
+                    return False
 
-            if not (self.rsyncd.pid and self.rsyncd.poll() is None):
-                return logger.error('Failed to start rsyncd')
+                if not (self.rsyncd.pid and self.rsyncd.poll() is None):
+                    return logger.error('Failed to start rsyncd')
 
         if self.replica_connections:
             logger.info('Executing CHECKPOINT on replicas %s', ','.join(self.replica_connections.keys()))
@@ -554,14 +950,17 @@ hosts deny = *
             results = pool.map_async(self.checkpoint, self.replica_connections.items())
             pool.close()
 
-        if not self.postgresql.pg_upgrade():
-            return logger.error('Failed to upgrade cluster from %s to %s', self.cluster_version, self.desired_version)
+        with timeline.phase('pg_upgrade'):
+            if not self.postgresql.pg_upgrade():
+                return logger.error('Failed to upgrade cluster from %s to %s',
+                                    self.cluster_version, self.desired_version)
 
-        self.postgresql.switch_pgdata()
-        self.upgrade_complete = True
+        with timeline.phase('update_configs'):
+            self.postgresql.switch_pgdata()
+            self.upgrade_complete = True
 
-        logger.info('Updating configuration files')
-        envdir = update_configs(self.desired_version)
+            logger.info('Updating configuration files')
+            envdir = update_configs(self.desired_version)
 
         ret = True
         if self.replica_connections:
@@ -574,72 +973,95 @@ hosts deny = *
                         self.replica_connections.pop(name)
 
         member = cluster.get_member(self.postgresql.name)
+
+        # the old cluster is kept intact by clone and copy modes, we can go back if the new one doesn't work,
+        # but only until replicas were resynced to the new version
+        if self.postgresql.transfer_mode != 'link':
+            with timeline.phase('health_check'):
+                healthy = self.postgresql.check_new_cluster(HEALTH_CHECK_TIMEOUT)
+            if not healthy:
+                with timeline.phase('rollback'):
+                    self.rollback(member)
+                return False
+
         if self.replica_connections:
+            with timeline.phase('build_manifest'):
+                self.build_manifest()
+
             primary_ip = member.conn_kwargs().get('host')
             rsync_start = time.time()
-            try:
-                if not self.rsync_replicas(primary_ip):
+            with timeline.phase('rsync'):
+                try:
+                    if not self.rsync_replicas(primary_ip):
+                        ret = False
+                except Exception as e:
+                    logger.error('rsync failed: %r', e)
                     ret = False
-            except Exception as e:
-                logger.error('rsync failed: %r', e)
-                ret = False
-            logger.info('Rsync took %s seconds', time.time() - rsync_start)
+                logger.info('Rsync took %s seconds', time.time() - rsync_start)
 
-            self.stop_rsyncd()
-            time.sleep(2)  # Give replicas a bit of time to switch PGDATA
+                if ret:
+                    self.wait_replicas_ready()
+                self.stop_rsyncd()
 
-        self.remove_initialize_key()
-        kill_patroni()
-        self.remove_initialize_key()
-
-        time.sleep(1)
-        for _ in polling_loop(10):
-            if self.check_patroni_api(member):
-                break
-        else:
-            logger.error('Patroni REST API on primary is not accessible after 10 seconds')
+        with timeline.phase('patroni_restart'):
+            self.remove_initialize_key()
+            kill_patroni()
+            self.remove_initialize_key()
+            self.wait_patroni_api(member)
 
         logger.info('Starting the primary postgres up')
-        for _ in polling_loop(10):
-            try:
-                result = self.request(member, 'post', 'restart', {})
-                logger.info('   %s %s', result.status, result.data.decode('utf-8'))
-                if result.status < 300:
-                    break
-            except Exception as e:
-                logger.error('POST /restart failed: %r', e)
-        else:
-            logger.error('Failed to start primary after upgrade')
+        with timeline.phase('primary_start'):
+            self.start_primary(member)
 
+        timeline.downtime_end()
         logger.info('Upgrade downtime: %s', time.time() - downtime_start)
 
+        # the sooner statistics are restored the less queries are executed with bad plans
+        if self._transplant:
+            with timeline.phase('restore_statistics'):
+                self.restore_statistics()
+
         # The last attempt to fix initialize key race condition
         cluster = self.dcs.get_cluster()
         if cluster.initialize == self._old_sysid:
             self.dcs.cancel_initialization()
 
-        try:
-            self.postgresql.update_extensions()
-        except Exception as e:
-            logger.error('Failed to update extensions: %r', e)
+        with timeline.phase('update_extensions'):
+            try:
+                self.postgresql.update_extensions()
+            except Exception as e:
+                logger.error('Failed to update extensions: %r', e)
 
         # start analyze early
         analyze_thread = Thread(target=self.analyze)
         analyze_thread.start()
 
+        prewarm_thread = None
+        if self._prewarm_snapshot:
+            prewarm_thread = Thread(target=self.prewarm)
+            prewarm_thread.start()
+
         if self.replica_connections:
-            self.wait_replicas_restart(cluster)
+            with timeline.phase('wait_replicas_restart'):
+                self.wait_replicas_restart(cluster)
 
-        self.resume_cluster()
+        with timeline.phase('resume'):
+            self.resume_cluster()
 
         analyze_thread.join()
+        if prewarm_thread:
+            prewarm_thread.join()
 
-        self.reanalyze()
+        with timeline.phase('reanalyze'):
+            self.reanalyze()
 
         logger.info('Total upgrade time (with analyze): %s', time.time() - downtime_start)
-        self.postgresql.bootstrap.call_post_bootstrap(self.config['bootstrap'])
+        with timeline.phase('post_bootstrap'):
+            self.postgresql.bootstrap.call_post_bootstrap(self.config['bootstrap'])
         self.postgresql.cleanup_old_pgdata()
 
+        timeline.finish(ret, self.manifest_summary)
+
         if envdir:
             self.start_backup(envdir)
 
@@ -649,6 +1071,12 @@ hosts deny = *
         self.stop_rsyncd()
         self.resume_cluster()
 
+        if self.timeline and not self.timeline.finished:
+            self.timeline.finish(False, self.manifest_summary)
+
+        if self.statistics_dump_dir:
+            shutil.rmtree(self.statistics_dump_dir, ignore_errors=True)
+
         if self.new_data_created:
             try:
                 self.postgresql.cleanup_new_pgdata()
@@ -669,10 +1097,52 @@ hosts deny = *
                             stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
 
 
+def rsync_with_manifest(postgresql, primary_ip, env):
+    """Recreates hard links to old files locally and fetches only remaining files from the primary.
+
+    Returns the exit code of rsync or None if the manifest isn't available and the full rsync is required."""
+    from spilo_commons import get_cpu_count
+    from upgrade_manifest import apply_manifest
+
+    data_dir = os.path.abspath(postgresql.data_dir)
+    pgroot = os.path.dirname(data_dir)
+    manifest_dir = data_dir + '_manifest'
+    url = 'rsync://{0}@{1}:{2}/'.format(postgresql.name, primary_ip, RSYNC_PORT)
+
+    shutil.rmtree(manifest_dir, ignore_errors=True)
+    if subprocess.call(['rsync', '--recursive', url + 'manifest/', manifest_dir], env=env) != 0\
+            or not os.path.exists(os.path.join(manifest_dir, 'summary.json')):
+        logger.warning('Manifest is not available, falling back to the full rsync')
+        return None
+
+    start = time.time()
+    try:
+        shards = apply_manifest(pgroot, manifest_dir, max(1, min(get_cpu_count(), RSYNC_MAX_STREAMS)))
+        for shard, files in enumerate(shards):
+            with open(os.path.join(manifest_dir, 'transfer.{0}'.format(shard)), 'w') as f:
+                f.writelines(path + '\n' for path in files)
+    except Exception as e:
+        logger.error('Failed to apply manifest: %r', e)
+        shutil.rmtree(data_dir, ignore_errors=True)
+        return None
+
+    # every shard is transferred via its own module, which notifies the primary about the result
+    procs = []
+    for shard in range(len(shards)):
+        files_from = os.path.join(manifest_dir, 'transfer.{0}'.format(shard))
+        procs.append(subprocess.Popen(['rsync', '--archive', '--files-from=' + files_from,
+                                       url + 'shard{0}'.format(shard), pgroot], env=env))
+    ret = 0
+    for proc in procs:
+        ret = proc.wait() or ret
+    logger.info('Sync with manifest in %s streams took %.1f seconds', len(procs), time.time() - start)
+    shutil.rmtree(manifest_dir, ignore_errors=True)
+    return ret
+
+
 # this function will be running in a clean environment, therefore we can't rely on DCS connection
 def rsync_replica(config, desired_version, primary_ip, pid):
     from pg_upgrade import PostgresqlUpgrade
-    from patroni.utils import polling_loop
 
     me = psutil.Process()
 
@@ -693,10 +1163,9 @@ def rsync_replica(config, desired_version, primary_ip, pid):
         return 0
 
     # Wait until the remote side will close the connection and backend process exits
-    for _ in polling_loop(10):
-        if not backend.is_running():
-            break
-    else:
+    try:
+        backend.wait(10)
+    except psutil.TimeoutExpired:
         logger.warning('Backend did not exit after 10 seconds')
 
     sysid = postgresql.sysid  # remember old sysid
@@ -711,17 +1180,28 @@ def rsync_replica(config, desired_version, primary_ip, pid):
 
     env = os.environ.copy()
     env['RSYNC_PASSWORD'] = postgresql.config.replication['password']
-    if subprocess.call(['rsync', '--archive', '--delete', '--hard-links', '--size-only', '--omit-dir-times',
-                        '--no-inc-recursive', '--include=/data/***', '--include=/data_old/***',
-                        '--exclude=/data/pg_xlog/*', '--exclude=/data_old/pg_xlog/*',
-                        '--exclude=/data/pg_wal/*', '--exclude=/data_old/pg_wal/*', '--exclude=*',
-                        'rsync://{0}@{1}:{2}/pgroot'.format(postgresql.name, primary_ip, RSYNC_PORT),
-                        os.path.dirname(postgresql.data_dir)], env=env) != 0:
+    ret = rsync_with_manifest(postgresql, primary_ip, env)
+    if ret is None:
+        ret = subprocess.call(['rsync', '--archive', '--delete', '--hard-links', '--size-only', '--omit-dir-times',
+                               '--no-inc-recursive', '--include=/data/***', '--include=/data_old/***',
+                               '--exclude=/data/pg_xlog/*', '--exclude=/data_old/pg_xlog/*',
+                               '--exclude=/data/pg_wal/*', '--exclude=/data_old/pg_wal/*', '--exclude=*',
+                               'rsync://{0}@{1}:{2}/pgroot'.format(postgresql.name, primary_ip, RSYNC_PORT),
+                               os.path.dirname(postgresql.data_dir)], env=env)
+    if ret != 0:
         logger.error('Failed to rsync from %s', primary_ip)
         postgresql.switch_back_pgdata()
         # XXX: rollback configs?
         return 1
 
+    # let the primary know that rsyncd isn't needed anymore
+    empty_dir = tempfile.mkdtemp()
+    try:
+        url = 'rsync://{0}@{1}:{2}/ready/'.format(postgresql.name, primary_ip, RSYNC_PORT)
+        subprocess.call(['rsync', '--dirs', url, empty_dir], env=env)
+    finally:
+        shutil.rmtree(empty_dir, ignore_errors=True)
+
     conn_kwargs = {k: v for k, v in postgresql.config.replication.items() if v is not None}
     if 'username' in conn_kwargs:
         conn_kwargs['user'] = conn_kwargs.pop('username')
@@ -729,7 +1209,7 @@ def rsync_replica(config, desired_version, primary_ip, pid):
     # If restart Patroni right now there is a chance that it will exit due to the sysid mismatch.
     # Due to cleaned environment we can't always use DCS on replicas in this script, therefore
     # the good indicator of initialize key being deleted/updated is running primary after the upgrade.
-    for _ in polling_loop(300):
+    for _ in backoff_loop(300):
         try:
             with postgresql.get_replication_connection_cursor(primary_ip, **conn_kwargs) as cur:
                 cur.execute('IDENTIFY_SYSTEM')
@@ -761,7 +1241,10 @@ def main():
 
     config = Config(PATRONI_CONFIG_FILE)
 
-    if len(sys.argv) == 4:
+    if len(sys.argv) in (3, 4) and sys.argv[2] == '--dry-run':
+        upgrade = InplaceUpgrade(config)
+        return 0 if upgrade.dry_run(int(sys.argv[1]), *sys.argv[3:]) else 1
+    elif len(sys.argv) == 4:
         desired_version = sys.argv[1]
         primary_ip = sys.argv[2]
         pid = int(sys.argv[3])
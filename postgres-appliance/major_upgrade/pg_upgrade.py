@@ -2,8 +2,9 @@ import logging
 import os
 import shutil
 import subprocess
-import psutil
+import time
 
+from multiprocessing.pool import ThreadPool
 from patroni.postgresql import Postgresql
 from patroni.postgresql.mpp import get_mpp
 
@@ -13,6 +14,10 @@ logger = logging.getLogger(__name__)
 class _PostgresqlUpgrade(Postgresql):
 
     _INCOMPATIBLE_EXTENSIONS = ('pg_repack',)
+    # upper limit of concurrent connections used for per-database maintenance
+    _MAX_DATABASE_WORKERS = 16
+    # how pg_upgrade transfers relation files, see transfer_mode.py
+    transfer_mode = 'link'
 
     def adjust_shared_preload_libraries(self, version):
         from spilo_commons import adjust_extensions
@@ -71,71 +76,135 @@ class _PostgresqlUpgrade(Postgresql):
     def _get_all_databases(self):
         return [d[0] for d in self.query('SELECT datname FROM pg_catalog.pg_database WHERE datallowconn')]
 
-    def drop_possibly_incompatible_extensions(self):
+    def for_each_database(self, operation, func, databases=None, raise_on_error=False):
+        """Executes ``func(cursor, dbname)`` in every database using a bounded pool of connections.
+
+        Returns results of successful calls as a dict, errors are logged and optionally raised all together."""
         from patroni.postgresql.connection import get_connection_cursor
 
-        logger.info('Dropping extensions from the cluster which could be incompatible')
+        if databases is None:
+            databases = self._get_all_databases()
+        if not databases:
+            return {}
+
         conn_kwargs = self.local_conn_kwargs
 
-        for d in self._get_all_databases():
-            conn_kwargs['dbname'] = d
-            with get_connection_cursor(**conn_kwargs) as cur:
-                for ext in self._INCOMPATIBLE_EXTENSIONS:
-                    logger.info('Executing "DROP EXTENSION IF EXISTS %s" in the database="%s"', ext, d)
-                    cur.execute("DROP EXTENSION IF EXISTS {0}".format(ext))
+        def execute(dbname):
+            start = time.time()
+            try:
+                with get_connection_cursor(**dict(conn_kwargs, dbname=dbname)) as cur:
+                    return dbname, func(cur, dbname), None, time.time() - start
+            except Exception as e:
+                logger.error('%s failed in the database="%s": %r', operation, dbname, e)
+                return dbname, None, e, time.time() - start
+
+        from spilo_commons import get_cpu_count
+
+        start = time.time()
+        pool = ThreadPool(min(len(databases), get_cpu_count(), self._MAX_DATABASE_WORKERS))
+        try:
+            results = pool.map(execute, databases)
+        finally:
+            pool.close()
+            pool.join()
+
+        errors = [dbname for dbname, _, error, _ in results if error]
+        slowest = sorted(results, key=lambda r: r[3], reverse=True)[:3]
+        logger.info('%s: %d databases in %.1f seconds, %d failed, slowest: %s', operation, len(databases),
+                    time.time() - start, len(errors), ', '.join('{0}={1:.1f}s'.format(r[0], r[3]) for r in slowest))
+
+        if errors and raise_on_error:
+            raise Exception('{0} failed in databases: {1}'.format(operation, ', '.join(errors)))
+        return {dbname: result for dbname, result, error, _ in results if not error}
+
+    def get_upgrade_statistics(self):
+        """Counts objects affecting the duration of pg_upgrade and of analyze in all databases"""
+        names = ('relations', 'tables', 'unlogged_tables', 'analyze_bytes', 'catalog_bytes', 'large_objects')
+        # analyze reads up to 300 * statistics_target pages from every table
+        query = ("SELECT pg_catalog.count(*), pg_catalog.count(*) FILTER (WHERE relkind IN ('r', 'm')),"
+                 " pg_catalog.count(*) FILTER (WHERE relpersistence = 'u' AND relkind = 'r'),"
+                 " COALESCE(pg_catalog.sum(LEAST(pg_catalog.pg_relation_size(oid), 300 *"
+                 " current_setting('default_statistics_target')::bigint * current_setting('block_size')::bigint))"
+                 " FILTER (WHERE relkind IN ('r', 'm')), 0)::bigint,"
+                 " COALESCE(pg_catalog.sum(pg_catalog.pg_relation_size(oid)) FILTER (WHERE oid < 16384), 0)::bigint,"
+                 " (SELECT pg_catalog.count(*) FROM pg_catalog.pg_largeobject_metadata)"
+                 " FROM pg_catalog.pg_class")
+
+        def get_statistics(cur, dbname):
+            cur.execute(query)
+            return cur.fetchone()
+
+        results = self.for_each_database('Collecting statistics', get_statistics, raise_on_error=True)
+        ret = {name: sum(int(r[i]) for r in results.values()) for i, name in enumerate(names)}
+        ret['databases'] = len(results)
+        ret['cluster_size'] = int(self.query('SELECT pg_catalog.sum(pg_catalog.pg_database_size(datname))'
+                                             ' FROM pg_catalog.pg_database')[0][0])
+        return ret
 
-    def drop_possibly_incompatible_objects(self):
-        from patroni.postgresql.connection import get_connection_cursor
+    def drop_possibly_incompatible_extensions(self):
+        logger.info('Dropping extensions from the cluster which could be incompatible')
+        query = 'DROP EXTENSION IF EXISTS {0}'.format(', '.join(self._INCOMPATIBLE_EXTENSIONS))
 
-        logger.info('Dropping objects from the cluster which could be incompatible')
-        conn_kwargs = self.local_conn_kwargs
+        def drop_extensions(cur, dbname):
+            logger.info('Executing "%s" in the database="%s"', query, dbname)
+            cur.execute(query)
 
-        for d in self._get_all_databases():
-            conn_kwargs['dbname'] = d
-            with get_connection_cursor(**conn_kwargs) as cur:
+        self.for_each_database('Dropping incompatible extensions', drop_extensions, raise_on_error=True)
 
-                cmd = "REVOKE EXECUTE ON FUNCTION pg_catalog.pg_switch_{0}() FROM admin".format(self.wal_name)
-                logger.info('Executing "%s" in the database="%s"', cmd, d)
-                cur.execute(cmd)
+    @staticmethod
+    def truncate_unlogged_tables(cur, dbname):
+        cur.execute("SELECT oid::regclass FROM pg_catalog.pg_class WHERE relpersistence = 'u' AND relkind = 'r'")
+        tables = [r[0] for r in cur.fetchall()]
+        if not tables:
+            return
+
+        logger.info('Truncating unlogged tables %s in the database="%s"', ', '.join(tables), dbname)
+        try:
+            cur.execute('TRUNCATE {0}'.format(', '.join(tables)))
+            return
+        except Exception as e:
+            logger.error('Failed: %r, truncating tables one by one', e)
+
+        for unlogged in tables:
+            logger.info('Truncating unlogged table %s', unlogged)
+            try:
+                cur.execute('TRUNCATE {0}'.format(unlogged))
+            except Exception as e:
+                logger.error('Failed: %r', e)
 
-                logger.info('Executing "DROP FUNCTION metric_helpers.pg_stat_statements" in the database="%s"', d)
-                cur.execute("DROP FUNCTION IF EXISTS metric_helpers.pg_stat_statements(boolean) CASCADE")
+    def drop_possibly_incompatible_objects(self):
+        logger.info('Dropping objects from the cluster which could be incompatible')
+        extensions = ('pg_stat_kcache', 'pg_stat_statements') + self._INCOMPATIBLE_EXTENSIONS
+        queries = ['REVOKE EXECUTE ON FUNCTION pg_catalog.pg_switch_{0}() FROM admin'.format(self.wal_name),
+                   'DROP FUNCTION IF EXISTS metric_helpers.pg_stat_statements(boolean) CASCADE',
+                   'DROP EXTENSION IF EXISTS {0}'.format(', '.join(extensions))]
 
-                for ext in ('pg_stat_kcache', 'pg_stat_statements') + self._INCOMPATIBLE_EXTENSIONS:
-                    logger.info('Executing "DROP EXTENSION IF EXISTS %s" in the database="%s"', ext, d)
-                    cur.execute("DROP EXTENSION IF EXISTS {0}".format(ext))
+        def drop_objects(cur, dbname):
+            # all statements are sent in one round trip
+            logger.info('Executing "%s" in the database="%s"', '; '.join(queries), dbname)
+            cur.execute(';'.join(queries))
+            self.truncate_unlogged_tables(cur, dbname)
 
-                cur.execute("SELECT oid::regclass FROM pg_catalog.pg_class"
-                            " WHERE relpersistence = 'u' AND relkind = 'r'")
-                for unlogged in cur.fetchall():
-                    logger.info('Truncating unlogged table %s', unlogged[0])
-                    try:
-                        cur.execute('TRUNCATE {0}'.format(unlogged[0]))
-                    except Exception as e:
-                        logger.error('Failed: %r', e)
+        self.for_each_database('Dropping incompatible objects', drop_objects, raise_on_error=True)
 
     def update_extensions(self):
-        from patroni.postgresql.connection import get_connection_cursor
-
-        conn_kwargs = self.local_conn_kwargs
-
-        for d in self._get_all_databases():
-            conn_kwargs['dbname'] = d
-            with get_connection_cursor(**conn_kwargs) as cur:
-                cur.execute('SELECT quote_ident(extname), extversion FROM pg_catalog.pg_extension')
-                for extname, version in cur.fetchall():
-                    # require manual update to 5.X+
-                    if extname == 'pg_partman' and int(version[0]) < 5:
-                        logger.warning("Skipping update of '%s' in database=%s. "
-                                       "Extension version: %s. Consider manual update",
-                                       extname, d, version)
-                        continue
-                    query = 'ALTER EXTENSION {0} UPDATE'.format(extname)
-                    logger.info("Executing '%s' in the database=%s", query, d)
-                    try:
-                        cur.execute(query)
-                    except Exception as e:
-                        logger.error('Failed: %r', e)
+        def update_extensions(cur, dbname):
+            cur.execute('SELECT quote_ident(extname), extversion FROM pg_catalog.pg_extension')
+            for extname, version in cur.fetchall():
+                # require manual update to 5.X+
+                if extname == 'pg_partman' and int(version[0]) < 5:
+                    logger.warning("Skipping update of '%s' in database=%s. "
+                                   "Extension version: %s. Consider manual update",
+                                   extname, dbname, version)
+                    continue
+                query = 'ALTER EXTENSION {0} UPDATE'.format(extname)
+                logger.info("Executing '%s' in the database=%s", query, dbname)
+                try:
+                    cur.execute(query)
+                except Exception as e:
+                    logger.error('Failed: %r', e)
+
+        self.for_each_database('Updating extensions', update_extensions)
 
     @staticmethod
     def remove_new_data(d):
@@ -161,6 +230,40 @@ class _PostgresqlUpgrade(Postgresql):
         self.configure_server_parameters()
         return True
 
+    def check_new_cluster(self, timeout):
+        """Starts the upgraded cluster only for local read-only connections and connects to every database.
+
+        The cluster is stopped afterwards, so that replicas could be resynced from it or it could be dropped."""
+        from patroni.postgresql.connection import get_connection_cursor
+
+        options = "-c listen_addresses='' -c archive_mode=off -c default_transaction_read_only=on"
+        if not self.pg_ctl('start', '-w', '-t', str(timeout), '-o', options):
+            return logger.error('Failed to start the new cluster')
+
+        try:
+            with get_connection_cursor(**dict(self.local_conn_kwargs, connect_timeout=3)) as cur:
+                cur.execute('SELECT pg_catalog.pg_is_in_recovery()')
+                if cur.fetchone()[0]:
+                    return logger.error('The new cluster is in recovery')
+                cur.execute('SELECT datname FROM pg_catalog.pg_database WHERE datallowconn')
+                databases = [d[0] for d in cur.fetchall()]
+
+            def check(cur, dbname):
+                cur.execute('SELECT COUNT(*) FROM pg_catalog.pg_class')
+                return cur.fetchone()[0] > 0
+
+            results = self.for_each_database('Health check', check, databases)
+            failed = [dbname for dbname in databases if not results.get(dbname)]
+            if failed:
+                return logger.error('Health check failed in databases %s', failed)
+            return True
+        except Exception as e:
+            logger.error('Health check failed: %r', e)
+        finally:
+            if not self.pg_ctl('stop', '-w', '-t', str(timeout), '-m', 'fast'):
+                logger.error('Failed to stop the new cluster')
+                return False
+
     def switch_back_pgdata(self):
         if os.path.exists(self._data_dir):
             self._new_data_dir = self._data_dir + '_new'
@@ -178,7 +281,10 @@ class _PostgresqlUpgrade(Postgresql):
         old_cwd = os.getcwd()
         os.chdir(upgrade_dir)
 
-        pg_upgrade_args = ['-k', '-j', str(psutil.cpu_count()),
+        from spilo_commons import get_cpu_count
+        from transfer_mode import PG_UPGRADE_OPTIONS
+
+        pg_upgrade_args = [PG_UPGRADE_OPTIONS[self.transfer_mode], '-j', str(get_cpu_count()),
                            '-b', self._old_bin_dir, '-B', self._new_bin_dir,
                            '-d', self._data_dir, '-D', self._new_data_dir,
                            '-O', "-c timescaledb.restoring='on'",
@@ -193,7 +299,7 @@ class _PostgresqlUpgrade(Postgresql):
 
         self.set_bin_dir(self._new_bin_dir)
 
-        logger.info('Executing pg_upgrade%s', (' --check' if check else ''))
+        logger.info('Executing pg_upgrade%s in %s mode', (' --check' if check else ''), self.transfer_mode)
         if subprocess.call([self.pgcommand('pg_upgrade')] + pg_upgrade_args) == 0:
             if check:
                 self.set_bin_dir(self._old_bin_dir)
@@ -268,32 +374,19 @@ class _PostgresqlUpgrade(Postgresql):
         return self.pg_upgrade() and self.restore_shared_preload_libraries()\
                  and self.switch_pgdata() and self.cleanup_old_pgdata()
 
-    def analyze(self, in_stages=False):
-        vacuumdb_args = ['--analyze-in-stages'] if in_stages else []
-        logger.info('Rebuilding statistics (vacuumdb%s)', (' ' + vacuumdb_args[0] if in_stages else ''))
-        if 'username' in self.config.superuser:
-            vacuumdb_args += ['-U', self.config.superuser['username']]
-        vacuumdb_args += ['-Z', '-j']
-
-        # vacuumdb is processing databases sequantially, while we better do them in parallel,
-        # because it will help with the case when there are multiple databases in the same cluster.
-        single_worker_dbs = ('postgres', 'template1')
-        databases = self._get_all_databases()
-        db_count = len([d for d in databases if d not in single_worker_dbs])
-        # calculate concurrency per database, except always existing "single_worker_dbs" (they'll get always 1 worker)
-        concurrency = str(max(1, int(psutil.cpu_count()/max(1, db_count))))
-        procs = []
-        for d in databases:
-            j = '1' if d in single_worker_dbs else concurrency
-            try:
-                procs.append(subprocess.Popen([self.pgcommand('vacuumdb')] + vacuumdb_args + [j, '-d', d]))
-            except Exception:
-                pass
-        for proc in procs:
-            try:
-                proc.wait()
-            except Exception:
-                pass
+    def analyze(self, in_stages=False, missing_stats_only=False, only=None, scans=None, boost=None):
+        """Rebuilds statistics of all databases with the global budget of workers, hot relations first.
+
+        Arguments are passed to ``analyze_scheduler.analyze()``, ``missing_stats_only`` is used when
+        statistics were preserved by pg_upgrade."""
+        from analyze_scheduler import analyze
+
+        logger.info('Rebuilding statistics (%s)', 'in stages' if in_stages else 'single stage')
+        try:
+            analyze(self.local_conn_kwargs, self._get_all_databases(), in_stages=in_stages,
+                    missing_only=missing_stats_only, only=only, scans=scans, boost=boost)
+        except Exception as e:
+            logger.error('Failed to rebuild statistics: %r', e)
 
 
 def PostgresqlUpgrade(config):
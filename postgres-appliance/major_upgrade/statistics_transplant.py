@@ -0,0 +1,124 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# pg_upgrade preserves optimizer statistics starting from this version
+NATIVE_STATISTICS_VERSION = 18
+
+SLOTS = range(1, 6)
+# STATISTIC_KIND_MCV .. STATISTIC_KIND_BOUNDS_HISTOGRAM, other kinds are produced by custom typanalyze functions
+MAX_KNOWN_KIND = 7
+
+STATISTIC_FILE = '{0}.statistic'
+CLASS_FILE = '{0}.class'
+
+
+def _slot_columns(template):
+    return ', '.join(template.format(i) for i in SLOTS)
+
+
+_RELATION = "pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(c.relname)"
+_FROM_CLASS = 'FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace'
+_FROM_STATISTIC = _FROM_CLASS + ' JOIN pg_catalog.pg_statistic s ON s.starelid = c.oid'
+_MAX_KIND = 'GREATEST(' + _slot_columns('s.stakind{0}') + ')'
+
+DUMP_STATISTIC = ' '.join([
+    'SELECT', _RELATION + ', a.attname, s.stainherit, s.stanullfrac, s.stawidth, s.stadistinct,',
+    _slot_columns('s.stakind{0}') + ',', _slot_columns('s.staop{0}::pg_catalog.regoperator::text') + ',',
+    _slot_columns('s.stanumbers{0}::text') + ',', _slot_columns('s.stavalues{0}::text'), _FROM_STATISTIC,
+    'JOIN pg_catalog.pg_attribute a ON a.attrelid = s.starelid AND a.attnum = s.staattnum',
+    'WHERE c.oid >= 16384 AND', _MAX_KIND, '<=', str(MAX_KNOWN_KIND)])
+
+DUMP_CLASS = ' '.join(['SELECT', _RELATION + ', c.relpages, c.reltuples, c.relallvisible', _FROM_CLASS,
+                       "WHERE c.oid >= 16384 AND c.relkind IN ('r', 'm', 'i', 'p')"])
+
+# relations with statistics produced by custom typanalyze functions
+DUMP_UNKNOWN = ' '.join(['SELECT DISTINCT', _RELATION, _FROM_STATISTIC,
+                         'WHERE c.oid >= 16384 AND', _MAX_KIND, '>', str(MAX_KNOWN_KIND)])
+
+CREATE_TEMP_TABLES = ('CREATE TEMPORARY TABLE spilo_statistic (relation text, attname name, stainherit boolean,'
+                      ' stanullfrac real, stawidth integer, stadistinct real, '
+                      + _slot_columns('stakind{0} smallint') + ', ' + _slot_columns('staop{0} text') + ', '
+                      + _slot_columns('stanumbers{0} text') + ', ' + _slot_columns('stavalues{0} text') + ');'
+                      'CREATE TEMPORARY TABLE spilo_class (relation text, relpages integer,'
+                      ' reltuples real, relallvisible integer)')
+
+# MCELEM (4) holds values of the element type, RANGE_LENGTH_HISTOGRAM (6) holds float8 lengths
+_ELEMENT_TYPE = ("CASE s.stakind{0} WHEN 4 THEN CASE WHEN a.atttypid = 'pg_catalog.tsvector'::pg_catalog.regtype"
+                 " THEN 'pg_catalog.text'::pg_catalog.regtype::oid ELSE t.typelem END"
+                 " WHEN 6 THEN 'pg_catalog.float8'::pg_catalog.regtype::oid ELSE a.atttypid END")
+_TYPMOD = 'CASE WHEN s.stakind{0} IN (4, 6) THEN -1 ELSE a.atttypmod END'
+
+_MAPPED = (' FROM spilo_statistic s JOIN pg_catalog.pg_attribute a'
+           ' ON a.attrelid = pg_catalog.to_regclass(s.relation) AND a.attname = s.attname AND NOT a.attisdropped'
+           ' JOIN pg_catalog.pg_type t ON t.oid = a.atttypid')
+
+DELETE_STATISTIC = ('DELETE FROM pg_catalog.pg_statistic WHERE starelid IN'
+                    ' (SELECT pg_catalog.to_regclass(relation) FROM spilo_statistic s{0})')
+
+UPDATE_CLASS = ('UPDATE pg_catalog.pg_class c SET relpages = s.relpages, reltuples = s.reltuples,'
+                ' relallvisible = s.relallvisible FROM spilo_class s WHERE c.oid = pg_catalog.to_regclass(s.relation)')
+
+# relations which must be analyzed: there are no statistics or they have extended statistics
+REFRESH = ("SELECT c.oid::pg_catalog.regclass FROM pg_catalog.pg_class c WHERE c.oid >= 16384"
+           " AND c.relkind IN ('r', 'm', 'p')"
+           " AND (NOT EXISTS (SELECT 1 FROM pg_catalog.pg_statistic s WHERE s.starelid = c.oid)"
+           " OR EXISTS (SELECT 1 FROM pg_catalog.pg_statistic_ext e WHERE e.stxrelid = c.oid))")
+
+
+def insert_statistic_query(with_collations):
+    columns = ['starelid', 'staattnum', 'stainherit', 'stanullfrac', 'stawidth', 'stadistinct',
+               _slot_columns('stakind{0}'), _slot_columns('staop{0}')]
+    values = ['a.attrelid', 'a.attnum', 's.stainherit', 's.stanullfrac', 's.stawidth', 's.stadistinct',
+              _slot_columns('s.stakind{0}'), _slot_columns('s.staop{0}::pg_catalog.regoperator')]
+    if with_collations:
+        columns.append(_slot_columns('stacoll{0}'))
+        values.append(_slot_columns('CASE WHEN s.stakind{0} BETWEEN 1 AND 5 THEN a.attcollation ELSE 0 END'))
+    columns += [_slot_columns('stanumbers{0}'), _slot_columns('stavalues{0}')]
+    values += [_slot_columns('s.stanumbers{0}::real[]'),
+               ', '.join('pg_catalog.array_in(s.stavalues{0}::cstring, {1}, {2})'
+                         .format(i, _ELEMENT_TYPE.format(i), _TYPMOD.format(i)) for i in SLOTS)]
+    query = 'INSERT INTO pg_catalog.pg_statistic ({0}) SELECT {1}'
+    return query.format(', '.join(columns), ', '.join(values)) + _MAPPED
+
+
+def dump_statistics(cur, dump_dir, name):
+    """Dumps statistics and size estimates of user relations of the old cluster to the dump_dir.
+
+    Returns relations which statistics can't be transplanted."""
+    with open(os.path.join(dump_dir, STATISTIC_FILE.format(name)), 'w') as f:
+        cur.copy_expert('COPY ({0}) TO STDOUT'.format(DUMP_STATISTIC), f)
+    with open(os.path.join(dump_dir, CLASS_FILE.format(name)), 'w') as f:
+        cur.copy_expert('COPY ({0}) TO STDOUT'.format(DUMP_CLASS), f)
+    cur.execute(DUMP_UNKNOWN)
+    return [r[0] for r in cur.fetchall()]
+
+
+def restore_statistics(cur, dbname, dump_dir, name):
+    """Loads statistics into the new cluster, relations are matched by names.
+
+    Returns relations which have to be analyzed."""
+    cur.execute(CREATE_TEMP_TABLES)
+    with open(os.path.join(dump_dir, STATISTIC_FILE.format(name))) as f:
+        cur.copy_expert('COPY spilo_statistic FROM STDIN', f)
+    with open(os.path.join(dump_dir, CLASS_FILE.format(name))) as f:
+        cur.copy_expert('COPY spilo_class FROM STDIN', f)
+
+    # statements sent in one query are executed in one transaction
+    insert = insert_statistic_query(cur.connection.server_version >= 120000)
+    try:
+        cur.execute(DELETE_STATISTIC.format('') + ';' + insert)
+    except Exception as e:
+        logger.error('Failed to restore statistics in the database=%s: %r, restoring relations one by one', dbname, e)
+        cur.execute('SELECT DISTINCT relation FROM spilo_statistic')
+        condition = ' WHERE s.relation = %s'
+        for relation, in cur.fetchall():
+            try:
+                cur.execute(DELETE_STATISTIC.format(condition) + ';' + insert + condition, (relation, relation))
+            except Exception as e:
+                logger.warning('Failed to restore statistics of %s in the database=%s: %r', relation, dbname, e)
+
+    cur.execute(UPDATE_CLASS)
+    cur.execute(REFRESH)
+    return [r[0] for r in cur.fetchall()]
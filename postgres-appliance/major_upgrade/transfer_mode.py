@@ -0,0 +1,101 @@
+import fcntl
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+PG_UPGRADE_OPTIONS = {'link': '-k', 'clone': '--clone', 'copy-file-range': '--copy-file-range', 'copy': '--copy'}
+# the version of pg_upgrade which supports the mode
+MIN_VERSIONS = {'link': 0, 'clone': 12, 'copy-file-range': 17, 'copy': 16}
+# pg_upgrade preserves relfilenodes and database oids starting from this version, hence relation
+# files of the new cluster have the same paths as in the old one and replicas could link them locally
+SAME_PATHS_VERSION = 15
+
+PROBE_SIZE = 64 * MB
+
+
+def clone_file(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def copy_file_range(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        offset, size = 0, os.fstat(s.fileno()).st_size
+        while offset < size:
+            copied = os.copy_file_range(s.fileno(), d.fileno(), size - offset, offset, offset)
+            if not copied:
+                break
+            offset += copied
+
+
+def measure(func, src, dst):
+    """Returns the throughput in bytes per second, or None if the method isn't supported"""
+    start = time.time()
+    try:
+        func(src, dst)
+        os.sync()
+    except (OSError, AttributeError) as e:
+        logger.info('%s is not supported: %r', func.__name__, e)
+        return None
+    finally:
+        if os.path.exists(dst):
+            os.unlink(dst)
+    return PROBE_SIZE / max(time.time() - start, 0.001)
+
+
+def probe(directory):
+    """Measures throughput of cloning on the filesystem of the directory"""
+    src = os.path.join(directory, '.transfer_mode_probe')
+    dst = src + '.copy'
+    try:
+        with open(src, 'wb') as f:
+            for _ in range(PROBE_SIZE // MB):
+                f.write(os.urandom(MB))
+            os.fsync(f.fileno())
+        return measure(clone_file, src, dst)
+    finally:
+        if os.path.exists(src):
+            os.unlink(src)
+
+
+def choose(requested, version, directory, replicas):
+    """Returns the pg_upgrade transfer mode and the measured throughput of cloning.
+
+    Cloning shares data blocks between both clusters, therefore it is as fast as linking, but keeps
+    the old cluster intact for a rollback. Auto mode chooses only between cloning and linking, copying
+    takes time and disk space proportional to the size of the data and must be requested explicitly.
+    With replicas linking is enforced (even if another mode was requested) for upgrades to versions
+    where relation files can't be matched by paths, otherwise everything must be transferred to replicas."""
+    version = float(version)
+    if replicas and version < SAME_PATHS_VERSION:
+        if requested not in ('auto', 'link'):
+            logger.warning('Transfer mode %s is not possible with replicas and pg_upgrade %s, using link',
+                           requested, version)
+        return 'link', None
+
+    if requested != 'auto':
+        if version < MIN_VERSIONS.get(requested, float('inf')):
+            logger.warning('Transfer mode %s is not supported by pg_upgrade %s, using link', requested, version)
+            return 'link', None
+        return requested, None
+
+    if version < MIN_VERSIONS['clone']:
+        return 'link', None
+
+    try:
+        throughput = probe(directory)
+    except Exception as e:
+        logger.error('Failed to probe cloning: %r', e)
+        return 'link', None
+
+    if throughput:
+        logger.info('Measured throughput of cloning: %.0f MB/s', throughput / MB)
+        return 'clone', throughput
+    return 'link', None
@@ -0,0 +1,80 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# seconds = fixed + sum(coefficient * feature). The coefficients are rough defaults,
+# predictions are scaled by the median ratio of measured to predicted durations of past upgrades.
+MODELS = {
+    # pg_upgrade -k dumps and restores the schema (per relation and per large object) and links relation files
+    'pg_upgrade': (10, {'databases': 1.0, 'relations': 0.002, 'large_objects': 0.0005, 'relation_files': 0.0001}),
+    # hard links are recreated on replicas, only the new catalog is transferred
+    'rsync': (5, {'relation_files': 0.0002, 'catalog_bytes': 1.0 / (50 * MB)}),
+    # ANALYZE in stages, reads a sample of every table
+    'analyze': (5, {'tables': 0.01, 'analyze_bytes': 1.0 / (100 * MB)})
+}
+
+# shutdown, update of configs, building of the manifest and restart of Patroni and postgres
+DEFAULT_DOWNTIME_OVERHEAD = 30
+CALIBRATION_RECORDS = 10
+
+
+def count_relation_files(data_dir):
+    """number and size of relation files (including tablespaces), pg_upgrade -k links each of them"""
+    files = size = 0
+    for top in ('base', 'global', 'pg_tblspc'):
+        for root, _, names in os.walk(os.path.join(data_dir, top), followlinks=True):
+            for name in names:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_size
+                    files += 1
+                except OSError:
+                    pass
+    return files, size
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def predict(model, features):
+    fixed, coefficients = model
+    return fixed + sum(coefficient * features.get(name, 0) for name, coefficient in coefficients.items())
+
+
+def calibrate(history, phase):
+    """Returns the correction factor for the model and the number of upgrades used to calculate it"""
+    model = MODELS[phase]
+    ratios = []
+    for record in history:
+        seconds = record.get('phases', {}).get(phase)
+        if record.get('success') and seconds and all(name in record for name in model[1]):
+            ratios.append(seconds / predict(model, record))
+    ratios = ratios[-CALIBRATION_RECORDS:]
+    return (median(ratios) if ratios else 1.0), len(ratios)
+
+
+def downtime_overhead(history):
+    overheads = [r['downtime'] - sum(r['phases'].get(p, 0) for p in ('pg_upgrade', 'rsync'))
+                 for r in history if r.get('success') and r.get('downtime') and r.get('phases')]
+    overheads = [o for o in overheads[-CALIBRATION_RECORDS:] if o > 0]
+    return median(overheads) if overheads else DEFAULT_DOWNTIME_OVERHEAD
+
+
+def estimate(features, history, replicas):
+    """Predicts durations of the pg_upgrade, rsync and analyze phases and the downtime"""
+    ret = {'phases': {}, 'calibrated_on': {}}
+    for phase, model in MODELS.items():
+        if phase == 'rsync' and not replicas:
+            continue
+        factor, count = calibrate(history, phase)
+        ret['phases'][phase] = round(predict(model, features) * factor, 1)
+        ret['calibrated_on'][phase] = count
+
+    ret['downtime'] = round(downtime_overhead(history) + ret['phases']['pg_upgrade'] + ret['phases'].get('rsync', 0), 1)
+    ret['total'] = round(ret['downtime'] + ret['phases']['analyze'], 1)
+    return ret
@@ -0,0 +1,186 @@
+import heapq
+import json
+import logging
+import os
+import re
+import stat
+import time
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+# the WAL of the new cluster isn't required on replicas, the same as with the full rsync
+SKIP_DIRS = ('pg_wal', 'pg_xlog')
+
+DIRS_FILE = 'dirs'
+SYMLINKS_FILE = 'symlinks'
+LINKS_FILE = 'links'
+FILES_FILE = 'files'
+SUMMARY_FILE = 'summary.json'
+
+# files of user relations in the default tablespace: base/<dboid>/<relfilenode>[_<fork>][.<segment>]
+USER_RELATION_FILE = re.compile(r'^base/\d+/(\d+)(_[a-z]+)?(\.\d+)?$')
+FIRST_NORMAL_OBJECT_ID = 16384
+
+
+def shard_file(shard):
+    return '{0}.{1}'.format(FILES_FILE, shard)
+
+
+def split_into_shards(files, shard_sizes):
+    """Assigns (path, size) pairs to shards, the biggest files first to the least loaded shard"""
+    heap = [(size, i) for i, size in enumerate(shard_sizes)]
+    heapq.heapify(heap)
+    shards = [[] for _ in shard_sizes]
+    for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+        total, i = heapq.heappop(heap)
+        shards[i].append(path)
+        shard_sizes[i] = total + size
+        heapq.heappush(heap, (shard_sizes[i], i))
+    return shards
+
+
+def walk(pgroot, top):
+    """yields (relative path, lstat result) for every entry under pgroot/top, including top"""
+    path = os.path.join(pgroot, top)
+    yield top, os.lstat(path)
+    for root, dirs, files in os.walk(path):
+        rel_root = os.path.relpath(root, pgroot)
+        for name in list(dirs) + files:
+            rel_path = os.path.join(rel_root, name)
+            if rel_root == top and name in SKIP_DIRS and name in dirs:
+                dirs.remove(name)  # keep the directory itself, but not its content
+            yield rel_path, os.lstat(os.path.join(pgroot, rel_path))
+
+
+def is_user_relation_file(path):
+    match = USER_RELATION_FILE.match(path)
+    return bool(match) and int(match.group(1)) >= FIRST_NORMAL_OBJECT_ID
+
+
+def build_manifest(pgroot, data_dir, old_data_dir, manifest_dir, shards=1, match_paths=False):
+    """Describes how to create the new data directory on replicas from the old one.
+
+    After ``pg_upgrade -k`` most files in the new data directory are hard links to files in the old one,
+    replicas have the same old files and could recreate these links locally. Only remaining files
+    (mostly catalog) must be transferred, they are split into shards of similar size in order to be
+    transferred by concurrent rsync streams. Paths are relative to pgroot and separated by tabs.
+
+    If pg_upgrade copied or cloned files instead of linking, ``match_paths`` allows to match files of user
+    relations by their paths relative to data directories and sizes. It's only correct when pg_upgrade
+    preserves relfilenodes and database oids (15+), replicas link such files locally as well."""
+    start = time.time()
+
+    old_inodes = {}
+    old_paths = {}
+    for path, st in walk(pgroot, old_data_dir):
+        if stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                old_inodes[(st.st_dev, st.st_ino)] = path
+            if match_paths:
+                rel_path = os.path.relpath(path, old_data_dir)
+                if is_user_relation_file(rel_path):
+                    old_paths[rel_path] = (path, st.st_size)
+
+    summary = {'dirs': 0, 'symlinks': 0, 'links': 0, 'linked_bytes': 0, 'files': 0, 'file_bytes': 0}
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+
+    transfer = []
+    files = {}
+    for name in (DIRS_FILE, SYMLINKS_FILE, LINKS_FILE):
+        files[name] = open(os.path.join(manifest_dir, name), 'w')
+    try:
+        for path, st in walk(pgroot, data_dir):
+            if stat.S_ISDIR(st.st_mode):
+                files[DIRS_FILE].write('{0}\t{1:o}\n'.format(path, stat.S_IMODE(st.st_mode)))
+                summary['dirs'] += 1
+            elif stat.S_ISLNK(st.st_mode):
+                files[SYMLINKS_FILE].write('{0}\t{1}\n'.format(path, os.readlink(os.path.join(pgroot, path))))
+                summary['symlinks'] += 1
+            elif stat.S_ISREG(st.st_mode):
+                old_path = old_inodes.get((st.st_dev, st.st_ino)) if st.st_nlink > 1 else None
+                if not old_path and match_paths:
+                    old_path, old_size = old_paths.get(os.path.relpath(path, data_dir), (None, None))
+                    if old_size != st.st_size:
+                        old_path = None
+                if old_path:
+                    files[LINKS_FILE].write('{0}\t{1}\t{2}\n'.format(path, old_path, st.st_size))
+                    summary['links'] += 1
+                    summary['linked_bytes'] += st.st_size
+                else:
+                    transfer.append((path, st.st_size))
+                    summary['files'] += 1
+                    summary['file_bytes'] += st.st_size
+    finally:
+        for f in files.values():
+            f.close()
+
+    summary['shard_bytes'] = [0] * shards
+    for shard, paths in enumerate(split_into_shards(transfer, summary['shard_bytes'])):
+        with open(os.path.join(manifest_dir, shard_file(shard)), 'w') as f:
+            f.writelines(path + '\n' for path in paths)
+
+    summary['seconds'] = round(time.time() - start, 1)
+    with open(os.path.join(manifest_dir, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f)
+
+    logger.info('Manifest: %s directories, %s hard links (%s bytes), %s files to transfer (%s bytes), took %s seconds',
+                summary['dirs'], summary['links'], summary['linked_bytes'], summary['files'],
+                summary['file_bytes'], summary['seconds'])
+    return summary
+
+
+def read_manifest(manifest_dir, name):
+    with open(os.path.join(manifest_dir, name)) as f:
+        return [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+
+def apply_manifest(pgroot, manifest_dir, workers):
+    """Creates directories, symlinks and hard links according to the manifest.
+
+    Returns lists of files per shard that must be transferred from the primary: files from the manifest
+    and files which could not be linked because the local copy is missing or has a different size."""
+    start = time.time()
+
+    with open(os.path.join(manifest_dir, SUMMARY_FILE)) as f:
+        shard_sizes = json.load(f).get('shard_bytes', [0])
+
+    for path, mode in read_manifest(manifest_dir, DIRS_FILE):
+        full_path = os.path.join(pgroot, path)
+        if not os.path.isdir(full_path):
+            os.mkdir(full_path)
+        os.chmod(full_path, int(mode, 8))
+
+    for path, target in read_manifest(manifest_dir, SYMLINKS_FILE):
+        os.symlink(target, os.path.join(pgroot, path))
+
+    def link(entry):
+        path, old_path, size = entry
+        old_path = os.path.join(pgroot, old_path)
+        try:
+            if os.path.getsize(old_path) == int(size):
+                os.link(old_path, os.path.join(pgroot, path))
+                return None
+        except OSError:
+            pass
+        return path, int(size)
+
+    links = read_manifest(manifest_dir, LINKS_FILE)
+    pool = ThreadPool(max(1, workers))
+    try:
+        missing = [entry for entry in pool.imap_unordered(link, links, 1000) if entry]
+    finally:
+        pool.close()
+        pool.join()
+
+    shards = [[entry[0] for entry in read_manifest(manifest_dir, shard_file(shard))]
+              for shard in range(len(shard_sizes))]
+    for shard, paths in enumerate(split_into_shards(missing, shard_sizes)):
+        shards[shard].extend(paths)
+
+    logger.info('Created %s hard links in %.1f seconds, %s files are missing locally, '
+                '%s files to transfer in %s shards', len(links) - len(missing), time.time() - start,
+                len(missing), sum(len(paths) for paths in shards), len(shards))
+    return shards
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import math
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+from queue import Empty, Queue
+
+import psycopg2
+
+from spilo_commons import get_cpu_count
+from spilo_metrics import record
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# tables with custom statistics targets are usually the ones where plans depend on detailed statistics
+CUSTOM_TARGET_BONUS = 3
+
+# the same as vacuumdb --analyze-in-stages does
+STAGES = ('SET default_statistics_target = 1; SET vacuum_cost_delay = 0',
+          'SET default_statistics_target = 10; RESET vacuum_cost_delay',
+          'RESET default_statistics_target')
+SINGLE_STAGE = ('SET vacuum_cost_delay = 0',)
+
+_RELATION = "pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(c.relname)"
+
+RELATIONS = ('SELECT ' + _RELATION + ', COALESCE(s.seq_scan, 0) + COALESCE(s.idx_scan, 0),'
+             ' pg_catalog.pg_relation_size(c.oid), EXISTS (SELECT 1 FROM pg_catalog.pg_attribute a'
+             ' WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped AND a.attstattarget > 0)'
+             ' FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace'
+             ' LEFT JOIN pg_catalog.pg_stat_all_tables s ON s.relid = c.oid'
+             " WHERE c.relkind IN ('r', 'm') AND c.relpersistence != 't'")
+MISSING_STATISTICS = ' AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_statistic WHERE starelid = c.oid)'
+# relpages and reltuples are replicated, hence on a promoted replica they describe the relation at the time
+# of the last vacuum or analyze on the old primary. Relations which grew or shrunk since then need new estimates.
+STALE_STATISTICS = (' AND (c.reltuples < 0 OR NOT EXISTS (SELECT 1 FROM pg_catalog.pg_statistic WHERE starelid = c.oid)'
+                    ' OR pg_catalog.abs(pg_catalog.pg_relation_size(c.oid)'
+                    " / pg_catalog.current_setting('block_size')::integer - c.relpages) > c.relpages * {0} + {1})")
+STALE_FRACTION = 0.2
+STALE_MIN_PAGES = 128
+
+# ANALYZE honors the cost-based delay, every page read from disk costs vacuum_cost_page_miss (2 since 14)
+THROTTLE_DELAY = 10  # ms
+PAGE_MISS_COST = 2
+BLOCK_SIZE = 8192
+
+SCAN_COUNTS = ('SELECT pg_catalog.quote_ident(schemaname) || \'.\' || pg_catalog.quote_ident(relname),'
+               ' COALESCE(seq_scan, 0) + COALESCE(idx_scan, 0) FROM pg_catalog.pg_stat_all_tables')
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Analyzes relations of all databases using one pool of workers, '
+                                                 'the most frequently scanned and biggest relations first')
+    parser.add_argument('-d', '--dbname', action='append', help='database to analyze, all databases by default')
+    parser.add_argument('-j', '--jobs', type=int, help='number of concurrent connections, number of CPUs by default')
+    parser.add_argument('--in-stages', action='store_true', help='analyze with increasing statistics targets')
+    parser.add_argument('--missing-only', action='store_true', help='analyze only relations without statistics')
+    parser.add_argument('--stale-only', action='store_true',
+                        help='analyze only relations without statistics or with significantly changed size')
+    parser.add_argument('--max-rate', type=int, help='MB/s read by every worker, unlimited by default')
+    parser.add_argument('--idle-io', action='store_true', help='run backends with the idle I/O scheduling class')
+    return parser.parse_args()
+
+
+def get_scan_counts(cur):
+    """Returns the number of scans per relation. They are lost during pg_upgrade and
+       therefore must be saved beforehand in order to be used for prioritization"""
+    cur.execute(SCAN_COUNTS)
+    return dict(cur.fetchall())
+
+
+def priority(scans, size, custom_target):
+    """frequently scanned relations first, bigger relations get worse estimates without statistics"""
+    return math.log1p(scans) + math.log1p(size / MB) / 2 + (CUSTOM_TARGET_BONUS if custom_target else 0)
+
+
+def throttle(max_rate):
+    """Returns the cost-based delay settings which limit reading to max_rate MB/s"""
+    limit = max_rate * MB // BLOCK_SIZE * PAGE_MISS_COST * THROTTLE_DELAY // 1000
+    return 'SET vacuum_cost_delay = {0}; SET vacuum_cost_limit = {1}'.format(THROTTLE_DELAY, min(max(limit, 1), 10000))
+
+
+def connect(conn_kwargs, dbname, idle_io=False):
+    conn = psycopg2.connect(**dict(conn_kwargs, dbname=dbname))
+    conn.autocommit = True
+    if idle_io:
+        set_idle_priority(conn)
+    return conn
+
+
+def set_idle_priority(conn):
+    """ANALYZE is executed by the backend, therefore its CPU and I/O priorities are lowered.
+       It works only if the backend runs on the same host under the same user."""
+    import psutil
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_catalog.pg_backend_pid()')
+            backend = psutil.Process(cur.fetchone()[0])
+        backend.nice(19)
+        backend.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except Exception as e:
+        logger.warning('Failed to lower priority of the backend: %r', e)
+
+
+def get_databases(conn_kwargs):
+    conn = connect(conn_kwargs, conn_kwargs.get('dbname', 'postgres'))
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT datname FROM pg_catalog.pg_database WHERE datallowconn')
+            return [r[0] for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+def get_relations(conn_kwargs, dbname, missing_only, stale_only=False):
+    conn = connect(conn_kwargs, dbname)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(RELATIONS + (MISSING_STATISTICS if missing_only else '')
+                        + (STALE_STATISTICS.format(STALE_FRACTION, STALE_MIN_PAGES) if stale_only else ''))
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def schedule(relations, stages, only=None, scans=None, boost=None):
+    """Returns (stage, dbname, relation) tuples ordered by stage and by priority of relations.
+
+    only: {dbname: [relations]} restricts relations to be analyzed, None as a value means all relations
+    scans: {dbname: {relation: scans}} saved before upgrade, used instead of current counters if bigger
+    boost: {dbname: [relations]} with custom statistics targets, if they were reset before analyze"""
+    tasks = []
+    for dbname, rows in relations.items():
+        allowed = None if only is None or only.get(dbname) is None else set(only[dbname])
+        saved_scans = (scans or {}).get(dbname) or {}
+        boosted = set((boost or {}).get(dbname) or ())
+        for relation, relation_scans, size, custom_target in rows:
+            if allowed is not None and relation not in allowed:
+                continue
+            relation_scans = max(relation_scans, saved_scans.get(relation, 0))
+            tasks.append((priority(relation_scans, size, custom_target or relation in boosted), dbname, relation))
+    tasks.sort(reverse=True)
+    return [(stage, dbname, relation) for stage in range(len(stages)) for _, dbname, relation in tasks]
+
+
+def analyze(conn_kwargs, databases=None, jobs=None, in_stages=False, missing_only=False,
+            only=None, scans=None, boost=None, stale_only=False, max_rate=None, idle_io=False):
+    """Analyzes relations of all databases with a single budget of concurrent connections"""
+    start = time.time()
+    jobs = max(1, jobs or get_cpu_count())
+    stages = STAGES if in_stages else SINGLE_STAGE
+    if max_rate:
+        # the last SET wins, it overrides the cost delay of the stage
+        stages = tuple('{0}; {1}'.format(stage, throttle(max_rate)) for stage in stages)
+
+    if databases is None:
+        databases = get_databases(conn_kwargs)
+    if only is not None:
+        databases = [d for d in databases if d in only and only[d] != []]
+    if not databases:
+        return 0
+
+    pool = ThreadPool(min(jobs, len(databases)))
+    try:
+        results = pool.map(lambda d: (d, get_relations(conn_kwargs, d, missing_only, stale_only)), databases)
+    finally:
+        pool.close()
+        pool.join()
+
+    tasks = Queue()
+    for task in schedule(dict(results), stages, only, scans, boost):
+        tasks.put(task)
+    total = tasks.qsize()
+    logger.info('Analyzing %s relations in %s databases with %s workers in %s stage(s)',
+                total // len(stages), len(databases), jobs, len(stages))
+
+    def worker(_):
+        conn = dbname = stage = None
+        failed = 0
+        try:
+            while True:
+                try:
+                    task = tasks.get_nowait()
+                except Empty:
+                    return failed
+                try:
+                    if task[1] != dbname:
+                        if conn:
+                            conn.close()
+                        conn, dbname, stage = connect(conn_kwargs, task[1], idle_io), task[1], None
+                    with conn.cursor() as cur:
+                        if task[0] != stage:
+                            stage = task[0]
+                            cur.execute(stages[stage])
+                        cur.execute('ANALYZE ' + task[2])
+                except Exception as e:
+                    logger.error('Failed to analyze %s in the database=%s: %r', task[2], task[1], e)
+                    failed += 1
+                    if conn and conn.closed:
+                        conn = dbname = None
+        finally:
+            if conn:
+                conn.close()
+
+    pool = ThreadPool(jobs)
+    try:
+        failed = sum(pool.map(worker, range(jobs)))
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info('Analyzed %s relations in %.1f seconds, %s failed', total - failed, time.time() - start, failed)
+    return failed
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    options = read_configuration()
+    start = time.time()
+    try:
+        failed = analyze({}, options.dbname, options.jobs, options.in_stages, options.missing_only,
+                         stale_only=options.stale_only, max_rate=options.max_rate, idle_io=options.idle_io)
+    except Exception:
+        logger.exception('Analyze failed')
+        record('analyze_scheduler', start, False)
+        return 1
+    record('analyze_scheduler', start, not failed, failed_relations=failed)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timezone
+
+import psycopg2
+
+from replica_planner import get_throughput, history_file as replica_history_file
+from spilo_commons import append_history, read_history
+from spilo_metrics import instrument, observe
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = 'backup_policy_history.json'
+
+# wal-g default is not to take delta backups at all, we allow a few
+DEFAULT_DELTA_MAX_STEPS = 6
+# restoring the backup (full + deltas) should take no longer than this
+DEFAULT_TARGET_RESTORE_TIME = 3600
+# deltas don't pay off when too much of the cluster has changed since the last full backup
+MAX_CHANGED_RATIO = 0.5
+# the cluster is considered idle when less WAL was generated since the last backup
+SKIP_CHANGED_RATIO = 0.01
+# but backups are not skipped forever, restoring would need to replay too much WAL
+MAX_SKIP_AGE = 7 * 86400
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Takes a full, a delta, or no base backup with wal-g depending on '
+                                                 'the amount of changes and the length of the delta chain')
+    parser.add_argument('--datadir', required=True)
+    return parser.parse_args()
+
+
+def lsn_to_str(lsn):
+    return '{0:X}/{1:X}'.format(lsn >> 32, lsn & 0xFFFFFFFF)
+
+
+def list_backups():
+    """Lists backups without details, which would download sentinels of all of them"""
+    backups = json.loads(subprocess.check_output(['wal-g', 'backup-list', '--json'],
+                                                 stderr=subprocess.DEVNULL)) or []
+    return sorted(backups, key=lambda b: b.get('time', ''))
+
+
+def read_sentinel(backup):
+    """Adds the start LSN, the size and the finish time from the stop sentinel of the backup"""
+    sentinel = json.loads(subprocess.check_output(
+        ['wal-g', 'st', 'cat', 'basebackups_005/{0}_backup_stop_sentinel.json'.format(backup['backup_name'])],
+        stderr=subprocess.DEVNULL))
+    return dict(backup, start_lsn=sentinel['LSN'], uncompressed_size=sentinel.get('UncompressedSize'),
+                finish_time=sentinel.get('FinishTime'))
+
+
+def get_wal_diff(start_lsn):
+    with psycopg2.connect('dbname=postgres', options='-c search_path=pg_catalog') as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_wal_lsn_diff(CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()"
+                        " ELSE pg_current_wal_lsn() END, %s)::bigint", (lsn_to_str(start_lsn),))
+            return max(cur.fetchone()[0], 0)
+
+
+def backup_age(backup):
+    try:
+        # wal-g reports nanoseconds, python accepts at most microseconds
+        value = re.sub(r'(\.\d{6})\d+', r'\1', backup.get('finish_time') or backup['time']).replace('Z', '+00:00')
+        return (datetime.now(timezone.utc) - datetime.fromisoformat(value)).total_seconds()
+    except Exception:
+        return None
+
+
+def is_delta(backup):
+    return '_D_' in backup.get('backup_name', '')
+
+
+def decide(backups, datadir):
+    """returns decision (full, delta or skip) and the reason"""
+    chain = []
+    for backup in reversed(backups):
+        chain.insert(0, backup)
+        if not is_delta(backup):
+            break
+    if not chain or is_delta(chain[0]):
+        return 'full', 'there is no full backup'
+    # only sentinels of the last full backup and of deltas based on it are needed
+    chain = [read_sentinel(backup) for backup in chain]
+
+    full, last = chain[0], chain[-1]
+    full_size = full.get('uncompressed_size') or 1
+    changed_since_full = get_wal_diff(full['start_lsn'])
+    changed_since_last = get_wal_diff(last['start_lsn'])
+    logger.info('Full backup size: %s, delta chain length: %s, WAL since the full backup: %s, since the last: %s',
+                full_size, len(chain) - 1, changed_since_full, changed_since_last)
+
+    age = backup_age(last)
+    if changed_since_last < full_size * SKIP_CHANGED_RATIO and age is not None and age < MAX_SKIP_AGE:
+        return 'skip', 'only {0} bytes of WAL since the last backup'.format(changed_since_last)
+
+    max_steps = int(os.environ.get('WALG_DELTA_MAX_STEPS') or DEFAULT_DELTA_MAX_STEPS)
+    if len(chain) > max_steps:
+        return 'full', 'delta chain length reached {0}'.format(max_steps)
+
+    if changed_since_full > full_size * MAX_CHANGED_RATIO:
+        return 'full', '{0} bytes of WAL since the full backup'.format(changed_since_full)
+
+    # WAL volume is the upper bound of the delta size, the same block could be changed many times
+    chain_size = sum(b.get('uncompressed_size') or 0 for b in chain) + min(changed_since_last, full_size)
+    throughput, _ = get_throughput(read_history(replica_history_file(datadir)), 'archive')
+    target = int(os.environ.get('BACKUP_TARGET_RESTORE_TIME') or DEFAULT_TARGET_RESTORE_TIME)
+    if chain_size / throughput > target:
+        return 'full', 'restore of the delta chain would take {0}s'.format(int(chain_size / throughput))
+
+    return 'delta', 'delta chain length is {0}'.format(len(chain))
+
+
+def backup_push(datadir, decision, backups):
+    env = os.environ.copy()
+    cmd = ['nice', '-n', '5', 'wal-g', 'backup-push', datadir]
+    if decision == 'full':
+        cmd.append('--full')
+    else:
+        # the chain length was already checked, make sure that wal-g doesn't fall back to a full backup
+        env['WALG_DELTA_MAX_STEPS'] = str(len(backups) + 1)
+    return subprocess.call(cmd, env=env)
+
+
+@instrument('backup_policy')
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    args = read_configuration()
+
+    record = {'time': int(time.time())}
+    try:
+        backups = list_backups()
+        decision, reason = decide(backups, args.datadir)
+    except Exception as e:
+        logger.exception('Failed to evaluate backup policy, taking a full backup')
+        backups, decision, reason = [], 'full', 'failed to evaluate policy: {0!r}'.format(e)
+    record.update(decision=decision, reason=reason, decision_seconds=round(time.time() - record['time'], 1))
+    logger.info('Backup decision: %s, %s', decision, reason)
+
+    ret = 0
+    if decision != 'skip':
+        started = time.time()
+        ret = backup_push(args.datadir, decision, backups)
+        record.update(backup_seconds=round(time.time() - started, 1), exitcode=ret)
+    observe('backup_policy', full=int(decision == 'full'), delta=int(decision == 'delta'),
+            skip=int(decision == 'skip'), decision_seconds=record['decision_seconds'])
+
+    try:
+        append_history(os.path.join(os.path.dirname(os.path.abspath(args.datadir)), HISTORY_FILE), record)
+    except Exception as e:
+        logger.warning('Failed to record backup decision: %r', e)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import requests
+import urllib3
+
+from spilo_commons import get_patroni_api_url, get_patroni_config
+
+logger = logging.getLogger(__name__)
+
+# the lock is kept in the dynamic configuration and is changed through the REST API of the local Patroni,
+# only when it is taken and released, because cron jobs don't have the environment to talk to DCS directly
+LOCK_KEY = 'spilo_backup_lock'
+
+# members wait for GRACE_SECONDS * their rank before trying to take the lock
+GRACE_SECONDS = int(os.environ.get('BACKUP_SCHEDULER_GRACE', 60))
+# PATCH /config merges the lock with concurrent changes, it must stay ours for SETTLE_SECONDS after it was taken
+SETTLE_SECONDS = 5
+# a finished backup satisfies all members triggered by the same schedule, but not the next run of the schedule
+WINDOW_SECONDS = 3600
+
+# penalize the primary, it is usually busier than replicas
+LEADER_PENALTY = 2
+BGMON_PORT = 8080
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Elects the least loaded healthy member to take the base backup')
+    parser.add_argument('action', choices=('acquire', 'release'))
+    parser.add_argument('--pid', type=int, default=os.getppid(),
+                        help='the process running the backup, used with "acquire"')
+    parser.add_argument('--success', action='store_true', help='the backup has succeeded, used with "release"')
+    return parser.parse_args()
+
+
+def parse_cron_field(field, first, last):
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            start, end = first, last
+        else:
+            start, _, end = part.partition('-')
+            start = int(start)
+            end = int(end) if end else (last if step else start)
+        values.update(range(start, end + 1, int(step or 1)))
+    return values
+
+
+def get_schedule_interval(schedule, now=None):
+    """Returns the shortest interval in seconds between runs of the cron schedule during the next week"""
+    minutes, hours, days, months, weekdays = schedule.split()[:5]
+    minutes, hours = parse_cron_field(minutes, 0, 59), parse_cron_field(hours, 0, 23)
+    days, months = parse_cron_field(days, 1, 31), parse_cron_field(months, 1, 12)
+    weekdays = set(d % 7 for d in parse_cron_field(weekdays, 0, 7))
+    # cron runs the job if either the day of month or the day of week matches, when both are restricted
+    any_day = '*' in (schedule.split()[2][:1], schedule.split()[4][:1])
+
+    start = int((now or time.time()) // 60 * 60)
+    runs = []
+    for t in range(start, start + 8 * 86400, 60):
+        tm = time.localtime(t)
+        day_matches = (tm.tm_mday in days) and ((tm.tm_wday + 1) % 7 in weekdays) if any_day else\
+            (tm.tm_mday in days) or ((tm.tm_wday + 1) % 7 in weekdays)
+        if tm.tm_min in minutes and tm.tm_hour in hours and tm.tm_mon in months and day_matches:
+            runs.append(t)
+    return min((b - a for a, b in zip(runs, runs[1:])), default=None)
+
+
+def get_window(schedule):
+    """The window is shorter than the interval between runs of BACKUP_SCHEDULE, otherwise runs would be skipped"""
+    window = WINDOW_SECONDS
+    try:
+        interval = get_schedule_interval(schedule)
+    except Exception as e:
+        logger.warning('Failed to parse the backup schedule %s: %r', schedule, e)
+        interval = None
+    if interval:
+        window = min(window, interval // 2)
+    return window
+
+
+class BackupScheduler(object):
+
+    def __init__(self):
+        config = get_patroni_config()
+        self.name = config['name']
+        self.api_url = get_patroni_api_url(config)
+        authentication = config.get('restapi', {}).get('authentication', {})
+        self.auth = (authentication['username'], authentication['password']) if authentication else None
+        self.window = get_window(os.environ.get('BACKUP_SCHEDULE', ''))
+
+    def api_get(self, path):
+        r = requests.get(self.api_url + path, timeout=5, verify=False)
+        r.raise_for_status()
+        return r.json()
+
+    def get_lock(self):
+        return self.api_get('/config').get(LOCK_KEY)
+
+    def set_lock(self, value):
+        """Returns False if the dynamic configuration was changed concurrently"""
+        if value:
+            # PATCH merges dictionaries, keys of the previous lock must be removed explicitly
+            value = dict({'pid': None, 'finished': None}, **value)
+        r = requests.patch(self.api_url + '/config', data=json.dumps({LOCK_KEY: value}),
+                           auth=self.auth, timeout=5, verify=False)
+        if r.status_code == 409:
+            logger.info('Dynamic configuration was changed concurrently')
+            return False
+        r.raise_for_status()
+        return True
+
+    @staticmethod
+    def get_system_load(member):
+        """load average and disk latency from bg_mon, if it is reachable"""
+        try:
+            r = requests.get('http://{0}:{1}'.format(member['host'], BGMON_PORT), timeout=2)
+            stats = r.json()
+        except Exception as e:
+            logger.debug('Failed to get bg_mon stats from %s: %r', member['name'], e)
+            return 0, 0
+
+        load_average = stats.get('system_stats', {}).get('load_average') or [0]
+        io = stats.get('disk_stats', {}).get('data', {}).get('device', {}).get('io', {})
+        return load_average[0], io.get('await', 0)
+
+    def rank_members(self):
+        """Returns names of healthy members, the best candidate first, and names of all running members"""
+        candidates = []
+        running = set()
+        for member in self.api_get('/cluster').get('members', []):
+            is_leader = member.get('role') in ('leader', 'standby_leader')
+            if member.get('state') not in ('running', 'streaming') or not member.get('host'):
+                continue
+            running.add(member['name'])
+            lag = 0 if is_leader else member.get('lag')
+            if not isinstance(lag, int):
+                continue
+            load, disk_await = self.get_system_load(member)
+            score = lag / 16777216.0 + load + disk_await / 10.0 + (LEADER_PENALTY if is_leader else 0)
+            logger.info('%s: lag=%s load=%s await=%s score=%.2f', member['name'], lag, load, disk_await, score)
+            candidates.append((score, member['name']))
+        return [name for _, name in sorted(candidates)], running
+
+    @staticmethod
+    def is_backup_running(pid):
+        try:
+            with open('/proc/{0}/cmdline'.format(pid), 'rb') as f:
+                return b'postgres_backup' in f.read()
+        except (IOError, TypeError):
+            return False
+
+    def lock_is_free(self, lock, now, running):
+        if not isinstance(lock, dict):
+            return True
+        if lock.get('finished'):
+            if now - lock['finished'] < self.window:
+                logger.info('Backup was already taken by %s', lock.get('member'))
+                return False
+        elif lock.get('member') not in running:
+            logger.info('Backup lock is held by %s, which is not running', lock.get('member'))
+        elif lock.get('member') != self.name or self.is_backup_running(lock.get('pid')):
+            logger.info('Backup is being taken by %s', lock.get('member'))
+            return False
+        else:
+            logger.info('Backup lock is held by the previous run on %s, which has died', self.name)
+        return True
+
+    def acquire(self, pid):
+        ranking, running = self.rank_members()
+        lock = self.get_lock()
+        # the member holding the lock of a killed run frees it before other members look at it
+        if isinstance(lock, dict) and lock.get('member') == self.name and not lock.get('finished')\
+                and self.lock_is_free(lock, time.time(), running):
+            self.set_lock(None)
+
+        if self.name not in ranking:
+            logger.info('%s is not healthy enough to take the backup', self.name)
+            return False
+
+        rank = ranking.index(self.name)
+        if rank:
+            logger.info('%s is ranked %d, waiting %d seconds for better candidates',
+                        self.name, rank, rank * GRACE_SECONDS)
+            time.sleep(rank * GRACE_SECONDS)
+
+        if not self.lock_is_free(self.get_lock(), time.time(), running):
+            return False
+
+        if not self.set_lock({'member': self.name, 'started': int(time.time()), 'pid': pid}):
+            return False
+        time.sleep(SETTLE_SECONDS)
+        lock = self.get_lock()
+        if not isinstance(lock, dict) or lock.get('member') != self.name or lock.get('pid') != pid:
+            logger.info('Backup lock was taken by %s', lock and lock.get('member'))
+            return False
+        logger.info('Acquired backup lock')
+        return True
+
+    def release(self, success):
+        lock = self.get_lock()
+        if not isinstance(lock, dict) or lock.get('member') != self.name or lock.get('finished'):
+            logger.warning('Backup lock is not held by %s', self.name)
+            return False
+        # keep the record of the successful backup, so that other members don't take another one
+        if not self.set_lock(dict(lock, finished=int(time.time())) if success else None):
+            return False
+        logger.info('Released backup lock')
+        return True
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    urllib3.disable_warnings()
+    args = read_configuration()
+    try:
+        scheduler = BackupScheduler()
+        ret = scheduler.acquire(args.pid) if args.action == 'acquire' else scheduler.release(args.success)
+    except Exception:
+        # unlike "not elected" (1), a failure must not be mistaken for another member taking the backup
+        logger.exception('Failed to %s backup lock', args.action)
+        return 2
+    return 0 if ret else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,11 @@
 #!/bin/bash
 
 RETRIES=2
+RESUME=true
+CHECKPOINT=fast
+COMPRESS=none
+MAX_RATE=
+THROTTLE_LAG=0
 
 while getopts ":-:" optchar; do
     [[ "${optchar}" == "-" ]] || continue
@@ -14,10 +19,28 @@ while getopts ":-:" optchar; do
         retries=* )
             RETRIES=${OPTARG#*=}
             ;;
+        resume=* )
+            RESUME=${OPTARG#*=}
+            ;;
+        checkpoint=* )
+            CHECKPOINT=${OPTARG#*=}
+            ;;
+        compress=* )
+            COMPRESS=${OPTARG#*=}
+            ;;
+        max_rate=* )
+            MAX_RATE=${OPTARG#*=}
+            ;;
+        throttle_lag=* )
+            THROTTLE_LAG=${OPTARG#*=}
+            ;;
     esac
 done
 
-[[ -z $DATA_DIR || -z "$CONNSTR" || ! $RETRIES =~ ^[1-9]$ ]] && exit 1
+[[ -z $DATA_DIR || -z "$CONNSTR" || ! $RETRIES =~ ^[1-9]$ || ! $THROTTLE_LAG =~ ^[0-9]+$ ]] && exit 1
+
+PG_BASEBACKUP_VERSION=$(pg_basebackup --version | sed -n 's/^[^0-9]*\([0-9]*\).*$/\1/p')
+readonly PG_BASEBACKUP_VERSION
 
 if which pg_receivewal &> /dev/null; then
     PG_RECEIVEWAL=pg_receivewal
@@ -27,13 +50,37 @@ else
     PG_BASEBACKUP_OPTS=()
 fi
 
+PG_BASEBACKUP_OPTS+=(--checkpoint="$CHECKPOINT")
+[[ -n $MAX_RATE ]] && PG_BASEBACKUP_OPTS+=(--max-rate="$MAX_RATE")
+# compress on the primary side to save the network bandwidth, the client decompresses it while writing files
+if [[ $COMPRESS != none && $PG_BASEBACKUP_VERSION -ge 15 ]]; then
+    PG_BASEBACKUP_OPTS+=(--compress="server-$COMPRESS")
+fi
+
+# pg_basebackup progress and throughput in JSON format
+PROGRESS_FILE=$(dirname "$DATA_DIR")/basebackup_progress.json
+readonly PROGRESS_FILE
+
 WAL_FAST=$(dirname "$DATA_DIR")/wal_fast
 readonly WAL_FAST
 mkdir -p "$WAL_FAST"
 
-rm -fr "$DATA_DIR" "${WAL_FAST:?}"/*
+# the partially transferred copy and the incremental backup taken on top of it
+readonly RESUME_DIR=${DATA_DIR}_resume
+readonly INCREMENTAL_DIR=${DATA_DIR}_incremental
+
+rm -fr "$DATA_DIR" "$RESUME_DIR" "$INCREMENTAL_DIR" "${WAL_FAST:?}"/*
+
+# Resuming relies on incremental backups and WAL summaries, both are available starting from PostgreSQL 17
+if [[ "$RESUME" == "true" && $PG_BASEBACKUP_VERSION -ge 17 \
+        && $(psql -d "$CONNSTR replication=1" -XtAc 'SHOW summarize_wal' 2> /dev/null) == "on" ]]; then
+    PG_BASEBACKUP_OPTS+=(--no-clean)
+else
+    RESUME=false
+fi
 
 function sigterm_handler() {
+    pkill -SIGTERM -P "$basebackup_pid"
     kill -SIGTERM "$receivewal_pid" "$basebackup_pid"
     exit 143
 }
@@ -95,17 +142,65 @@ else
     receivewal_pid=$(cat "$WAL_FAST/receivewal.pid")
 fi
 
+function run_pg_basebackup() {
+    python3 /scripts/basebackup_monitor.py --status-file="$PROGRESS_FILE" --throttle-lag="$THROTTLE_LAG" \
+        -- pg_basebackup --progress "$@" "${PG_BASEBACKUP_OPTS[@]}" --dbname="${CONNSTR}"
+}
+
+function resume_basebackup() {
+    local start_time=$SECONDS
+
+    rm -fr "$INCREMENTAL_DIR"
+    run_pg_basebackup --pgdata="$INCREMENTAL_DIR" --incremental="$RESUME_DIR/backup_manifest" || return
+
+    echo "incremental backup of $(du -sb "$INCREMENTAL_DIR" | cut -f1) bytes took $((SECONDS-start_time)) seconds"
+
+    # pg_control is transferred the last, pg_combinebackup only needs it to compare system identifiers
+    if [[ ! -f $RESUME_DIR/global/pg_control ]]; then
+        mkdir -p "$RESUME_DIR/global"
+        cp "$INCREMENTAL_DIR/global/pg_control" "$RESUME_DIR/global/pg_control" || return
+    fi
+
+    pg_combinebackup --output="$DATA_DIR" "$RESUME_DIR" "$INCREMENTAL_DIR" || return
+    rm -fr "$RESUME_DIR" "$INCREMENTAL_DIR"
+}
+
+# keep the partially transferred copy and make it usable as a base for the incremental backup
+function prepare_resume() {
+    [[ "$RESUME" == "true" ]] || return 1
+
+    if [[ -d $RESUME_DIR ]]; then
+        rm -fr "$DATA_DIR" "$INCREMENTAL_DIR"
+        return
+    fi
+
+    [[ -f $DATA_DIR/backup_label ]] && python3 /scripts/partial_backup_manifest.py \
+        --datadir="$DATA_DIR" --connstring="$CONNSTR" && mv "$DATA_DIR" "$RESUME_DIR"
+}
+
 ATTEMPT=0
+START_TIME=$SECONDS
 while [[ $((ATTEMPT++)) -le $RETRIES ]]; do
-    pg_basebackup --pgdata="${DATA_DIR}" "${PG_BASEBACKUP_OPTS[@]}" --dbname="${CONNSTR}" &
+    if [[ -d $RESUME_DIR ]]; then
+        resume_basebackup &
+    else
+        run_pg_basebackup --pgdata="${DATA_DIR}" &
+    fi
     basebackup_pid=$!
     wait $basebackup_pid
     EXITCODE=$?
     if [[ $EXITCODE == 0 ]]; then
+        SIZE=$(du -sb "$DATA_DIR" | cut -f1)
+        DURATION=$((SECONDS-START_TIME))
+        echo "transferred $SIZE bytes in $DURATION seconds ($((SIZE/1048576/(DURATION > 0 ? DURATION : 1))) MB/s)"
+        python3 /scripts/replica_planner.py record --datadir="$DATA_DIR" --method=basebackup \
+            --bytes="$SIZE" --seconds="$DURATION"
         break
     elif [[ $ATTEMPT -le $RETRIES ]]; then
         sleep $((ATTEMPT*10))
-        rm -fr "${DATA_DIR}"
+        if ! prepare_resume; then
+            rm -fr "${DATA_DIR}" "$RESUME_DIR" "$INCREMENTAL_DIR"
+        fi
     fi
 done
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+import urllib3
+
+from spilo_commons import get_patroni_api_url, get_patroni_config
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_RE = re.compile(r'(\d+)/(\d+) kB \((\d+)%\)')
+
+# how often to check the replication lag and print the progress
+LAG_CHECK_INTERVAL = 5
+REPORT_INTERVAL = 30
+
+# the throttling is implemented by pausing pg_basebackup for the given fraction of every second,
+# the walsender on the primary stops reading files as soon as the socket buffers are full.
+MAX_PAUSE_FRACTION = 0.9
+PAUSE_STEP = 0.1
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Runs pg_basebackup, reports its progress and throttles it '
+                                                 'when other replicas are lagging')
+    parser.add_argument('--status-file', required=True, help='file to keep the current progress in JSON format')
+    parser.add_argument('--throttle-lag', type=int, default=0,
+                        help='slow down the transfer when replication lag on other members exceeds this '
+                             'amount of megabytes, 0 disables throttling')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='pg_basebackup command line')
+    args = parser.parse_args()
+    if args.command[:1] == ['--']:
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error('pg_basebackup command line is required')
+    return args
+
+
+class BasebackupMonitor(object):
+
+    def __init__(self, command, status_file, throttle_lag):
+        self.command = command
+        self.status_file = status_file
+        self.throttle_lag = throttle_lag * 1024 * 1024
+        self.process = None
+        self.pause_fraction = 0.0
+        self.max_lag = None
+        self.start_time = time.time()
+        self.status = {'state': 'starting', 'done_kb': 0, 'total_kb': None, 'percent': 0}
+        self.last_report = 0
+        self.api_url = self.member_name = None
+
+    def get_max_lag(self):
+        if self.api_url is None:
+            config = get_patroni_config()
+            self.api_url = get_patroni_api_url(config)
+            self.member_name = config.get('name')
+
+        r = requests.get(self.api_url + '/cluster', timeout=2, verify=False)
+        lags = [m['lag'] for m in r.json().get('members', [])
+                if m.get('name') != self.member_name and isinstance(m.get('lag'), int)]
+        return max(lags) if lags else 0
+
+    def adjust_throttling(self):
+        try:
+            self.max_lag = self.get_max_lag()
+        except Exception as e:
+            logger.debug('Failed to get replication lag: %r', e)
+            return
+
+        if self.max_lag > self.throttle_lag:
+            pause_fraction = min(self.pause_fraction + PAUSE_STEP, MAX_PAUSE_FRACTION)
+        elif self.max_lag < self.throttle_lag / 2:
+            pause_fraction = max(self.pause_fraction - PAUSE_STEP, 0.0)
+        else:
+            return
+
+        if pause_fraction != self.pause_fraction:
+            logger.info('Replication lag is %s bytes, pausing pg_basebackup for %d%% of time',
+                        self.max_lag, pause_fraction * 100)
+            self.pause_fraction = pause_fraction
+
+    def write_status(self):
+        elapsed = time.time() - self.start_time
+        done = self.status['done_kb'] * 1024
+        self.status.update(elapsed=round(elapsed, 1), bytes_per_second=int(done / elapsed) if elapsed > 0 else 0,
+                           pause_fraction=round(self.pause_fraction, 1), max_lag=self.max_lag)
+        if self.status['total_kb'] and self.status['bytes_per_second'] and self.status['state'] == 'running':
+            remaining = self.status['total_kb'] * 1024 - done
+            self.status['eta_seconds'] = max(int(remaining / self.status['bytes_per_second']), 0)
+        else:
+            self.status.pop('eta_seconds', None)
+
+        tmp_file = self.status_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.status, f)
+            os.rename(tmp_file, self.status_file)
+        except Exception as e:
+            logger.warning('Failed to write %s: %r', self.status_file, e)
+
+        if self.status['state'] != 'running' or time.time() - self.last_report >= REPORT_INTERVAL:
+            self.last_report = time.time()
+            print(json.dumps(self.status), flush=True)
+
+    def read_stderr(self):
+        for line in self.process.stderr:
+            line = line.decode('utf-8', 'replace').rstrip()
+            match = PROGRESS_RE.search(line)
+            if match:
+                self.status.update(state='running', done_kb=int(match.group(1)),
+                                   total_kb=int(match.group(2)), percent=int(match.group(3)))
+                self.write_status()
+            elif line:
+                sys.stderr.write(line + '\n')
+
+    def signal_process(self, signum):
+        try:
+            self.process.send_signal(signum)
+        except OSError:
+            pass
+
+    def sigterm_handler(self, signum, frame):
+        self.signal_process(signal.SIGCONT)
+        self.signal_process(signal.SIGTERM)
+
+    def run(self):
+        self.process = subprocess.Popen(self.command, stderr=subprocess.PIPE)
+        signal.signal(signal.SIGTERM, self.sigterm_handler)
+        signal.signal(signal.SIGINT, self.sigterm_handler)
+
+        reader = threading.Thread(target=self.read_stderr)
+        reader.daemon = True
+        reader.start()
+
+        next_check = 0
+        while self.process.poll() is None:
+            if self.throttle_lag and time.time() >= next_check:
+                next_check = time.time() + LAG_CHECK_INTERVAL
+                self.adjust_throttling()
+
+            if self.pause_fraction:
+                self.signal_process(signal.SIGSTOP)
+                time.sleep(self.pause_fraction)
+                self.signal_process(signal.SIGCONT)
+                time.sleep(1 - self.pause_fraction)
+            else:
+                time.sleep(1)
+
+        reader.join(5)
+        self.status['state'] = 'finished' if self.process.returncode == 0 else 'failed'
+        self.write_status()
+        return self.process.returncode if self.process.returncode >= 0 else 128 - self.process.returncode
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    urllib3.disable_warnings()
+    args = read_configuration()
+    return BasebackupMonitor(args.command, args.status_file, args.throttle_lag).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,56 +1,107 @@
 #!/usr/bin/env python
 
-import boto.ec2
-import boto.utils
+import json
 import logging
 import os
 import sys
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+from spilo_metrics import instrument
+
 logger = logging.getLogger(__name__)
 LEADER_TAG_VALUE = os.environ.get('AWS_LEADER_TAG_VALUE', 'master')
 
+IMDS_URL = 'http://169.254.169.254/latest/'
+# instance and volume topology is cached across callbacks, volumes could be attached or detached though
+TOPOLOGY_CACHE = '/run/postgresql/callback_aws.json'
+TOPOLOGY_CACHE_TTL = 3600
 
-def retry(func):
-    def wrapped(*args, **kwargs):
-        count = 0
-        while True:
-            try:
-                return func(*args, **kwargs)
-            except boto.exception.BotoServerError as e:
-                if count >= 10 or str(e.error_code) not in ('Throttling', 'RequestLimitExceeded'):
-                    raise
-                logger.info('Throttling AWS API requests...')
-                time.sleep(2 ** count * 0.5)
-                count += 1
 
-    return wrapped
+def imds_request(path, timeout=2):
+    """IMDSv2 with the fallback to IMDSv1"""
+    headers = {}
+    try:
+        token_request = Request(IMDS_URL + 'api/token', method='PUT',
+                                headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        with urlopen(token_request, timeout=timeout) as r:
+            headers['X-aws-ec2-metadata-token'] = r.read().decode('utf-8')
+    except Exception as e:
+        logger.debug('Failed to get IMDSv2 token: %r', e)
+    with urlopen(Request(IMDS_URL + path, headers=headers), timeout=timeout) as r:
+        return r.read().decode('utf-8')
 
 
 def get_instance_metadata():
-    return boto.utils.get_instance_identity()['document']
+    return json.loads(imds_request('dynamic/instance-identity/document'))
+
+
+def get_ec2_client(region):
+    import boto3
+    from botocore.config import Config
 
+    # throttling and transient errors are retried by botocore with the client-side rate limiting
+    return boto3.client('ec2', region_name=region,
+                        config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=10))
 
-@retry
-def associate_address(ec2, allocation_id, instance_id):
-    return ec2.associate_address(instance_id=instance_id, allocation_id=allocation_id, allow_reassociation=True)
 
+def read_topology():
+    try:
+        with open(TOPOLOGY_CACHE) as f:
+            topology = json.load(f)
+        if topology.get('timestamp', 0) + TOPOLOGY_CACHE_TTL > time.time():
+            return topology
+    except (IOError, ValueError):
+        pass
 
-@retry
-def tag_resource(ec2, resource_id, tags):
-    return ec2.create_tags([resource_id], tags)
 
+def write_topology(topology):
+    try:
+        tmp_file = TOPOLOGY_CACHE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(topology, f)
+        os.rename(tmp_file, TOPOLOGY_CACHE)
+    except Exception as e:
+        logger.warning('Failed to write %s: %r', TOPOLOGY_CACHE, e)
 
-@retry
-def list_volumes(ec2, instance_id):
-    return ec2.get_all_volumes(filters={'attachment.instance-id': instance_id})
 
+def describe_topology(ec2, instance_id):
+    """Returns the root device name and attached volumes with their devices"""
+    instance = ec2.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]
+    volumes = []
+    paginator = ec2.get_paginator('describe_volumes')
+    for page in paginator.paginate(Filters=[{'Name': 'attachment.instance-id', 'Values': [instance_id]}]):
+        for v in page['Volumes']:
+            device = next((a['Device'] for a in v.get('Attachments', []) if a['InstanceId'] == instance_id), None)
+            volumes.append({'id': v['VolumeId'], 'device': device,
+                            'named': any(t['Key'] == 'Name' for t in v.get('Tags', []))})
+    return {'root_device_name': instance.get('RootDeviceName'), 'volumes': volumes}
+
+
+def tag_batches(instance_id, topology, role, cluster):
+    """Groups resources which get the same tags, every group is tagged by one CreateTags call"""
+    tags = {'Role': LEADER_TAG_VALUE if role == 'primary' else role}
+    batches = [([instance_id], tags)]
 
-@retry
-def get_instance(ec2, instance_id):
-    return ec2.get_only_instances([instance_id])[0]
+    tags = dict(tags, Instance=instance_id)
+    named = [v['id'] for v in topology['volumes'] if v['named']]
+    if named:
+        batches.append((named, tags))
+    for volume_device in ('root', 'data'):
+        ids = [v['id'] for v in topology['volumes'] if not v['named']
+               and (v['device'] == topology['root_device_name']) == (volume_device == 'root')]
+        if ids:
+            batches.append((ids, dict(tags, Name='spilo_{}_{}'.format(cluster, volume_device))))
+    return batches
 
 
+def create_tags(ec2, resource_ids, tags):
+    ec2.create_tags(Resources=resource_ids, Tags=[{'Key': k, 'Value': v} for k, v in tags.items()])
+
+
+@instrument('callback_aws')
 def main():
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
 
@@ -60,35 +111,40 @@ def main():
         sys.exit("Usage: {0} [eip_allocation_id] action role name".format(sys.argv[0]))
 
     action, role, cluster = sys.argv[argc - 3:argc]
+    start = time.time()
 
-    metadata = get_instance_metadata()
-
-    instance_id = metadata['instanceId']
+    topology = read_topology()
+    if not topology:
+        metadata = get_instance_metadata()
+        topology = {'instance_id': metadata['instanceId'], 'region': metadata['region']}
+    instance_id = topology['instance_id']
 
-    ec2 = boto.ec2.connect_to_region(metadata['region'])
+    ec2 = get_ec2_client(topology['region'])
 
+    # the EIP restores connectivity of clients, therefore it goes first
     if argc == 5 and role in ('primary', 'standby_leader') and action in ('on_start', 'on_role_change'):
-        associate_address(ec2, sys.argv[1], instance_id)
-
-    instance = get_instance(ec2, instance_id)
-
-    tags = {'Role': LEADER_TAG_VALUE if role == 'primary' else role}
-    tag_resource(ec2, instance_id, tags)
-
-    tags.update({'Instance': instance_id})
-
-    volumes = list_volumes(ec2, instance_id)
-    for v in volumes:
-        if 'Name' in v.tags:
-            tags_to_update = tags
-        else:
-            if v.attach_data.device == instance.root_device_name:
-                volume_device = 'root'
-            else:
-                volume_device = 'data'
-            tags_to_update = dict(tags, Name='spilo_{}_{}'.format(cluster, volume_device))
-
-        tag_resource(ec2, v.id, tags_to_update)
+        ec2.associate_address(InstanceId=instance_id, AllocationId=sys.argv[1], AllowReassociation=True)
+        logger.info('Associated %s with %s in %.3f seconds', sys.argv[1], instance_id, time.time() - start)
+
+    if 'volumes' not in topology:
+        topology.update(describe_topology(ec2, instance_id), timestamp=time.time())
+
+    batches = tag_batches(instance_id, topology, role, cluster)
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        futures = [executor.submit(create_tags, ec2, ids, tags) for ids, tags in batches]
+        errors = [f.exception() for f in futures if f.exception()]
+
+    if errors:
+        # volumes might have been detached, the topology must be refreshed
+        topology.pop('volumes', None)
+        write_topology(topology)
+        raise errors[0]
+
+    for volume in topology['volumes']:
+        volume['named'] = True
+    write_topology(topology)
+    logger.info('Tagged %s resources with %s CreateTags calls, the callback took %.3f seconds',
+                sum(len(ids) for ids, _ in batches), len(batches), time.time() - start)
 
 
 if __name__ == '__main__':
@@ -2,13 +2,14 @@
 
 import json
 import logging
-import requests
-import requests.exceptions
 import os
 import socket
 import sys
+import threading
 import time
 
+from spilo_metrics import instrument
+
 KUBE_SERVICE_DIR = '/var/run/secrets/kubernetes.io/serviceaccount/'
 KUBE_NAMESPACE_FILENAME = KUBE_SERVICE_DIR + 'namespace'
 KUBE_TOKEN_FILENAME = KUBE_SERVICE_DIR + 'token'
@@ -16,12 +17,21 @@ KUBE_CA_CERT = KUBE_SERVICE_DIR + 'ca.crt'
 
 KUBE_API_URL = 'https://kubernetes.default.svc.cluster.local/api/v1/namespaces'
 
+# the resident service started by runit, callbacks are executed in-process if it isn't running
+SOCKET_PATH = '/run/postgresql/.callback_role.sock'
+CLIENT_TIMEOUT = 300
+MAX_RETRY_DELAY = 8
+
 logger = logging.getLogger(__name__)
 
 LABEL = os.environ.get("KUBERNETES_ROLE_LABEL", 'spilo-role')
 LEADER_LABEL_VALUE = os.environ.get("KUBERNETES_LEADER_LABEL_VALUE", 'master')
 
 
+class Superseded(Exception):
+    pass
+
+
 def read_first_line(filename):
     try:
         with open(filename) as f:
@@ -30,66 +40,259 @@ def read_first_line(filename):
         return None
 
 
-def read_token():
-    return read_first_line(KUBE_TOKEN_FILENAME)
+class KubernetesApi(object):
+    """Keeps the pool of authenticated connections to the API, the token is reread only when it was rotated"""
+
+    def __init__(self):
+        import requests
 
+        self._session = requests.Session()
+        self._session.verify = KUBE_CA_CERT
+        self._session.headers['Content-Type'] = 'application/strategic-merge-patch+json'
+        self._token_mtime = None
+        self.namespace = os.environ.get('POD_NAMESPACE', read_first_line(KUBE_NAMESPACE_FILENAME)) or 'default'
+        self._ip = None
 
-def api_patch(namespace, kind, name, entity_name, body):
-    api_url = '/'.join([KUBE_API_URL, namespace, kind, name])
-    count = 0
-    while True:
+    def read_token(self):
         try:
-            token = read_token()
+            mtime = os.stat(KUBE_TOKEN_FILENAME).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is None or mtime != self._token_mtime:
+            token = read_first_line(KUBE_TOKEN_FILENAME)
             if token:
-                r = requests.patch(api_url, data=body, verify=KUBE_CA_CERT,
-                                   headers={'Content-Type': 'application/strategic-merge-patch+json',
-                                            'Authorization': 'Bearer {0}'.format(token)})
-                if r.status_code in range(200, 206):
-                    break
-                logger.warning('Unable to change %s: %s', entity_name, r.text)
-                if not (r.status_code in (500, 503, 504) or 'retry-after' in r.headers):
-                    break
+                self._session.headers['Authorization'] = 'Bearer {0}'.format(token)
+                self._token_mtime = mtime
             else:
-                logger.warning('Unable to read Kubernetes authorization token')
-        except requests.exceptions.RequestException as e:
-            logger.warning('Exception when executing PATCH on %s: %s', api_url, e)
-        if count >= 10:
-            raise Exception('PATCH {0} failed'.format(api_url))
-        time.sleep(2 ** count * 0.5)
-        count += 1
+                self._session.headers.pop('Authorization', None)
+                self._token_mtime = None
+        return 'Authorization' in self._session.headers
+
+    @property
+    def ip(self):
+        if not self._ip:
+            self._ip = os.environ.get('POD_IP') or\
+                socket.getaddrinfo(socket.gethostname(), 0, socket.AF_UNSPEC, socket.SOCK_STREAM, 0)[0][4][0]
+        return self._ip
+
+    def patch(self, kind, name, entity_name, body, is_current, cancel):
+        """Applies the strategic merge patch conditionally on the resourceVersion of the object, so that
+           concurrent modifications are never overwritten with a stale state. Retries stop as soon as
+           the cancel event is set, i.e. when a newer role change is pending."""
+        import requests.exceptions
+
+        api_url = '/'.join([KUBE_API_URL, self.namespace, kind, name])
+        count = 0
+        while True:
+            if cancel.is_set():
+                raise Superseded()
+            delay = True
+            try:
+                if self.read_token():
+                    r = self._session.get(api_url)
+                    if r.status_code == 200:
+                        obj = r.json()
+                        if is_current(obj):
+                            break
+                        body['metadata'] = dict(body.get('metadata', {}),
+                                                resourceVersion=obj['metadata']['resourceVersion'])
+                        r = self._session.patch(api_url, data=json.dumps(body))
+                        if r.status_code in range(200, 206):
+                            break
+                    if r.status_code == 409:  # the object was changed concurrently, check it again immediately
+                        delay = False
+                    else:
+                        logger.warning('Unable to change %s: %s', entity_name, r.text)
+                        if r.status_code == 401:
+                            self._token_mtime = None  # force rereading of the token
+                        elif not (r.status_code in (500, 503, 504) or 'retry-after' in r.headers):
+                            break
+                else:
+                    logger.warning('Unable to read Kubernetes authorization token')
+            except requests.exceptions.RequestException as e:
+                logger.warning('Exception when executing PATCH on %s: %s', api_url, e)
+            if count >= 10:
+                raise Exception('PATCH {0} failed'.format(api_url))
+            if delay:
+                cancel.wait(min(2 ** count * 0.5, MAX_RETRY_DELAY))
+            count += 1
+
+    def warm_up(self):
+        """Establishes the TLS connection in advance, so that the first role change doesn't wait for it"""
+        try:
+            if self.read_token():
+                self._session.get('/'.join([KUBE_API_URL, self.namespace, 'pods', os.environ['HOSTNAME']]),
+                                  timeout=5)
+        except Exception as e:
+            logger.warning('Failed to connect to the Kubernetes API: %r', e)
+
+    def change_pod_role_label(self, new_role, cancel):
+        body = {'metadata': {'labels': {LABEL: new_role}}}
+
+        def is_current(pod):
+            return (pod['metadata'].get('labels') or {}).get(LABEL) == new_role
+
+        self.patch('pods', os.environ['HOSTNAME'], '{} label'.format(LABEL), body, is_current, cancel)
+
+    def change_endpoints(self, cluster, cancel):
+        ports = [{'name': 'postgresql', 'port': 5432, 'protocol': 'TCP'}]
+        body = {'subsets': [{'addresses': [{'ip': self.ip}], 'ports': ports}]}
+
+        def is_current(endpoints):
+            subsets = endpoints.get('subsets') or []
+            return len(subsets) == 1 and [a.get('ip') for a in subsets[0].get('addresses') or []] == [self.ip]\
+                and [(p.get('name'), p.get('port')) for p in subsets[0].get('ports') or []] == [('postgresql', 5432)]
+
+        try:
+            self.patch('endpoints', cluster, 'service endpoints', body, is_current, cancel)
+        except Superseded:
+            raise
+        except Exception:
+            pass
+
+    def record_role_change(self, action, new_role, cluster, cancel=None):
+        """Updates the endpoints (if the pod became the leader) and the role label concurrently.
+           Raises Superseded if the cancel event was set before both were applied."""
+        from concurrent.futures import ThreadPoolExecutor
 
+        cancel = cancel or threading.Event()
+        start = time.time()
+        new_role = None if action == 'on_stop' else new_role
+        logger.debug("Changing the pod's role to %s", new_role)
 
-def change_pod_role_label(namespace, new_role):
-    body = json.dumps({'metadata': {'labels': {LABEL: new_role}}})
-    api_patch(namespace, 'pods', os.environ['HOSTNAME'], '{} label'.format(LABEL), body)
+        durations = {}
 
+        def timed(name, func, *args):
+            func_start = time.time()
+            try:
+                return func(*args)
+            finally:
+                durations[name] = time.time() - func_start
 
-def change_endpoints(namespace, cluster):
-    ip = socket.getaddrinfo(socket.gethostname(), 0, socket.AF_UNSPEC, socket.SOCK_STREAM, 0)[0][4][0]
-    ip = os.environ.get('POD_IP', ip)
-    body = json.dumps({'subsets': [{'addresses': [{'ip': ip}],
-                                    'ports': [{'name': 'postgresql', 'port': 5432, 'protocol': 'TCP'}]}]})
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = []
+            if new_role == LEADER_LABEL_VALUE:
+                futures.append(executor.submit(timed, 'endpoints', self.change_endpoints, cluster, cancel))
+            futures.append(executor.submit(timed, 'label', self.change_pod_role_label, new_role, cancel))
+            for future in futures:
+                future.result()
+
+        logger.info('%s to the role %s took %.3f seconds (%s)', action, new_role, time.time() - start,
+                    ', '.join('{0}: {1:.3f}'.format(k, v) for k, v in sorted(durations.items())))
+
+
+class RoleChangeQueue(object):
+    """Collapses pending role changes of the pod, only the newest desired state is applied.
+
+    Callbacks are numbered in the order of arrival. A new callback cancels the one being applied,
+    callers of superseded callbacks get the result of the newest one."""
+
+    def __init__(self, api):
+        self._api = api
+        self._condition = threading.Condition()
+        self._desired = None  # (seq, action, role, cluster, cancel event)
+        self._seq = self._applied = 0
+        self._error = None
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, action, role, cluster):
+        """Returns None if the role change (or a newer one) was applied, or the error"""
+        with self._condition:
+            self._seq += 1
+            seq = self._seq
+            if self._desired:
+                self._desired[4].set()
+                logger.info('Collapsing pending %s to the role %s', self._desired[1], self._desired[2])
+            self._desired = (seq, action, role, cluster, threading.Event())
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._applied >= seq)
+            return self._error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._desired and self._desired[0] > self._applied)
+                seq, action, role, cluster, cancel = self._desired
+            try:
+                self._api.record_role_change(action, role, cluster, cancel)
+                error = None
+            except Superseded:
+                continue
+            except Exception as e:
+                logger.exception('Failed to execute callback')
+                error = repr(e)
+            with self._condition:
+                self._applied, self._error = seq, error
+                self._condition.notify_all()
+
+
+def serve(socket_path=SOCKET_PATH):
+    """Accepts callbacks from clients over the Unix socket and applies them via the RoleChangeQueue"""
+    import socketserver
+
+    api = KubernetesApi()
+    api.warm_up()
+    queue = RoleChangeQueue(api)
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                error = queue.submit(request['action'], request['role'], request['cluster'])
+            except Exception as e:
+                error = repr(e)
+            response = {'ok': True} if error is None else {'ok': False, 'error': error}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    os.chmod(socket_path, 0o600)
+    logger.info('Listening on %s', socket_path)
+    server.serve_forever()
+
+
+def send_to_service(action, new_role, cluster, socket_path=SOCKET_PATH):
+    """Returns the result of the callback executed by the service or None if the service isn't available"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        api_patch(namespace, 'endpoints', cluster, 'service endpoints', body)
-    except Exception:
-        pass
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+        sock.settimeout(CLIENT_TIMEOUT)
+        sock.sendall(json.dumps({'action': action, 'role': new_role, 'cluster': cluster}).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+    finally:
+        sock.close()
 
 
-def record_role_change(action, new_role, cluster):
-    new_role = None if action == 'on_stop' else new_role
-    logger.debug("Changing the pod's role to %s", new_role)
-    pod_namespace = os.environ.get('POD_NAMESPACE', read_first_line(KUBE_NAMESPACE_FILENAME)) or 'default'
-    if new_role == LEADER_LABEL_VALUE:
-        change_endpoints(pod_namespace, cluster)
-    change_pod_role_label(pod_namespace, new_role)
+@instrument('callback_role')
+def callback(action, new_role, cluster):
+    try:
+        response = send_to_service(action, new_role, cluster, socket_path=SOCKET_PATH)
+    except Exception as e:
+        logger.warning('Callback service failed: %r', e)
+        response = None
+    if response is None:
+        KubernetesApi().record_role_change(action=action, new_role=new_role, cluster=cluster)
+    elif not response.get('ok'):
+        sys.exit('Callback failed: {0}'.format(response.get('error')))
 
 
 def main():
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
-    if len(sys.argv) == 4 and sys.argv[1] in ('on_start', 'on_stop', 'on_role_change', 'on_restart'):
-        record_role_change(action=sys.argv[1], new_role=sys.argv[2], cluster=sys.argv[3])
+    if len(sys.argv) == 2 and sys.argv[1] == '--serve':
+        serve(SOCKET_PATH)
+    elif len(sys.argv) == 4 and sys.argv[1] in ('on_start', 'on_stop', 'on_role_change', 'on_restart'):
+        callback(*sys.argv[1:])
     else:
-        sys.exit('Usage: %s <action> <role> <cluster_name>', sys.argv[0])
+        sys.exit('Usage: {0} <action> <role> <cluster_name> | --serve'.format(sys.argv[0]))
     return 0
 
 
@@ -22,8 +22,8 @@ import yaml
 import pystache
 import requests
 
-from spilo_commons import RW_DIR, PATRONI_CONFIG_FILE, append_extensions, \
-        get_binary_version, get_bin_dir, is_valid_pg_version, write_file, write_patroni_config
+from spilo_commons import RW_DIR, PATRONI_CONFIG_FILE, append_extensions, get_binary_version, get_bin_dir, \
+        get_cpu_count, is_valid_pg_version, write_file, write_patroni_config
 
 
 PROVIDER_AWS = "aws"
@@ -384,6 +384,13 @@ hstore,hypopg,intarray,ltree,pgcrypto,pgq,pgq_node,pg_trgm,postgres_fdw,roaringb
   basebackup_fast_xlog:
     command: /scripts/basebackup.sh
     retries: 2
+    resume: '{{BASEBACKUP_RESUME}}'
+    checkpoint: {{BASEBACKUP_CHECKPOINT}}
+    compress: '{{BASEBACKUP_COMPRESSION}}'
+    throttle_lag: {{BASEBACKUP_THROTTLE_LAG_MEGABYTES}}
+    {{#BASEBACKUP_MAX_RATE}}
+    max_rate: '{{BASEBACKUP_MAX_RATE}}'
+    {{/BASEBACKUP_MAX_RATE}}
 {{#STANDBY_WITH_WALE}}
   bootstrap_standby_with_wale:
     command: envdir "{{STANDBY_WALE_ENV_DIR}}" bash /scripts/wale_restore.sh
@@ -530,6 +537,10 @@ def get_placeholders(provider):
     placeholders.setdefault('APIPORT', '8008')
     placeholders.setdefault('BACKUP_SCHEDULE', '0 1 * * *')
     placeholders.setdefault('BACKUP_NUM_TO_RETAIN', '5')
+    placeholders.setdefault('PREWARM_SCHEDULE', '')
+    placeholders.setdefault('PREWARM_MAX_RATE', '32')
+    placeholders.setdefault('METRICS_PORT', '')
+    placeholders.setdefault('PGBOUNCER_PROCESSES', '')
     placeholders.setdefault('CRONTAB', '[]')
     placeholders.setdefault('PGROOT', os.path.join(placeholders['PGHOME'], 'pgroot'))
     placeholders.setdefault('WALE_TMPDIR', os.path.abspath(os.path.join(placeholders['PGROOT'], '../tmp')))
@@ -557,6 +568,11 @@ def get_placeholders(provider):
     placeholders.setdefault('SSL_RESTAPI_PRIVATE_KEY_FILE', '')
     placeholders.setdefault('WALE_BACKUP_THRESHOLD_MEGABYTES', 102400)
     placeholders.setdefault('WALE_BACKUP_THRESHOLD_PERCENTAGE', 30)
+    placeholders.setdefault('BASEBACKUP_RESUME', 'true')
+    placeholders.setdefault('BASEBACKUP_CHECKPOINT', 'fast')
+    placeholders.setdefault('BASEBACKUP_COMPRESSION', 'lz4')
+    placeholders.setdefault('BASEBACKUP_THROTTLE_LAG_MEGABYTES', 64)
+    placeholders.setdefault('BASEBACKUP_MAX_RATE', '')
     placeholders.setdefault('INITDB_LOCALE', 'en_US')
     placeholders.setdefault('CLONE_TARGET_TIMELINE', 'latest')
     # if Kubernetes is defined as a DCS, derive the namespace from the POD_NAMESPACE, if not set explicitely.
@@ -857,12 +873,14 @@ def write_wale_environment(placeholders, prefix, overwrite):
                   'WALG_PGP_KEY', 'WALG_PGP_KEY_PATH', 'WALG_PGP_KEY_PASSPHRASE',
                   'no_proxy', 'http_proxy', 'https_proxy']
     aws_imds_names = ['AWS_EC2_METADATA_SERVICE_ENDPOINT', 'AWS_EC2_METADATA_SERVICE_ENDPOINT_MODE']
+    backup_names = ['BACKUP_NUM_TO_RETAIN', 'BACKUP_SCHEDULE', 'BACKUP_SCHEDULER', 'BACKUP_SCHEDULER_GRACE',
+                    'BACKUP_POLICY', 'BACKUP_TARGET_RESTORE_TIME']
 
     wale = defaultdict(lambda: '')
     for name in ['PGVERSION', 'PGPORT', 'WALE_ENV_DIR', 'SCOPE', 'WAL_BUCKET_SCOPE_PREFIX', 'WAL_BUCKET_SCOPE_SUFFIX',
-                 'WAL_S3_BUCKET', 'WAL_GCS_BUCKET', 'WAL_GS_BUCKET', 'WAL_SWIFT_BUCKET', 'BACKUP_NUM_TO_RETAIN',
-                 'ENABLE_WAL_PATH_COMPAT'] + s3_names + swift_names + gs_names + walg_names + azure_names + \
-            azure_auth_names + ssh_names:
+                 'WAL_S3_BUCKET', 'WAL_GCS_BUCKET', 'WAL_GS_BUCKET', 'WAL_SWIFT_BUCKET',
+                 'ENABLE_WAL_PATH_COMPAT'] + backup_names + s3_names + swift_names + gs_names + walg_names + \
+            azure_names + azure_auth_names + ssh_names:
         wale[name] = placeholders.get(prefix + name, '')
 
     if wale.get('WAL_S3_BUCKET') or wale.get('WALE_S3_PREFIX') or wale.get('WALG_S3_PREFIX'):
@@ -972,7 +990,7 @@ def write_wale_environment(placeholders, prefix, overwrite):
         os.makedirs(wale['WALE_ENV_DIR'])
 
     wale['WALE_LOG_DESTINATION'] = 'stderr'
-    for name in write_envdir_names + ['WALE_LOG_DESTINATION', 'PGPORT'] + ([] if prefix else ['BACKUP_NUM_TO_RETAIN']):
+    for name in write_envdir_names + ['WALE_LOG_DESTINATION', 'PGPORT'] + ([] if prefix else backup_names):
         if wale.get(name):
             path = os.path.join(wale['WALE_ENV_DIR'], name)
             write_file(wale[name], path, overwrite)
@@ -1030,10 +1048,7 @@ def setup_runit_cron(placeholders):
     link_runit_service(placeholders, 'cron')
 
 
-def write_crontab(placeholders, overwrite):
-    lines = ['PATH={PATH}'.format(**placeholders)]
-    root_lines = []
-
+def setup_renice(placeholders):
     sys_nice_is_set = no_new_privs = None
     with open('/proc/self/status') as f:
         for line in f:
@@ -1044,16 +1059,17 @@ def write_crontab(placeholders, overwrite):
                 sys_nice_is_set = int(line[8:], 16) & sys_nice == sys_nice
 
     if sys_nice_is_set:
-        renice = '*/5 * * * * bash /scripts/renice.sh'
-        if not no_new_privs:
-            lines += [renice]
-        elif os.getuid() == 0:
-            root_lines = [lines[0], renice]
+        if not no_new_privs or os.getuid() == 0:
+            link_runit_service(placeholders, 'renice')
         else:
-            logging.info('Skipping creation of renice cron job due to running as not root '
+            logging.info('Skipping renice service due to running as not root '
                          'and with "no-new-privileges:true" (allowPrivilegeEscalation=false on K8s)')
     else:
-        logging.info('Skipping creation of renice cron job due to lack of SYS_NICE capability')
+        logging.info('Skipping renice service due to lack of SYS_NICE capability')
+
+
+def write_crontab(placeholders, overwrite):
+    lines = ['PATH={PATH}'.format(**placeholders)]
 
     if placeholders.get('SSL_TEST_RELOAD'):
         env = ' '.join('{0}="{1}"'.format(n, placeholders[n]) for n in ('PGDATA', 'SSL_CA_FILE', 'SSL_CRL_FILE',
@@ -1073,17 +1089,18 @@ def write_crontab(placeholders, overwrite):
         lines += [('{0} nice -n 5 envdir "{1}"' +
                    ' /scripts/upload_pg_log_to_s3.py').format(schedule, log_dir)]
 
+    if placeholders.get('PREWARM_SCHEDULE'):
+        lines += [('{PREWARM_SCHEDULE} /scripts/prewarm.py sync --max-rate {PREWARM_MAX_RATE}'
+                   ' > /dev/null 2>&1').format(**placeholders)]
+
     lines += yaml.safe_load(placeholders['CRONTAB'])
 
-    if len(lines) > 1 or root_lines:
+    if len(lines) > 1:
         setup_runit_cron(placeholders)
 
     if len(lines) > 1 and (overwrite or check_crontab('postgres')):
         setup_crontab('postgres', lines)
 
-    if root_lines and (overwrite or check_crontab('root')):
-        setup_crontab('root', root_lines)
-
 
 def write_pam_oauth2_configuration(placeholders, overwrite):
     pam_oauth2_args = placeholders.get('PAM_OAUTH2') or ''
@@ -1101,6 +1118,81 @@ def write_pam_oauth2_configuration(placeholders, overwrite):
     write_file(pam_oauth2_config, '/etc/pam.d/postgresql', overwrite)
 
 
+def read_pgbouncer_sections(pgbouncer_config):
+    """Returns {section: {name: value}}, names of sections and of settings in [pgbouncer] are lowercased"""
+    sections = defaultdict(dict)
+    section = None
+    for line in pgbouncer_config.splitlines():
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1].strip().lower()
+        elif section and '=' in line and not line.startswith((';', '#')):
+            name, value = line.split('=', 1)
+            name = name.strip().lower() if section == 'pgbouncer' else name.strip()
+            sections[section][name] = value.strip()
+    return sections
+
+
+def write_pgbouncer_process_configurations(placeholders, pgbouncer_dir, overwrite):
+    """Every process includes pgbouncer.ini and listens on the same port with so_reuseport.
+       Processes are peers of each other, so that cancel requests could be forwarded to the one
+       having the connection, and have own unix_socket_dir, e.g. to connect to the admin console.
+       Returns False if PGBOUNCER_PROCESSES is invalid."""
+    processes = placeholders['PGBOUNCER_PROCESSES']
+    if processes == 'auto':
+        # a single pgbouncer process is able to serve a few CPUs worth of postgres backends
+        processes = min(max(1, get_cpu_count() // 4), 16)
+    elif processes.isdigit() and int(processes) > 0:
+        processes = int(processes)
+    else:
+        logging.error('PGBOUNCER_PROCESSES must be a positive number or "auto", not %s', processes)
+        return False
+
+    sections = read_pgbouncer_sections(placeholders['PGBOUNCER_CONFIGURATION'])
+    settings = sections['pgbouncer']
+    port = settings.get('listen_port', '6432')
+
+    # a quarter of max_connections is left for replication, monitoring, pg_cron and superusers.
+    # max_db_connections limits connections to a database of all users, hence the rest is split
+    # between databases of all processes, the wildcard is counted as one database.
+    databases = max(1, len(sections['databases']))
+    if '*' in sections['databases']:
+        logging.warning('Pools of databases matched by the wildcard of pgbouncer are sized as one database')
+    max_connections = int(placeholders['postgresql']['parameters']['max_connections'])
+    pool_size = max(1, max_connections * 3 // 4 // processes // databases)
+    pool_settings = {'default_pool_size': pool_size, 'max_db_connections': pool_size}
+    # limits configured explicitly are split between processes
+    for name in ('default_pool_size', 'min_pool_size', 'reserve_pool_size', 'max_db_connections',
+                 'max_user_connections'):
+        if settings.get(name, '').isdigit() and int(settings[name]) > 0:
+            pool_settings[name] = max(1, -(-int(settings[name]) // processes))
+
+    peers = ''.join('{0} = host={1} port={2}\n'.format(i, os.path.join(pgbouncer_dir, str(i)), port)
+                    for i in range(1, processes + 1))
+    for i in range(1, processes + 1):
+        socket_dir = os.path.join(pgbouncer_dir, str(i))
+        if not os.path.exists(socket_dir):
+            os.makedirs(socket_dir)
+            adjust_owner(socket_dir)
+        config = '%include {0}/pgbouncer.ini\n\n[pgbouncer]\n'.format(pgbouncer_dir)
+        config += 'so_reuseport = 1\npeer_id = {0}\nunix_socket_dir = {1}\n'.format(i, socket_dir)
+        if settings.get('pidfile'):
+            config += 'pidfile = {0}/pgbouncer.pid\n'.format(socket_dir)
+        config += ''.join('{0} = {1}\n'.format(k, v) for k, v in sorted(pool_settings.items()))
+        config += '\n[peers]\n' + peers
+        write_file(config, '{0}/pgbouncer-{1}.ini'.format(pgbouncer_dir, i), overwrite)
+
+        # services get own directories because runsv keeps the state in the service directory
+        service_dir = os.path.join(placeholders['RW_DIR'], 'service', 'pgbouncer-{0}'.format(i))
+        if not os.path.exists(service_dir):
+            os.makedirs(service_dir)
+            run = os.path.join(service_dir, 'run')
+            write_file('#!/bin/sh\nexec /etc/runit/runsvdir/default/pgbouncer/run {0}\n'.format(i), run, True)
+            os.chmod(run, 0o755)
+    logging.info('Configured %s pgbouncer processes with pool size %s', processes, pool_settings['default_pool_size'])
+    return True
+
+
 def write_pgbouncer_configuration(placeholders, overwrite):
     pgbouncer_config = placeholders.get('PGBOUNCER_CONFIGURATION')
     if not pgbouncer_config:
@@ -1115,7 +1207,9 @@ def write_pgbouncer_configuration(placeholders, overwrite):
     if pgbouncer_auth:
         write_file(pgbouncer_auth, pgbouncer_dir + '/userlist.txt', overwrite)
 
-    link_runit_service(placeholders, 'pgbouncer')
+    if not (placeholders['PGBOUNCER_PROCESSES']
+            and write_pgbouncer_process_configurations(placeholders, pgbouncer_dir, overwrite)):
+        link_runit_service(placeholders, 'pgbouncer')
 
 
 def main():
@@ -1169,6 +1263,9 @@ def main():
     if 'extwlist.extensions' not in user_config.get('postgresql', {}).get('parameters', {}):
         config['postgresql']['parameters']['extwlist.extensions'] =\
                 append_extensions(config['postgresql']['parameters']['extwlist.extensions'], version, True)
+    # WAL summaries are required to resume interrupted pg_basebackup with an incremental backup
+    if version >= 17 and 'summarize_wal' not in user_config.get('postgresql', {}).get('parameters', {}):
+        config['postgresql']['parameters']['summarize_wal'] = 'on'
 
     # Ensure replication is available
     if 'pg_hba' in config['bootstrap'] and not any(['replication' in i for i in config['bootstrap']['pg_hba']]):
@@ -1182,11 +1279,21 @@ def main():
             write_patroni_config(config, args['force'])
             adjust_owner(PATRONI_CONFIG_FILE, gid=-1)
             link_runit_service(placeholders, 'patroni')
+            if placeholders['CALLBACK_SCRIPT'] == 'python3 /scripts/callback_role.py':
+                link_runit_service(placeholders, 'callback_role')
             pg_socket_dir = '/run/postgresql'
             if not os.path.exists(pg_socket_dir):
                 os.makedirs(pg_socket_dir)
                 os.chmod(pg_socket_dir, 0o2775)
                 adjust_owner(pg_socket_dir)
+            # scripts record their metrics there, restore_command.sh does it only if the directory exists
+            metrics_dir = os.path.join(pg_socket_dir, 'metrics')
+            if not os.path.exists(metrics_dir):
+                os.makedirs(metrics_dir)
+                os.chmod(metrics_dir, 0o2775)
+                adjust_owner(metrics_dir)
+            if placeholders['METRICS_PORT']:
+                link_runit_service(placeholders, 'spilo_metrics')
         elif section == 'pgqd':
             link_runit_service(placeholders, 'pgqd')
         elif section == 'log':
@@ -1199,6 +1306,7 @@ def main():
             write_certificates(placeholders, args['force'])
             write_restapi_certificates(placeholders, args['force'])
         elif section == 'crontab':
+            setup_renice(placeholders)
             write_crontab(placeholders, args['force'])
         elif section == 'pam-oauth2':
             write_pam_oauth2_configuration(placeholders, args['force'])
@@ -5,7 +5,10 @@ GRANT USAGE ON SCHEMA metric_helpers TO admin, robot_zmon;
 SET search_path TO metric_helpers;
 
 -- table and btree bloat estimation queries are borrowed from https://github.com/ioguix/pgsql-bloat-estimation
-CREATE OR REPLACE FUNCTION get_table_bloat_approx (
+-- Estimates are computed for the given tables only, get_table_bloat_approx() and get_btree_bloat_approx()
+-- take them from the cache refreshed by pg_cron and compute only what is missing or stale.
+CREATE OR REPLACE FUNCTION table_bloat_live (
+    IN relids oid[],
     OUT t_database name,
     OUT t_schema_name name,
     OUT t_table_name name,
@@ -15,7 +18,8 @@ CREATE OR REPLACE FUNCTION get_table_bloat_approx (
     OUT t_fill_factor integer,
     OUT t_bloat_size double precision,
     OUT t_bloat_ratio double precision,
-    OUT t_is_na boolean
+    OUT t_is_na boolean,
+    OUT t_relid oid
 ) RETURNS SETOF record AS
 $_$
 SELECT
@@ -37,7 +41,8 @@ SELECT
     THEN 100 * (tblpages - est_tblpages_ff)/tblpages::float
     ELSE 0
   END AS bloat_ratio,
-  is_na
+  is_na,
+  tblid
 FROM (
   SELECT ceil( reltuples / ( (bs-page_hdr)/tpl_size ) ) + ceil( toasttuples / 4 ) AS est_tblpages,
     ceil( reltuples / ( (bs-page_hdr)*fillfactor/(tpl_size*100) ) ) + ceil( toasttuples / 4 ) AS est_tblpages_ff,
@@ -75,16 +80,16 @@ FROM (
         LEFT JOIN pg_class AS toast ON tbl.reltoastrelid = toast.oid
       WHERE NOT att.attisdropped
         AND tbl.relkind = 'r'
+        AND tbl.oid = ANY(relids)
       GROUP BY 1,2,3,4,5,6,7,8,9,10
       ORDER BY 2,3
     ) AS s
   ) AS s2
 ) AS s3 WHERE schemaname NOT LIKE 'information_schema';
-$_$ LANGUAGE sql SECURITY DEFINER IMMUTABLE STRICT SET search_path to 'pg_catalog';
-
-CREATE OR REPLACE VIEW table_bloat AS SELECT * FROM get_table_bloat_approx();
+$_$ LANGUAGE sql SECURITY DEFINER STABLE STRICT SET search_path to 'pg_catalog';
 
-CREATE OR REPLACE FUNCTION get_btree_bloat_approx (
+CREATE OR REPLACE FUNCTION btree_bloat_live (
+    IN relids oid[],
     OUT i_database name,
     OUT i_schema_name name,
     OUT i_table_name name,
@@ -95,7 +100,9 @@ CREATE OR REPLACE FUNCTION get_btree_bloat_approx (
     OUT i_fill_factor integer,
     OUT i_bloat_size double precision,
     OUT i_bloat_ratio double precision,
-    OUT i_is_na boolean
+    OUT i_is_na boolean,
+    OUT i_relid oid,
+    OUT i_table_relid oid
 ) RETURNS SETOF record AS
 $_$
 SELECT current_database(), nspname AS schemaname, tblname, idxname, bs*(relpages)::bigint AS real_size,
@@ -107,7 +114,7 @@ SELECT current_database(), nspname AS schemaname, tblname, idxname, bs*(relpages
     ELSE 0
   END AS bloat_size,
   100 * (relpages-est_pages_ff)::float / relpages AS bloat_ratio,
-  is_na
+  is_na, idxoid, tbloid
   -- , 100-(pst).avg_leaf_density AS pst_avg_bloat, est_pages, index_tuple_hdr_bm, maxalign, pagehdr, nulldatawidth, nulldatahdrwidth, reltuples, relpages -- (DEBUG INFO)
 FROM (
   SELECT coalesce(1 +
@@ -116,7 +123,7 @@ FROM (
       coalesce(1 +
          ceil(reltuples/floor((bs-pageopqdata-pagehdr)*fillfactor/(100*(4+nulldatahdrwidth)::float))), 0
       ) AS est_pages_ff,
-      bs, nspname, tblname, idxname, relpages, fillfactor, is_na
+      bs, nspname, tblname, idxname, relpages, fillfactor, is_na, idxoid, tbloid
       -- , pgstatindex(idxoid) AS pst, index_tuple_hdr_bm, maxalign, pagehdr, nulldatawidth, nulldatahdrwidth, reltuples -- (DEBUG INFO)
   FROM (
       SELECT maxalign, bs, nspname, tblname, idxname, reltuples, relpages, idxoid, fillfactor,
@@ -130,7 +137,7 @@ FROM (
                   WHEN nulldatawidth::integer%maxalign = 0 THEN maxalign
                   ELSE nulldatawidth::integer%maxalign
                 END
-            )::numeric AS nulldatahdrwidth, pagehdr, pageopqdata, is_na
+            )::numeric AS nulldatahdrwidth, pagehdr, pageopqdata, is_na, tbloid
             -- , index_tuple_hdr_bm, nulldatawidth -- (DEBUG INFO)
       FROM (
           SELECT n.nspname, ct.relname AS tblname, i.idxname, i.reltuples, i.relpages,
@@ -150,7 +157,8 @@ FROM (
               END AS index_tuple_hdr_bm,
               /* data len: we remove null values save space using it fractionnal part from stats */
               sum( (1-coalesce(s.stanullfrac, 0)) * coalesce(s.stawidth, 1024)) AS nulldatawidth,
-              max( CASE WHEN a.atttypid = 'pg_catalog.name'::regtype THEN 1 ELSE 0 END ) > 0 AS is_na
+              max( CASE WHEN a.atttypid = 'pg_catalog.name'::regtype THEN 1 ELSE 0 END ) > 0 AS is_na,
+              i.tbloid
           FROM (
               SELECT idxname, reltuples, relpages, tbloid, idxoid, fillfactor,
                   CASE WHEN indkey[i]=0 THEN idxoid ELSE tbloid END AS att_rel,
@@ -169,6 +177,7 @@ FROM (
                       JOIN pg_class ci ON ci.oid=i.indexrelid
                       WHERE ci.relam=(SELECT oid FROM pg_am WHERE amname = 'btree')
                         AND ci.relpages > 0
+                        AND i.indrelid = ANY(relids)
                   ) AS idx_data
               ) AS idx_data_cross
           ) i
@@ -178,11 +187,187 @@ FROM (
                              AND s.staattnum = i.att_pos
           JOIN pg_class ct ON ct.oid = i.tbloid
           JOIN pg_namespace n ON ct.relnamespace = n.oid
-          GROUP BY 1,2,3,4,5,6,7,8,9,10
+          GROUP BY 1,2,3,4,5,6,7,8,9,10,i.tbloid
       ) AS rows_data_stats
   ) AS rows_hdr_pdg_stats
 ) AS relation_stats;
-$_$ LANGUAGE sql SECURITY DEFINER IMMUTABLE STRICT SET search_path to 'pg_catalog';
+$_$ LANGUAGE sql SECURITY DEFINER STABLE STRICT SET search_path to 'pg_catalog';
+
+CREATE TABLE IF NOT EXISTS bloat_refresh (
+    relid oid PRIMARY KEY,
+    relpages integer NOT NULL,
+    reltuples real NOT NULL,
+    activity bigint NOT NULL,  -- n_tup_ins + n_tup_upd + n_tup_del at the time of the refresh
+    refreshed_at timestamp with time zone NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS table_bloat_cache (
+    t_relid oid PRIMARY KEY,
+    t_schema_name name,
+    t_table_name name,
+    t_real_size numeric,
+    t_extra_size double precision,
+    t_extra_ratio double precision,
+    t_fill_factor integer,
+    t_bloat_size double precision,
+    t_bloat_ratio double precision,
+    t_is_na boolean
+);
+
+CREATE TABLE IF NOT EXISTS btree_bloat_cache (
+    i_relid oid PRIMARY KEY,
+    i_table_relid oid NOT NULL,
+    i_schema_name name,
+    i_table_name name,
+    i_index_name name,
+    i_real_size numeric,
+    i_extra_size numeric,
+    i_extra_ratio double precision,
+    i_fill_factor integer,
+    i_bloat_size double precision,
+    i_bloat_ratio double precision,
+    i_is_na boolean
+);
+CREATE INDEX IF NOT EXISTS btree_bloat_cache_table_relid ON btree_bloat_cache (i_table_relid);
+
+-- the last run of refresh_bloat_cache(), one row
+CREATE TABLE IF NOT EXISTS bloat_refresh_run (
+    finished_at timestamp with time zone NOT NULL,
+    caught_up boolean NOT NULL  -- all due tables fit into the batch
+);
+
+-- cached estimates older than that are computed on the fly, could be changed with ALTER DATABASE ... SET
+CREATE OR REPLACE FUNCTION bloat_cache_max_age() RETURNS interval AS
+$_$
+SELECT coalesce(nullif(current_setting('metric_helpers.bloat_cache_max_age', true), '')::interval, interval '1 day');
+$_$ LANGUAGE sql STABLE SET search_path to 'pg_catalog';
+
+-- Refreshes estimates of the batch of tables (with their indexes), executed by pg_cron.
+-- Tables without estimates go first, then ones close to the max age, then the most modified.
+-- Modified tables are refreshed at most every 1/24 of the max age, unchanged ones when
+-- their estimates become half the max age old. Catalogs are scanned at most every 1/24
+-- of the max age too, unless the previous run didn't manage to refresh all due tables.
+CREATE OR REPLACE FUNCTION refresh_bloat_cache(batch_size integer DEFAULT 1000) RETURNS integer AS
+$_$
+DECLARE
+    max_age interval := metric_helpers.bloat_cache_max_age();
+    relids oid[];
+BEGIN
+    IF EXISTS (SELECT 1 FROM metric_helpers.bloat_refresh_run
+                WHERE caught_up AND finished_at > now() - max_age / 24) THEN
+        RETURN 0;
+    END IF;
+
+    DELETE FROM metric_helpers.bloat_refresh r WHERE NOT EXISTS (SELECT 1 FROM pg_class c WHERE c.oid = r.relid);
+    DELETE FROM metric_helpers.table_bloat_cache t
+     WHERE NOT EXISTS (SELECT 1 FROM metric_helpers.bloat_refresh r WHERE r.relid = t.t_relid);
+    DELETE FROM metric_helpers.btree_bloat_cache i
+     WHERE NOT EXISTS (SELECT 1 FROM metric_helpers.bloat_refresh r WHERE r.relid = i.i_table_relid);
+
+    SELECT array_agg(relid) INTO relids FROM (
+        SELECT c.oid AS relid
+          FROM pg_class c
+          LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+          LEFT JOIN metric_helpers.bloat_refresh r ON r.relid = c.oid
+         CROSS JOIN LATERAL (SELECT coalesce(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0) AS activity) a
+         WHERE c.relkind IN ('r', 'm', 't')
+           AND (r.relid IS NULL OR r.refreshed_at < now() - max_age / 2
+                OR r.refreshed_at < now() - max_age / 24 AND (r.activity != a.activity
+                    OR r.relpages != c.relpages OR r.reltuples != c.reltuples))
+         ORDER BY r.relid IS NULL DESC, r.refreshed_at < now() - max_age / 2 DESC,
+                  CASE WHEN a.activity >= r.activity THEN a.activity - r.activity ELSE a.activity END DESC
+         LIMIT batch_size
+    ) AS b;
+
+    DELETE FROM metric_helpers.bloat_refresh_run;
+    INSERT INTO metric_helpers.bloat_refresh_run VALUES (now(), coalesce(array_length(relids, 1), 0) < batch_size);
+
+    IF relids IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    DELETE FROM metric_helpers.table_bloat_cache WHERE t_relid = ANY(relids);
+    INSERT INTO metric_helpers.table_bloat_cache
+    SELECT t_relid, t_schema_name, t_table_name, t_real_size, t_extra_size, t_extra_ratio, t_fill_factor,
+           t_bloat_size, t_bloat_ratio, t_is_na
+      FROM metric_helpers.table_bloat_live(relids);
+
+    DELETE FROM metric_helpers.btree_bloat_cache WHERE i_table_relid = ANY(relids);
+    INSERT INTO metric_helpers.btree_bloat_cache
+    SELECT i_relid, i_table_relid, i_schema_name, i_table_name, i_index_name, i_real_size, i_extra_size,
+           i_extra_ratio, i_fill_factor, i_bloat_size, i_bloat_ratio, i_is_na
+      FROM metric_helpers.btree_bloat_live(relids);
+
+    -- statistics are fetched once per transaction, counters are the same as the batch was chosen with
+    INSERT INTO metric_helpers.bloat_refresh
+    SELECT c.oid, c.relpages, c.reltuples, coalesce(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0), now()
+      FROM pg_class c LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+     WHERE c.oid = ANY(relids)
+        ON CONFLICT (relid) DO UPDATE SET relpages = EXCLUDED.relpages, reltuples = EXCLUDED.reltuples,
+                                          activity = EXCLUDED.activity, refreshed_at = EXCLUDED.refreshed_at;
+    RETURN array_length(relids, 1);
+END;
+$_$ LANGUAGE plpgsql SET search_path to 'pg_catalog';
+
+CREATE OR REPLACE FUNCTION get_table_bloat_approx (
+    OUT t_database name,
+    OUT t_schema_name name,
+    OUT t_table_name name,
+    OUT t_real_size numeric,
+    OUT t_extra_size double precision,
+    OUT t_extra_ratio double precision,
+    OUT t_fill_factor integer,
+    OUT t_bloat_size double precision,
+    OUT t_bloat_ratio double precision,
+    OUT t_is_na boolean
+) RETURNS SETOF record AS
+$_$
+WITH fresh AS (
+  SELECT r.relid FROM metric_helpers.bloat_refresh r
+   WHERE r.refreshed_at > now() - metric_helpers.bloat_cache_max_age()
+     AND EXISTS (SELECT 1 FROM pg_class c WHERE c.oid = r.relid)
+)
+SELECT current_database(), t_schema_name, t_table_name, t_real_size, t_extra_size, t_extra_ratio, t_fill_factor,
+       t_bloat_size, t_bloat_ratio, t_is_na
+  FROM metric_helpers.table_bloat_cache JOIN fresh ON fresh.relid = t_relid
+UNION ALL
+SELECT t_database, t_schema_name, t_table_name, t_real_size, t_extra_size, t_extra_ratio, t_fill_factor,
+       t_bloat_size, t_bloat_ratio, t_is_na
+  FROM metric_helpers.table_bloat_live(ARRAY(SELECT c.oid FROM pg_class c WHERE c.relkind = 'r'
+                                             AND NOT EXISTS (SELECT 1 FROM fresh WHERE fresh.relid = c.oid)));
+$_$ LANGUAGE sql SECURITY DEFINER STABLE STRICT SET search_path to 'pg_catalog';
+
+CREATE OR REPLACE VIEW table_bloat AS SELECT * FROM get_table_bloat_approx();
+
+CREATE OR REPLACE FUNCTION get_btree_bloat_approx (
+    OUT i_database name,
+    OUT i_schema_name name,
+    OUT i_table_name name,
+    OUT i_index_name name,
+    OUT i_real_size numeric,
+    OUT i_extra_size numeric,
+    OUT i_extra_ratio double precision,
+    OUT i_fill_factor integer,
+    OUT i_bloat_size double precision,
+    OUT i_bloat_ratio double precision,
+    OUT i_is_na boolean
+) RETURNS SETOF record AS
+$_$
+WITH fresh AS (
+  SELECT r.relid FROM metric_helpers.bloat_refresh r
+   WHERE r.refreshed_at > now() - metric_helpers.bloat_cache_max_age()
+     AND EXISTS (SELECT 1 FROM pg_class c WHERE c.oid = r.relid)
+)
+SELECT current_database(), i_schema_name, i_table_name, i_index_name, i_real_size, i_extra_size, i_extra_ratio,
+       i_fill_factor, i_bloat_size, i_bloat_ratio, i_is_na
+  FROM metric_helpers.btree_bloat_cache JOIN fresh ON fresh.relid = i_table_relid
+ WHERE EXISTS (SELECT 1 FROM pg_class c WHERE c.oid = i_relid)
+UNION ALL
+SELECT i_database, i_schema_name, i_table_name, i_index_name, i_real_size, i_extra_size, i_extra_ratio,
+       i_fill_factor, i_bloat_size, i_bloat_ratio, i_is_na
+  FROM metric_helpers.btree_bloat_live(ARRAY(SELECT c.oid FROM pg_class c WHERE c.relkind IN ('r', 'm', 't')
+                                             AND NOT EXISTS (SELECT 1 FROM fresh WHERE fresh.relid = c.oid)));
+$_$ LANGUAGE sql SECURITY DEFINER STABLE STRICT SET search_path to 'pg_catalog';
 
 CREATE OR REPLACE VIEW index_bloat AS SELECT * FROM get_btree_bloat_approx();
 
@@ -228,5 +413,6 @@ GRANT SELECT ON ALL TABLES IN SCHEMA metric_helpers TO admin, robot_zmon;
 
 REVOKE ALL ON ALL FUNCTIONS IN SCHEMA metric_helpers FROM public;
 GRANT EXECUTE ON ALL FUNCTIONS IN SCHEMA metric_helpers TO admin, robot_zmon;
+REVOKE EXECUTE ON FUNCTION refresh_bloat_cache(integer) FROM admin, robot_zmon;
 
 RESET search_path;
@@ -11,7 +11,8 @@ if [[ "${*: -3:1}" == "on_role_change" && "${*: -2:1}" == "primary" ]]; then
     num=30  # wait 30 seconds for end of recovery
     while  [[ $((num--)) -gt 0 ]]; do
         if [[ "$(psql -d $dbname -tAc 'SELECT pg_catalog.pg_is_in_recovery()')" == "f" ]]; then
-            vacuumdb -aZ > /dev/null 2>&1 &
+            # statistics are replicated, only relations which changed since the last analyze need it
+            python3 /scripts/analyze_scheduler.py --stale-only --jobs 2 --max-rate 16 --idle-io > /dev/null 2>&1 &
             exec /scripts/post_init.sh "$HUMAN_ROLE" "$dbname"
         else
             sleep 1
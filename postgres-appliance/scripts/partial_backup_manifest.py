@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# pg_basebackup writes files one after another, therefore only files touched
+# shortly before the transfer has failed could be incomplete.
+COOLDOWN_SECONDS = 5
+
+SKIP_FILES = ('backup_manifest', 'postmaster.pid', 'postmaster.opts')
+SKIP_DIRS = ('pg_wal', 'pg_xlog')
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Writes a backup_manifest for a partially transferred base backup, '
+                                                 'so that it could be used as a base for "pg_basebackup --incremental"')
+    parser.add_argument('--datadir', required=True, help='directory with the partially transferred base backup')
+    parser.add_argument('--connstring', required=True, help='connection string to the primary')
+    return parser.parse_args()
+
+
+def get_system_identifier(connstring):
+    conn = psycopg2.connect(connstring, replication=1)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('IDENTIFY_SYSTEM')
+            return int(cur.fetchone()[0])
+    finally:
+        conn.close()
+
+
+def parse_backup_label(datadir):
+    with open(os.path.join(datadir, 'backup_label')) as f:
+        label = f.read()
+
+    start_lsn = re.search(r'^START WAL LOCATION: ([0-9A-F]+/[0-9A-F]+)', label, re.M)
+    timeline = re.search(r'^START TIMELINE: (\d+)', label, re.M)
+    if not start_lsn or not timeline:
+        raise Exception('Failed to parse backup_label')
+    if re.search(r'^INCREMENTAL FROM LSN:', label, re.M):
+        raise Exception('Resuming of incremental backups is not supported')
+    return start_lsn.group(1), int(timeline.group(1))
+
+
+def list_files(datadir):
+    files = []
+    for root, dirs, names in os.walk(datadir):
+        rel_root = os.path.relpath(root, datadir)
+        if rel_root in SKIP_DIRS:
+            dirs[:] = []
+            continue
+        for name in names:
+            path = os.path.join(root, name)
+            if rel_root == '.' and name in SKIP_FILES or os.path.islink(path):
+                continue
+            st = os.lstat(path)
+            files.append((os.path.normpath(os.path.join(rel_root, name)), st.st_size, st.st_mtime))
+    return files
+
+
+def build_manifest(system_identifier, files, start_lsn, timeline):
+    lines = ['{ "PostgreSQL-Backup-Manifest-Version": 2,',
+             '"System-Identifier": {0},'.format(system_identifier),
+             '"Files": [']
+    entries = ['{{ "Path": {0}, "Size": {1}, "Last-Modified": "{2}" }}'
+               .format(json.dumps(path), size, time.strftime('%Y-%m-%d %H:%M:%S GMT', time.gmtime(mtime)))
+               for path, size, mtime in files]
+    lines += [e + ',' for e in entries[:-1]] + entries[-1:]
+    lines += ['],',
+              '"WAL-Ranges": [',
+              # the end of the interrupted backup is unknown, the new backup will anyway start later
+              '{{ "Timeline": {0}, "Start-LSN": "{1}", "End-LSN": "{1}" }}'.format(timeline, start_lsn),
+              '],']
+    # Manifest-Checksum covers everything up to and including the penultimate newline
+    content = ''.join(line + '\n' for line in lines)
+    checksum = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return content + '"Manifest-Checksum": "{0}"}}\n'.format(checksum)
+
+
+def write_manifest(datadir, connstring):
+    start_lsn, timeline = parse_backup_label(datadir)
+
+    files = list_files(datadir)
+    if not files:
+        raise Exception('Nothing was transferred')
+
+    cutoff = max(mtime for _, _, mtime in files) - COOLDOWN_SECONDS
+    complete = [f for f in files if f[2] < cutoff or f[0] == 'backup_label']
+    complete_size = sum(size for _, size, _ in complete)
+    logger.info('%s files (%s bytes) were transferred completely and will be reused, '
+                '%s recently written files will be transferred again',
+                len(complete), complete_size, len(files) - len(complete))
+
+    manifest = build_manifest(get_system_identifier(connstring), complete, start_lsn, timeline)
+    with open(os.path.join(datadir, 'backup_manifest'), 'w') as f:
+        f.write(manifest)
+    return complete_size
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    options = read_configuration()
+    try:
+        write_manifest(options.datadir, options.connstring)
+    except Exception:
+        logger.exception('Failed to write backup_manifest for %s', options.datadir)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,10 @@ cd "$(dirname "${BASH_SOURCE[0]}")" || exit 1
 
 export PGOPTIONS="-c synchronous_commit=local -c search_path=pg_catalog"
 
+START=$EPOCHREALTIME
+trap 'python3 spilo_metrics.py record post_init --start "$START" --exitcode $? --value "databases=${#DATABASES[@]}" \
+    > /dev/null 2>&1' EXIT
+
 PGVER=$(psql -d "$2" -XtAc "SELECT pg_catalog.current_setting('server_version_num')::int/10000")
 if [ "$PGVER" -lt 17 ]; then
     RESET_ARGS="oid, oid, bigint"
@@ -11,7 +15,20 @@ else
     RESET_ARGS="oid, oid, bigint, bool"
 fi
 
-(echo "\set ON_ERROR_STOP on"
+# Sunday could be 0 or 7 depending on the format, we just create both
+LOG_SHIP_HOURLY=$(echo "SELECT text(current_setting('log_rotation_age') = '1h')" | psql -tAX -d postgres 2> /dev/null | tail -n 1)
+
+# What was applied is recorded in the catalog as spilo.post_init_global (for the database "$2")
+# and spilo.post_init (for every database) settings, on promotion only changed parts are applied again.
+SCRIPT_VERSION=$(cat post_init.sh create_user_functions.sql metric_helpers.sql _zmon_schema.dump | md5sum | cut -d ' ' -f 1)
+EXTENSIONS_VERSION=$(psql -d "$2" -XtAc "SELECT pg_catalog.md5(pg_catalog.string_agg(name || ' ' || COALESCE(default_version, ''), ',' ORDER BY name)) FROM pg_catalog.pg_available_extensions")
+GLOBAL_FINGERPRINT=$(echo "$SCRIPT_VERSION $PGVER $1 $LOG_SHIP_HOURLY $EXTENSIONS_VERSION" | md5sum | cut -d ' ' -f 1)
+# schedule of the background refresh of bloat estimates, runs without anything due return immediately
+BLOAT_REFRESH_SCHEDULE=${BLOAT_REFRESH_SCHEDULE:-"*/10 * * * *"}
+DATABASE_FINGERPRINT=$(echo "$SCRIPT_VERSION $PGVER $1 $ENABLE_PG_MON $BLOAT_REFRESH_SCHEDULE $PREWARM_SCHEDULE $EXTENSIONS_VERSION" | md5sum | cut -d ' ' -f 1)
+
+function global_sql() {
+echo "\set ON_ERROR_STOP on"
 echo "DO \$\$
 BEGIN
     PERFORM * FROM pg_catalog.pg_authid WHERE rolname = 'admin';
@@ -150,8 +167,7 @@ if [ "$PGVER" -ge 14 ]; then
     echo "ALTER TABLE public.postgres_log ADD COLUMN IF NOT EXISTS query_id bigint;"
 fi
 
-# Sunday could be 0 or 7 depending on the format, we just create both
-LOG_SHIP_HOURLY=$(echo "SELECT text(current_setting('log_rotation_age') = '1h')" | psql -tAX -d postgres 2> /dev/null | tail -n 1)
+
 if [ "$LOG_SHIP_HOURLY" != "true" ]; then
     tbl_regex='postgres_log_\d_\d{2}$'
 else
@@ -210,110 +226,123 @@ done
 
 cat _zmon_schema.dump
 
-while IFS= read -r db_name; do
-    echo "\c ${db_name}"
+# recorded only if everything above succeeded
+echo "SELECT pg_catalog.format('ALTER DATABASE %I SET spilo.post_init_global = %L', pg_catalog.current_database(), '$GLOBAL_FINGERPRINT') \gexec"
+}
+
+function database_sql() {
+    echo "\set ON_ERROR_STOP on"
+    echo "\c $1"
+    echo "\set ON_ERROR_STOP off"
+    echo "\set upgrade_timescaledb false"
+    echo "\set timescaledb_below_215 false"
+    echo "\set upgrade_timescaledb_toolkit false"
+    echo "\set upgrade_postgis false"
     # In case if timescaledb binary is missing the first query fails with the error
     # ERROR:  could not access file "$libdir/timescaledb-$OLD_VERSION": No such file or directory
-    UPGRADE_TIMESCALEDB=$(echo -e "SELECT NULL;\nSELECT default_version != installed_version FROM pg_catalog.pg_available_extensions WHERE name = 'timescaledb'" | psql -tAX -d "${db_name}" 2> /dev/null | tail -n 1)
-    if [ "$UPGRADE_TIMESCALEDB" = "t" ]; then
-        echo "ALTER EXTENSION timescaledb UPDATE;"
-        IS_VERSION_BELOW_215=$(echo -e "SELECT (installed_version < '2.15')::bool FROM pg_catalog.pg_available_extensions WHERE name = 'timescaledb'" | psql -tAX -d "${db_name}" 2> /dev/null | tail -n 1)
-        if [ "$IS_VERSION_BELOW_215" = "t" ]; then
-            echo """
-                    -- Fix compressed hypertables with FOREIGN KEY constraints that were created with TimescaleDB versions before 2.15.0
-                    CREATE OR REPLACE FUNCTION pg_temp.constraint_columns(regclass, int2[]) RETURNS text[] AS
-                    $$
-                    SELECT array_agg(attname) FROM unnest($2) un(attnum) LEFT JOIN pg_attribute att ON att.attrelid=$1 AND att.attnum = un.attnum;
-                    $$ LANGUAGE SQL SET search_path TO pg_catalog, pg_temp;
-                    DO $$
-                        DECLARE
-                        ht_id int;
-                        ht regclass;
-                        chunk regclass;
-                        con_oid oid;
-                        con_frelid regclass;
-                        con_name text;
-                        con_columns text[];
-                        chunk_id int;
-
-                        BEGIN
-
-                        -- iterate over all hypertables that have foreign key constraints
-                        FOR ht_id, ht in
-                            SELECT
-                            ht.id,
-                            format('%I.%I',ht.schema_name,ht.table_name)::regclass
-                            FROM _timescaledb_catalog.hypertable ht
-                            WHERE
-                            EXISTS (
-                                SELECT FROM pg_constraint con
-                                WHERE
-                                con.contype='f' AND
-                                con.conrelid=format('%I.%I',ht.schema_name,ht.table_name)::regclass
-                            )
-                        LOOP
-                            RAISE NOTICE 'Hypertable % has foreign key constraint', ht;
-
-                            -- iterate over all foreign key constraints on the hypertable
-                            -- and check that they are present on every chunk
-                            FOR con_oid, con_frelid, con_name, con_columns IN
-                            SELECT con.oid, con.confrelid, con.conname, pg_temp.constraint_columns(con.conrelid,con.conkey)
-                            FROM pg_constraint con
-                            WHERE
-                                con.contype='f' AND
-                                con.conrelid=ht
-                            LOOP
-                                RAISE NOTICE 'Checking constraint % %', con_name, con_columns;
-                                -- check that the foreign key constraint is present on the chunk
-
-                                FOR chunk_id, chunk IN
-                                    SELECT
-                                    ch.id,
-                                    format('%I.%I',ch.schema_name,ch.table_name)::regclass
-                                    FROM _timescaledb_catalog.chunk ch
-                                    WHERE
-                                    ch.hypertable_id=ht_id
-                                LOOP
-                                    RAISE NOTICE 'Checking chunk %', chunk;
-                                    IF NOT EXISTS (
-                                    SELECT FROM pg_constraint con
-                                    WHERE
-                                        con.contype='f' AND
-                                        con.conrelid=chunk AND
-                                        con.confrelid=con_frelid  AND
-                                        pg_temp.constraint_columns(con.conrelid,con.conkey) = con_columns
-                                    ) THEN
-                                    RAISE WARNING 'Restoring constraint % on chunk %', con_name, chunk;
-                                    PERFORM _timescaledb_functions.constraint_clone(con_oid, chunk);
-                                    INSERT INTO _timescaledb_catalog.chunk_constraint(chunk_id, dimension_slice_id, constraint_name, hypertable_constraint_name) VALUES (chunk_id, NULL, con_name, con_name);
-                                    END IF;
-
-                                END LOOP;
-                            END LOOP;
-
-                        END LOOP;
-
-                    END
-                    $$;
-
-                    DROP FUNCTION pg_temp.constraint_columns(regclass, int2[]);
-                """
-        fi
-    fi
-    UPGRADE_TIMESCALEDB_TOOLKIT=$(echo -e "SELECT NULL;\nSELECT default_version != installed_version FROM pg_catalog.pg_available_extensions WHERE name = 'timescaledb_toolkit'" | psql -tAX -d "${db_name}" 2> /dev/null | tail -n 1)
-    if [ "$UPGRADE_TIMESCALEDB_TOOLKIT" = "t" ]; then
-        echo "ALTER EXTENSION timescaledb_toolkit UPDATE;"
-    fi
-    UPGRADE_POSTGIS=$(echo "SELECT COUNT(*) FROM pg_catalog.pg_extension WHERE extname = 'postgis'" | psql -tAX -d "${db_name}" 2> /dev/null | tail -n 1)
-    if [ "$UPGRADE_POSTGIS" = "1" ]; then
-        # public.postgis_lib_version() is available only if postgis extension is created
-        UPGRADE_POSTGIS=$(echo "SELECT extversion != public.postgis_lib_version() FROM pg_catalog.pg_extension WHERE extname = 'postgis'" | psql -tAX -d "${db_name}" 2> /dev/null | tail -n 1)
-        if [ "$UPGRADE_POSTGIS" = "t" ]; then
-            echo "ALTER EXTENSION postgis UPDATE;"
-            echo "SELECT public.postgis_extensions_upgrade();"
-        fi
-    fi
-    sed "s/:HUMAN_ROLE/$1/" create_user_functions.sql
+    echo "SELECT NULL;"
+    echo "SELECT COALESCE(pg_catalog.bool_or(default_version != installed_version AND name = 'timescaledb'), false) AS upgrade_timescaledb,
+    COALESCE(pg_catalog.bool_or(installed_version < '2.15' AND name = 'timescaledb'), false) AS timescaledb_below_215,
+    COALESCE(pg_catalog.bool_or(default_version != installed_version AND name = 'timescaledb_toolkit'), false) AS upgrade_timescaledb_toolkit
+    FROM pg_catalog.pg_available_extensions WHERE name IN ('timescaledb', 'timescaledb_toolkit') \gset"
+    echo "\set ON_ERROR_STOP on"
+    echo "\if :upgrade_timescaledb"
+    echo "ALTER EXTENSION timescaledb UPDATE;"
+    echo "\if :timescaledb_below_215"
+    cat <<'EOF'
+-- Fix compressed hypertables with FOREIGN KEY constraints that were created with TimescaleDB versions before 2.15.0
+CREATE OR REPLACE FUNCTION pg_temp.constraint_columns(regclass, int2[]) RETURNS text[] AS
+$$
+SELECT array_agg(attname) FROM unnest($2) un(attnum) LEFT JOIN pg_attribute att ON att.attrelid=$1 AND att.attnum = un.attnum;
+$$ LANGUAGE SQL SET search_path TO pg_catalog, pg_temp;
+DO $$
+    DECLARE
+    ht_id int;
+    ht regclass;
+    chunk regclass;
+    con_oid oid;
+    con_frelid regclass;
+    con_name text;
+    con_columns text[];
+    chunk_id int;
+
+    BEGIN
+
+    -- iterate over all hypertables that have foreign key constraints
+    FOR ht_id, ht in
+        SELECT
+        ht.id,
+        format('%I.%I',ht.schema_name,ht.table_name)::regclass
+        FROM _timescaledb_catalog.hypertable ht
+        WHERE
+        EXISTS (
+            SELECT FROM pg_constraint con
+            WHERE
+            con.contype='f' AND
+            con.conrelid=format('%I.%I',ht.schema_name,ht.table_name)::regclass
+        )
+    LOOP
+        RAISE NOTICE 'Hypertable % has foreign key constraint', ht;
+
+        -- iterate over all foreign key constraints on the hypertable
+        -- and check that they are present on every chunk
+        FOR con_oid, con_frelid, con_name, con_columns IN
+        SELECT con.oid, con.confrelid, con.conname, pg_temp.constraint_columns(con.conrelid,con.conkey)
+        FROM pg_constraint con
+        WHERE
+            con.contype='f' AND
+            con.conrelid=ht
+        LOOP
+            RAISE NOTICE 'Checking constraint % %', con_name, con_columns;
+            -- check that the foreign key constraint is present on the chunk
+
+            FOR chunk_id, chunk IN
+                SELECT
+                ch.id,
+                format('%I.%I',ch.schema_name,ch.table_name)::regclass
+                FROM _timescaledb_catalog.chunk ch
+                WHERE
+                ch.hypertable_id=ht_id
+            LOOP
+                RAISE NOTICE 'Checking chunk %', chunk;
+                IF NOT EXISTS (
+                SELECT FROM pg_constraint con
+                WHERE
+                    con.contype='f' AND
+                    con.conrelid=chunk AND
+                    con.confrelid=con_frelid  AND
+                    pg_temp.constraint_columns(con.conrelid,con.conkey) = con_columns
+                ) THEN
+                RAISE WARNING 'Restoring constraint % on chunk %', con_name, chunk;
+                PERFORM _timescaledb_functions.constraint_clone(con_oid, chunk);
+                INSERT INTO _timescaledb_catalog.chunk_constraint(chunk_id, dimension_slice_id, constraint_name, hypertable_constraint_name) VALUES (chunk_id, NULL, con_name, con_name);
+                END IF;
+
+            END LOOP;
+        END LOOP;
+
+    END LOOP;
+
+END
+$$;
+
+DROP FUNCTION pg_temp.constraint_columns(regclass, int2[]);
+EOF
+    echo "\endif"
+    echo "\endif"
+    echo "\if :upgrade_timescaledb_toolkit"
+    echo "ALTER EXTENSION timescaledb_toolkit UPDATE;"
+    echo "\endif"
+    # public.postgis_lib_version() is available only if postgis extension is created
+    echo "SELECT EXISTS (SELECT 1 FROM pg_catalog.pg_extension WHERE extname = 'postgis') AS upgrade_postgis \gset"
+    echo "\if :upgrade_postgis"
+    echo "SELECT extversion != public.postgis_lib_version() AS upgrade_postgis FROM pg_catalog.pg_extension WHERE extname = 'postgis' \gset"
+    echo "\if :upgrade_postgis"
+    echo "ALTER EXTENSION postgis UPDATE;"
+    echo "SELECT public.postgis_extensions_upgrade();"
+    echo "\endif"
+    echo "\endif"
+    sed "s/:HUMAN_ROLE/$2/" create_user_functions.sql
     echo "CREATE EXTENSION IF NOT EXISTS pg_stat_statements SCHEMA public;
 CREATE EXTENSION IF NOT EXISTS pg_stat_kcache SCHEMA public;
 CREATE EXTENSION IF NOT EXISTS set_user SCHEMA public;
@@ -322,6 +351,71 @@ GRANT EXECUTE ON FUNCTION public.set_user(text) TO admin;
 GRANT EXECUTE ON FUNCTION public.pg_stat_statements_reset($RESET_ARGS) TO admin;"
     echo "GRANT EXECUTE ON FUNCTION pg_catalog.pg_switch_wal() TO admin;"
     if [ "$ENABLE_PG_MON" = "true" ]; then echo "CREATE EXTENSION IF NOT EXISTS pg_mon SCHEMA public;"; fi
+    # replicas load blocks with pg_prewarm, they can't create it themselves
+    if [ -n "$PREWARM_SCHEDULE" ]; then echo "CREATE SCHEMA IF NOT EXISTS spilo_prewarm;
+CREATE EXTENSION IF NOT EXISTS pg_prewarm SCHEMA spilo_prewarm;"; fi
     cat metric_helpers.sql
-done < <(psql -d "$2" -tAc 'select pg_catalog.quote_ident(datname) from pg_catalog.pg_database where datallowconn')
-) | psql -Xd "$2"
+    # bloat estimates are refreshed in the background, jobs could be scheduled only from the pg_cron database.
+    # Template databases are skipped, sessions of pg_cron would break CREATE DATABASE.
+    echo "SELECT pg_catalog.current_database() AS bloat_database, NOT datistemplate AS bloat_job
+    FROM pg_catalog.pg_database WHERE datname = pg_catalog.current_database() \gset"
+    echo "\if :bloat_job"
+    echo "\c $CRON_DATABASE"
+    echo "SELECT cron.schedule_in_database('$BLOAT_JOB_PREFIX' || :'bloat_database', '$BLOAT_REFRESH_SCHEDULE',
+    'SELECT metric_helpers.refresh_bloat_cache()', :'bloat_database');"
+    echo "\c $1"
+    echo "\else"
+    echo "TRUNCATE metric_helpers.bloat_refresh, metric_helpers.bloat_refresh_run,
+    metric_helpers.table_bloat_cache, metric_helpers.btree_bloat_cache;"
+    echo "\endif"
+    echo "SELECT pg_catalog.format('ALTER DATABASE %I SET spilo.post_init = %L', pg_catalog.current_database(), '$DATABASE_FINGERPRINT') \gexec"
+}
+
+# is_current global_fingerprint fingerprint db_name
+FINGERPRINTS=$(psql -d "$2" -XtA -F ' ' -c "SELECT d.datname = pg_catalog.current_database(),
+    COALESCE(pg_catalog.max(pg_catalog.split_part(c, '=', 2)) FILTER (WHERE pg_catalog.split_part(c, '=', 1) = 'spilo.post_init_global'), '-'),
+    COALESCE(pg_catalog.max(pg_catalog.split_part(c, '=', 2)) FILTER (WHERE pg_catalog.split_part(c, '=', 1) = 'spilo.post_init'), '-'),
+    pg_catalog.quote_ident(d.datname)
+    FROM pg_catalog.pg_database d
+    LEFT JOIN pg_catalog.pg_db_role_setting s ON s.setdatabase = d.oid AND s.setrole = 0
+    LEFT JOIN LATERAL pg_catalog.unnest(s.setconfig) c ON true
+    WHERE d.datallowconn GROUP BY d.datname") || exit 1
+
+BLOAT_JOB_PREFIX=metric_helpers_refresh_bloat_cache_
+DATABASES=()
+while read -r is_current global_fingerprint fingerprint db_name; do
+    if [ "$is_current" = "t" ]; then
+        # pg_cron is created in the database "$2"
+        CRON_DATABASE=$db_name
+        if [ "$global_fingerprint" != "$GLOBAL_FINGERPRINT" ]; then
+            # roles created here are used by the per-database part, therefore it goes first
+            global_sql "$1" | psql -Xd "$2" || exit 1
+        fi
+    fi
+    if [ "$fingerprint" != "$DATABASE_FINGERPRINT" ]; then
+        DATABASES+=("$db_name")
+    fi
+done < <(echo "$FINGERPRINTS" | sort -r)
+
+# databases are processed in parallel, with one connection per database and not more than CPUs of the container
+MAX_JOBS=$(python3 -c 'from spilo_commons import get_cpu_count; print(get_cpu_count())' 2> /dev/null || echo 1)
+RUNNING=0
+FAILED=0
+for db_name in "${DATABASES[@]}"; do
+    if [ $RUNNING -ge "$MAX_JOBS" ]; then
+        wait -n || FAILED=1
+        RUNNING=$((RUNNING-1))
+    fi
+    database_sql "$db_name" "$1" | psql -Xd "$2" &
+    RUNNING=$((RUNNING+1))
+done
+while [ $RUNNING -gt 0 ]; do
+    wait -n || FAILED=1
+    RUNNING=$((RUNNING-1))
+done
+
+if [ ${#DATABASES[@]} -gt 0 ]; then
+    psql -Xd "$2" -c "SELECT cron.unschedule(jobid) FROM cron.job WHERE pg_catalog.starts_with(jobname, '$BLOAT_JOB_PREFIX')
+        AND database NOT IN (SELECT datname FROM pg_catalog.pg_database WHERE NOT datistemplate)" > /dev/null || FAILED=1
+fi
+exit $FAILED
@@ -9,18 +9,39 @@ function log
 
 log "I was called as: $0 $*"
 
+START=$EPOCHREALTIME
+METRIC_VALUES=()
+
+# the run is failed if either the backup or the retention has failed
+function record_metrics() {
+    local exitcode=$1
+    [[ ${BACKUP_EXITCODE:-0} != 0 ]] && exitcode=$BACKUP_EXITCODE
+    python3 /scripts/spilo_metrics.py record postgres_backup --start "$START" --exitcode "$exitcode" \
+        "${METRIC_VALUES[@]}" > /dev/null 2>&1
+}
+trap 'record_metrics $?' EXIT
 
 readonly PGDATA=$1
 DAYS_TO_RETAIN=$BACKUP_NUM_TO_RETAIN
 
-IN_RECOVERY=$(psql -tXqAc "select pg_catalog.pg_is_in_recovery()")
-readonly IN_RECOVERY
-if [[ $IN_RECOVERY == "f" ]]; then
-    [[ "$WALG_BACKUP_FROM_REPLICA" == "true" ]] && log "Cluster is not in recovery, not running backup" && exit 0
-elif [[ $IN_RECOVERY == "t" ]]; then
-    [[ "$WALG_BACKUP_FROM_REPLICA" != "true" ]] && log "Cluster is in recovery, not running backup" && exit 0
+if [[ "$BACKUP_SCHEDULER" == "true" && "$USE_WALG_BACKUP" == "true" ]]; then
+    # let the least loaded healthy member of the cluster take the backup
+    python3 /scripts/backup_scheduler.py acquire
+    case $? in
+        0) BACKUP_LOCK=true ;;
+        1) log "Not elected to take the backup" && exit 0 ;;
+        *) log "ERROR: failed to elect the member taking the backup" && exit 1 ;;
+    esac
 else
-    log "ERROR: Recovery state unknown: $IN_RECOVERY" && exit 1
+    IN_RECOVERY=$(psql -tXqAc "select pg_catalog.pg_is_in_recovery()")
+    readonly IN_RECOVERY
+    if [[ $IN_RECOVERY == "f" ]]; then
+        [[ "$WALG_BACKUP_FROM_REPLICA" == "true" ]] && log "Cluster is not in recovery, not running backup" && exit 0
+    elif [[ $IN_RECOVERY == "t" ]]; then
+        [[ "$WALG_BACKUP_FROM_REPLICA" != "true" ]] && log "Cluster is in recovery, not running backup" && exit 0
+    else
+        log "ERROR: Recovery state unknown: $IN_RECOVERY" && exit 1
+    fi
 fi
 
 if [[ "$USE_WALG_BACKUP" == "true" ]]; then
@@ -38,16 +59,42 @@ fi
 
 # push a new base backup
 log "producing a new backup"
-# We reduce the priority of the backup for CPU consumption
-nice -n 5 $WAL_E backup-push "$PGDATA" "${POOL_SIZE[@]}"
+BACKUP_START=$SECONDS
+if [[ "$BACKUP_POLICY" == "adaptive" && "$USE_WALG_BACKUP" == "true" ]]; then
+    # decides between full, delta or no backup and runs backup-push with reduced priority
+    python3 /scripts/backup_policy.py --datadir="$PGDATA"
+else
+    # We reduce the priority of the backup for CPU consumption
+    nice -n 5 $WAL_E backup-push "$PGDATA" "${POOL_SIZE[@]}"
+fi
+BACKUP_EXITCODE=$?
+METRIC_VALUES+=(--value "backup_exitcode=$BACKUP_EXITCODE" --value "backup_seconds=$((SECONDS - BACKUP_START))")
 
-# Collect all backups and sort them by modification time
+if [[ $BACKUP_LOCK == "true" ]]; then
+    [[ $BACKUP_EXITCODE == 0 ]] && SUCCESS=(--success)
+    python3 /scripts/backup_scheduler.py release "${SUCCESS[@]}"
+fi
+
+# Collect all backups and sort them by modification time, without details which require downloading sentinels
 mapfile -t backup_records < <(wal-g backup-list 2>/dev/null |
     sed '0,/^\(backup_\)\?name\s*\(last_\)\?modified\s*/d' |
     awk '{ print $1, $2 }' |
     sort -k2r
     )
 
+if [[ ${#backup_records[@]} -gt 0 ]]; then
+    # the newest backup could be taken by another member of the cluster
+    METRIC_VALUES+=(--value "last_backup_timestamp=$(date +%s -ud "${backup_records[0]##* }")"
+                    --value "backups=${#backup_records[@]}")
+    # only the sentinel of the newest backup is downloaded for its sizes
+    if read -r compressed_size uncompressed_size < <(wal-g st cat \
+            "basebackups_005/${backup_records[0]%% *}_backup_stop_sentinel.json" 2>/dev/null |
+            jq -r '"\(.CompressedSize // 0) \(.UncompressedSize // 0)"' 2>/dev/null); then
+        METRIC_VALUES+=(--value "last_backup_compressed_bytes=$compressed_size"
+                        --value "last_backup_uncompressed_bytes=$uncompressed_size")
+    fi
+fi
+
 # leave at least 2 days base backups and/or 2 backups
 [[ "$BACKUP_NUM_TO_RETAIN" -lt 2 ]] && BACKUP_NUM_TO_RETAIN=2
 [[ "$DAYS_TO_RETAIN" -lt 2 ]] && DAYS_TO_RETAIN=2
@@ -73,6 +120,9 @@ fi
 
 if [[ $TOTAL -gt $BACKUP_NUM_TO_RETAIN ]]; then
     wal-g delete before FIND_FULL "$BEFORE" --confirm
+    DELETE_EXITCODE=$?
+    METRIC_VALUES+=(--value "retention_exitcode=$DELETE_EXITCODE")
+    exit $DELETE_EXITCODE
 else
     log "There are only $TOTAL backups, not deleting any"
 fi
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from queue import Empty, Queue
+
+import psycopg2
+
+from spilo_metrics import record
+
+logger = logging.getLogger(__name__)
+
+FORKS = ('main', 'fsm', 'vm', 'init')
+# big ranges are split in order to keep the rate limit smooth
+MAX_RANGE_BLOCKS = 1024
+# number of ranges processed by a worker with one connection
+CHUNK_RANGES = 64
+DEFAULT_MAX_RATE = int(os.environ.get('PREWARM_MAX_RATE', 32))  # MB/s
+DEFAULT_JOBS = 2
+# owned by Spilo, extensions aren't created in schemas of users
+SCHEMA = 'spilo_prewarm'
+
+# the schema of the extension is substituted, it is created in SCHEMA, because pg_catalog can't contain its view
+BUFFERS = ('SELECT d.datname, b.reltablespace, b.relfilenode, b.relforknumber, b.relblocknumber, b.usagecount'
+           ' FROM {0}.pg_buffercache b JOIN pg_catalog.pg_database d ON d.oid = b.reldatabase'
+           ' WHERE b.relfilenode IS NOT NULL AND d.datallowconn'
+           ' ORDER BY 1, 2, 3, 4, 5')
+
+# relfilenodes are resolved to names, because they could change during pg_upgrade, while names don't
+RELATIONS = ("SELECT f.spc, f.node, pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(c.relname)"
+             ' FROM pg_catalog.unnest(%s::oid[], %s::oid[]) f(spc, node)'
+             ' JOIN pg_catalog.pg_class c ON c.oid = pg_catalog.pg_filenode_relation(f.spc, f.node)'
+             ' JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace')
+
+PREWARM = "SELECT {0}.pg_prewarm(pg_catalog.to_regclass(%s), 'buffer', %s, %s, %s)"
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Takes snapshots of shared buffers and loads them back')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    snapshot = subparsers.add_parser('snapshot', help='write the list of blocks in shared buffers into a file')
+    snapshot.add_argument('--output', required=True)
+
+    load = subparsers.add_parser('load', help='load blocks from the snapshot file, the hottest first')
+    load.add_argument('--input', required=True)
+
+    sync = subparsers.add_parser('sync', help="load the snapshot of the primary's shared buffers on a replica")
+    for p in (load, sync):
+        p.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help='number of concurrent connections')
+        p.add_argument('--max-rate', type=int, default=DEFAULT_MAX_RATE, help='MB/s, 0 means unlimited')
+    return parser.parse_args()
+
+
+def connect(conn_kwargs, dbname=None):
+    conn = psycopg2.connect(**dict(conn_kwargs, dbname=dbname or conn_kwargs.get('dbname', 'postgres')))
+    conn.autocommit = True
+    return conn
+
+
+def ensure_extension(cur, name):
+    """Creates the extension on the primary, replicas get it from the primary.
+       Returns the quoted name of the schema of the extension or None if it doesn't exist."""
+    query = ('SELECT pg_catalog.quote_ident(n.nspname) FROM pg_catalog.pg_extension e'
+             ' JOIN pg_catalog.pg_namespace n ON n.oid = e.extnamespace WHERE e.extname = %s')
+    cur.execute(query, (name,))
+    row = cur.fetchone()
+    if not row:
+        cur.execute('SELECT pg_catalog.pg_is_in_recovery()')
+        if cur.fetchone()[0]:
+            return None
+        cur.execute('CREATE SCHEMA IF NOT EXISTS {1}; CREATE EXTENSION IF NOT EXISTS {0} SCHEMA {1}'
+                    .format(name, SCHEMA))
+        cur.execute(query, (name,))
+        row = cur.fetchone()
+    return row and row[0]
+
+
+def build_ranges(rows):
+    """Merges consecutive blocks with the same usage count into [fork, first, last, usagecount] ranges"""
+    ranges = []
+    for fork, block, usagecount in rows:
+        last = ranges[-1] if ranges else None
+        if last and last[0] == fork and last[2] + 1 == block and last[3] == usagecount:
+            last[2] = block
+        else:
+            ranges.append([fork, block, block, usagecount])
+    return ranges
+
+
+def take_snapshot(conn_kwargs):
+    """Returns blocks in shared buffers as {dbname: [[relation, fork, first, last, usagecount], ...]}"""
+    start = time.time()
+    conn = connect(conn_kwargs)
+    try:
+        with conn.cursor() as cur:
+            schema = ensure_extension(cur, 'pg_buffercache')
+            if not schema:
+                raise Exception('pg_buffercache extension is not installed')
+            cur.execute("SELECT current_setting('block_size')::integer")
+            block_size = cur.fetchone()[0]
+            cur.execute(BUFFERS.format(schema))
+            buffers = defaultdict(lambda: defaultdict(list))
+            for dbname, spc, node, fork, block, usagecount in cur:
+                buffers[dbname][(spc, node)].append((FORKS[fork], block, usagecount))
+    finally:
+        conn.close()
+
+    databases = {}
+    for dbname, relations in buffers.items():
+        conn = connect(conn_kwargs, dbname)
+        try:
+            with conn.cursor() as cur:
+                spcs, nodes = zip(*relations.keys())
+                cur.execute(RELATIONS, (list(spcs), list(nodes)))
+                databases[dbname] = [[name] + r for spc, node, name in cur.fetchall()
+                                     for r in build_ranges(relations[(spc, node)])]
+        except Exception as e:
+            logger.error('Failed to resolve relations in the database=%s: %r', dbname, e)
+        finally:
+            conn.close()
+
+    blocks = sum(r[3] - r[2] + 1 for ranges in databases.values() for r in ranges)
+    logger.info('Snapshot of %s blocks in %s databases was taken in %.1f seconds',
+                blocks, len(databases), time.time() - start)
+    return {'timestamp': int(time.time()), 'block_size': block_size, 'databases': databases}
+
+
+def write_snapshot(snapshot, filename):
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(snapshot, f)
+    os.rename(tmp_file, filename)
+
+
+class RateLimiter(object):
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            delay = max(0, self.next_time - now)
+            self.next_time = max(self.next_time, now) + size / float(self.rate)
+        time.sleep(delay)
+
+
+def plan(snapshot, limit_blocks):
+    """Returns chunks of work (usagecount, dbname, ranges), the hottest first, limited to the size of shared buffers"""
+    chunks = defaultdict(list)
+    total = 0
+    ranges = sorted(((r[4], r[3] - r[2], dbname, r) for dbname, ranges in snapshot['databases'].items()
+                     for r in ranges), key=lambda r: r[:2], reverse=True)
+    for usagecount, _, dbname, (relation, fork, first, last, _) in ranges:
+        if total >= limit_blocks:
+            break
+        last = min(last, first + limit_blocks - total - 1)
+        total += last - first + 1
+        for block in range(first, last + 1, MAX_RANGE_BLOCKS):
+            chunks[(usagecount, dbname)].append((relation, fork, block, min(last, block + MAX_RANGE_BLOCKS - 1)))
+    return [(usagecount, dbname, chunks[(usagecount, dbname)][i:i + CHUNK_RANGES])
+            for usagecount, dbname in sorted(chunks, reverse=True)
+            for i in range(0, len(chunks[(usagecount, dbname)]), CHUNK_RANGES)]
+
+
+def load(conn_kwargs, snapshot, jobs=DEFAULT_JOBS, max_rate=DEFAULT_MAX_RATE):
+    """Loads blocks from the snapshot into shared buffers with pg_prewarm, in parallel and rate-limited"""
+    start = time.time()
+    conn = connect(conn_kwargs)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT setting::bigint FROM pg_catalog.pg_settings WHERE name = 'shared_buffers'")
+            shared_buffers = cur.fetchone()[0]
+    finally:
+        conn.close()
+
+    tasks = Queue()
+    for chunk in plan(snapshot, shared_buffers):
+        tasks.put(chunk)
+    limiter = RateLimiter(max_rate * 1024 * 1024)
+    block_size = snapshot['block_size']
+    prepared = {}
+    lock = threading.Lock()
+
+    def prepare(cur, dbname):
+        with lock:
+            if dbname not in prepared:
+                prepared[dbname] = ensure_extension(cur, 'pg_prewarm')
+                if not prepared[dbname]:
+                    logger.warning('Skipping the database=%s, pg_prewarm extension is not installed', dbname)
+            return prepared[dbname]
+
+    def worker(_):
+        loaded = failed = 0
+        while True:
+            try:
+                _, dbname, ranges = tasks.get_nowait()
+            except Empty:
+                return loaded, failed
+            try:
+                conn = connect(conn_kwargs, dbname)
+            except Exception as e:
+                logger.error('Failed to connect to the database=%s: %r', dbname, e)
+                continue
+            try:
+                with conn.cursor() as cur:
+                    schema = prepare(cur, dbname)
+                    if not schema:
+                        continue
+                    for relation, fork, first, last in ranges:
+                        limiter.wait((last - first + 1) * block_size)
+                        try:
+                            cur.execute(PREWARM.format(schema), (relation, fork, first, last))
+                            loaded += cur.fetchone()[0] or 0
+                        except Exception as e:
+                            # the relation was dropped or truncated
+                            logger.debug('Failed to prewarm %s: %r', relation, e)
+                            failed += 1
+            finally:
+                conn.close()
+
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = pool.map(worker, range(max(1, jobs)))
+    finally:
+        pool.close()
+        pool.join()
+
+    loaded = sum(r[0] for r in results)
+    logger.info('Prewarmed %s blocks in %.1f seconds, %s ranges failed',
+                loaded, time.time() - start, sum(r[1] for r in results))
+    return loaded
+
+
+def get_primary_conn_kwargs():
+    """Connection parameters of the primary if this node is a replica, taken from the Patroni config and REST API"""
+    import requests
+    import urllib3
+
+    from spilo_commons import get_patroni_api_url, get_patroni_config
+
+    urllib3.disable_warnings()
+    config = get_patroni_config()
+    r = requests.get(get_patroni_api_url(config) + '/cluster', timeout=5, verify=False)
+    r.raise_for_status()
+    members = r.json().get('members', [])
+    me = next((m for m in members if m['name'] == config['name']), {})
+    leader = next((m for m in members if m.get('role') in ('leader', 'standby_leader')), None)
+    if not leader or me.get('role') in ('leader', 'standby_leader') or not leader.get('host'):
+        return None
+
+    superuser = config['postgresql']['authentication']['superuser']
+    return {'host': leader['host'], 'port': leader.get('port', 5432), 'user': superuser['username'],
+            'password': superuser.get('password'), 'connect_timeout': 5}
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    options = read_configuration()
+    start = time.time()
+    values = {}
+    try:
+        if options.action == 'snapshot':
+            write_snapshot(take_snapshot({}), options.output)
+        elif options.action == 'load':
+            with open(options.input) as f:
+                values['loaded_blocks'] = load({}, json.load(f), options.jobs, options.max_rate)
+        else:
+            primary = get_primary_conn_kwargs()
+            if not primary:
+                logger.info('Not a replica, the own shared buffers are restored by autoprewarm')
+                return 0
+            values['loaded_blocks'] = load({}, take_snapshot(primary), options.jobs, options.max_rate)
+    except Exception:
+        logger.exception('Failed to %s', options.action)
+        record('prewarm_' + options.action, start, False)
+        return 1
+    record('prewarm_' + options.action, start, True, **values)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+PROC = '/proc'
+# list of adjusted processes, for troubleshooting and monitoring
+STATE_FILE = '/run/postgresql/renice.json'
+INTERVAL = 1
+
+# replication lag and recovery time grow if these processes wait for CPU or disk
+PROCESS_TYPES = ('checkpointer', 'archiver', 'startup', 'walsender', 'walreceiver')
+PROCESS_TITLE = re.compile(r'^postgres: (?:.*?: )?({0})(?: |$)'.format('|'.join(PROCESS_TYPES)))
+
+NICE = -20
+IONICE_CLASS = 2  # best-effort, the realtime class could starve everything else
+IONICE_LEVEL = 0
+
+
+def read_cmdline(pid):
+    try:
+        with open(os.path.join(PROC, str(pid), 'cmdline'), 'rb') as f:
+            return f.read().replace(b'\0', b' ').decode('utf-8', 'replace').rstrip()
+    except IOError:
+        return None
+
+
+def set_nice(pid):
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, NICE)
+        return True
+    except PermissionError:
+        # /usr/bin/renice has the cap_sys_nice capability
+        return subprocess.call(['renice', '-n', str(NICE), '-p', str(pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+
+
+def set_ionice(pid):
+    import psutil
+
+    try:
+        psutil.Process(pid).ionice(IONICE_CLASS, IONICE_LEVEL)
+        return True
+    except Exception as e:
+        logger.debug('Failed to set I/O priority of %s: %r', pid, e)
+        return False
+
+
+class Prioritizer(object):
+    """Detects new postgres processes of PROCESS_TYPES by scanning /proc and raises their priorities.
+       Only cmdlines of processes which didn't exist during the previous scan are read."""
+
+    def __init__(self):
+        self._seen = set()
+        self._adjusted = {}
+        # a cgroup with higher weights would have to be a sibling of the container's cgroup, because of the
+        # "no internal processes" rule, and processes moved there would escape limits of the container
+        logger.info('cgroup weights are not supported, only nice and I/O priorities are adjusted')
+
+    def adjust(self, pid, process_type):
+        result = {'type': process_type, 'nice': set_nice(pid), 'ionice': set_ionice(pid)}
+        logger.info('Adjusted priority of the %s process %s: %s', process_type, pid, result)
+        return result
+
+    def scan(self):
+        """Returns True if the list of adjusted processes has changed"""
+        pids = set(int(p) for p in os.listdir(PROC) if p.isdigit())
+        changed = bool(set(self._adjusted) - pids)
+        self._seen &= pids
+        self._adjusted = {pid: v for pid, v in self._adjusted.items() if pid in pids}
+
+        for pid in pids - self._seen:
+            cmdline = read_cmdline(pid)
+            if cmdline is None:
+                continue
+            # a freshly forked backend has the title of the postmaster until it is initialized
+            if not cmdline.startswith('postgres: ') and os.path.basename(cmdline.split(' ')[0]) == 'postgres':
+                continue
+            self._seen.add(pid)
+            match = PROCESS_TITLE.match(cmdline)
+            if match:
+                self._adjusted[pid] = self.adjust(pid, match.group(1))
+                changed = True
+        return changed
+
+    def write_state(self):
+        state = {'timestamp': int(time.time()),
+                 'processes': [dict(v, pid=pid) for pid, v in sorted(self._adjusted.items())]}
+        try:
+            tmp_file = STATE_FILE + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_file, STATE_FILE)
+        except Exception as e:
+            logger.warning('Failed to write %s: %r', STATE_FILE, e)
+
+    def run(self):
+        while True:
+            try:
+                if self.scan():
+                    self.write_state()
+            except Exception:
+                logger.exception('Failed to scan processes')
+            time.sleep(INTERVAL)
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    Prioritizer().run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
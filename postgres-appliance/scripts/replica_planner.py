@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import json
+import os
+import subprocess
+import sys
+import time
+
+import psycopg2
+
+from spilo_commons import append_history, read_history
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = 'replica_creation_history.json'
+
+# bytes per second, used until the respective method was measured on this node
+DEFAULT_THROUGHPUT = {
+    'archive': 64 * 1024 * 1024,
+    'basebackup': 128 * 1024 * 1024,
+    # fetching WAL segments one by one with restore_command and replaying them
+    'wal_replay': 16 * 1024 * 1024
+}
+
+# only the most recent measurements are relevant, network and storage change over time
+HISTORY_DEPTH = 5
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Decides whether a new replica should be restored from the backup '
+                                                 'archive or streamed from the primary with pg_basebackup')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    plan = subparsers.add_parser('plan', help='exits with 0 if restoring from the archive is expected to be faster')
+    plan.add_argument('--datadir', required=True)
+    plan.add_argument('--connstring', required=True)
+    plan.add_argument('--backup-name', help='the chosen backup, its sentinel has the size of the data directory')
+    plan.add_argument('--backup-start-segment', required=True, help='WAL segment where the chosen backup starts')
+    plan.add_argument('--threshold-megabytes', type=int, default=10240,
+                      help='used only when the size of the data directory is unknown')
+
+    record = subparsers.add_parser('record', help='stores the throughput of finished replica creation')
+    record.add_argument('--datadir', required=True)
+    record.add_argument('--method', required=True, choices=('archive', 'basebackup'))
+    record.add_argument('--bytes', type=int, required=True)
+    record.add_argument('--seconds', type=float, required=True)
+
+    return parser.parse_args()
+
+
+def history_file(datadir):
+    # PGROOT survives recreation of the data directory
+    return os.path.join(os.path.dirname(os.path.abspath(datadir)), HISTORY_FILE)
+
+
+def get_throughput(history, method):
+    values = [r['bytes'] / r['seconds'] for r in history if r.get('method') == method and r.get('seconds', 0) > 0]
+    if values:
+        values = sorted(values[-HISTORY_DEPTH:])
+        return values[len(values) // 2], True
+    return DEFAULT_THROUGHPUT[method], False
+
+
+def segment_to_lsn(segment):
+    return '{0:X}/{1:X}'.format(int(segment[8:16], 16), int(segment[16:24], 16) << 24)
+
+
+def get_wal_diff(connstring, backup_start_lsn):
+    conn = psycopg2.connect(connstring, options='-c search_path=pg_catalog', connect_timeout=5)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT CASE WHEN pg_is_in_recovery() THEN GREATEST("
+                        "pg_wal_lsn_diff(COALESCE(pg_last_wal_receive_lsn(), '0/0'), %s)::bigint,"
+                        " pg_wal_lsn_diff(pg_last_wal_replay_lsn(), %s)::bigint)"
+                        " ELSE pg_wal_lsn_diff(pg_current_wal_lsn(), %s)::bigint END", (backup_start_lsn,) * 3)
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def get_backup_size(backup_name):
+    """Reads the stop sentinel of the chosen backup only, listing backups with details downloads all of them.
+       DataCatalogSize is the size of the data directory, the uncompressed size of a delta backup covers
+       only the delta, so it can be used only for a full backup."""
+    if not backup_name or os.environ.get('USE_WALG_RESTORE') != 'true':
+        return None
+    try:
+        output = subprocess.check_output(['wal-g', 'st', 'cat',
+                                          'basebackups_005/{0}_backup_stop_sentinel.json'.format(backup_name)],
+                                         stderr=subprocess.DEVNULL, timeout=60)
+        sentinel = json.loads(output)
+    except Exception as e:
+        logger.warning('Failed to read the sentinel of %s: %r', backup_name, e)
+        return None
+    size = sentinel.get('DataCatalogSize')
+    if not size and not sentinel.get('DeltaFrom'):
+        size = sentinel.get('UncompressedSize')
+    return size or None
+
+
+def get_data_size(backup_name, history):
+    """The size of the chosen backup is a good approximation of the data directory size,
+       otherwise take the size of the data directory created the last time"""
+    size = get_backup_size(backup_name)
+    if size:
+        return size
+    sizes = [r['bytes'] for r in history if r.get('method') in ('archive', 'basebackup')]
+    return sizes[-1] if sizes else None
+
+
+def plan(args):
+    history = read_history(history_file(args.datadir))
+    diff_in_bytes = get_wal_diff(args.connstring, segment_to_lsn(args.backup_start_segment))
+    data_size = get_data_size(args.backup_name, history)
+
+    logger.info('Data size: %s, WAL generated since the backup: %s', data_size, diff_in_bytes)
+
+    if data_size is None:
+        # nothing to build a model on, fallback to static thresholds
+        if diff_in_bytes > args.threshold_megabytes * 1024 * 1024:
+            logger.info('Not restoring from backup because amount of generated WAL exceeds %sMB',
+                        args.threshold_megabytes)
+            return 1
+        return 0
+
+    estimates = {}
+    for method in DEFAULT_THROUGHPUT:
+        throughput, measured = get_throughput(history, method)
+        logger.info('%s throughput: %d bytes/s (%s)', method, throughput, 'measured' if measured else 'default')
+        estimates[method] = throughput
+
+    archive_time = data_size / estimates['archive'] + diff_in_bytes / estimates['wal_replay']
+    basebackup_time = data_size / estimates['basebackup']
+    logger.info('Estimated time to restore from the archive: %ds, to stream from the primary: %ds',
+                archive_time, basebackup_time)
+
+    if archive_time > basebackup_time:
+        logger.info('Not restoring from backup because streaming from the primary is expected to be faster')
+        return 1
+    return 0
+
+
+def record(args):
+    append_history(history_file(args.datadir), {'method': args.method, 'bytes': args.bytes,
+                                                'seconds': args.seconds, 'time': int(time.time())})
+    logger.info('%s: %s bytes in %ss', args.method, args.bytes, args.seconds)
+    return 0
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    args = read_configuration()
+    try:
+        return plan(args) if args.action == 'plan' else record(args)
+    except Exception:
+        logger.exception('Failed to %s', args.action)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
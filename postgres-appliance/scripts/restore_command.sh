@@ -25,12 +25,34 @@ readonly wal_destination=$2
 
 [[ -z $wal_filename || -z $wal_destination ]] && exit 1
 
+readonly metrics_counters=/run/postgresql/metrics/restore_command
+START=$EPOCHREALTIME
+PREFETCHED=0
+
+# Updates counters read by spilo_metrics.py: fetches, prefetch hits, failures, total and last fetch time
+# in microseconds and the timestamp of the last fetch. It is called for every WAL segment, hence no forks.
+function fetch() {
+    "$@"
+    local ret=$?
+    if [[ -d ${metrics_counters%/*} ]]; then
+        local fetches=0 hits=0 failures=0 total=0 last now=$EPOCHREALTIME
+        [[ -f $metrics_counters ]] && read -r fetches hits failures total _ < "$metrics_counters"
+        last=$(( ${now/./} - ${START/./} ))
+        printf '%s %s %s %s %s %s\n' $((fetches+1)) $((hits+PREFETCHED)) $((failures+(ret != 0))) \
+            $((total+last)) $last "${now%.*}" > "$metrics_counters"
+    fi
+    exit $ret
+}
+
 wal_dir=$(dirname "$wal_destination")
 readonly wal_dir
 wal_fast_source=$(dirname "$(dirname "$(realpath "$wal_dir")")")/wal_fast/$wal_filename
 readonly wal_fast_source
 
-[[ -f $wal_fast_source ]] && exec mv "${wal_fast_source}" "${wal_destination}"
+if [[ -f $wal_fast_source ]]; then
+    PREFETCHED=1
+    fetch mv "${wal_fast_source}" "${wal_destination}"
+fi
 
 if [[ "$wal_destination" =~ /$wal_filename$ ]]; then  # Patroni fetching missing files for pg_rewind
     export WALG_DOWNLOAD_CONCURRENCY=1
@@ -39,17 +61,22 @@ else
     POOL_SIZE=$WALG_DOWNLOAD_CONCURRENCY
 fi
 
-[[ "$USE_WALG_RESTORE" == "true" ]] && exec wal-g wal-fetch "${wal_filename}" "${wal_destination}"
+if [[ "$USE_WALG_RESTORE" == "true" ]]; then
+    [[ -f $wal_dir/.wal-g/prefetch/$wal_filename ]] && PREFETCHED=1
+    fetch wal-g wal-fetch "${wal_filename}" "${wal_destination}"
+fi
 
 [[ $POOL_SIZE -gt 8 ]] && POOL_SIZE=8
 
 if [[ -z $WALE_S3_PREFIX ]]; then  # non AWS environment?
     readonly wale_prefetch_source=${wal_dir}/.wal-e/prefetch/${wal_filename}
     if [[ -f $wale_prefetch_source ]]; then
-        exec mv "${wale_prefetch_source}" "${wal_destination}"
+        PREFETCHED=1
+        fetch mv "${wale_prefetch_source}" "${wal_destination}"
     else
-        exec wal-e wal-fetch -p $POOL_SIZE "${wal_filename}" "${wal_destination}"
+        fetch wal-e wal-fetch -p $POOL_SIZE "${wal_filename}" "${wal_destination}"
     fi
 else
-    exec bash /scripts/wal-e-wal-fetch.sh wal-fetch -p $POOL_SIZE "${wal_filename}" "${wal_destination}"
+    [[ -f $wal_dir/.wal-e/prefetch/$wal_filename ]] && PREFETCHED=1
+    fetch bash /scripts/wal-e-wal-fetch.sh wal-fetch -p $POOL_SIZE "${wal_filename}" "${wal_destination}"
 fi
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import subprocess
@@ -19,6 +20,9 @@ extensions = {
 }
 if os.environ.get('ENABLE_PG_MON') == 'true':
     extensions['pg_mon'] = (11,  17, True,  False)
+# autoprewarm restores shared buffers after restarts
+if os.environ.get('PREWARM_SCHEDULE'):
+    extensions['pg_prewarm'] = (11,  17, True,  False)
 
 
 def adjust_extensions(old, version, extwlist=False):
@@ -83,3 +87,50 @@ def get_patroni_config():
 
 def write_patroni_config(config, force):
     write_file(yaml.dump(config, default_flow_style=False, width=120), PATRONI_CONFIG_FILE, force)
+
+
+def get_patroni_api_url(config):
+    restapi = config.get('restapi', {})
+    port = restapi.get('listen', ':8008').rsplit(':', 1)[1]
+    return '{0}://localhost:{1}'.format('https' if restapi.get('certfile') else 'http', port)
+
+
+def read_history(filename):
+    try:
+        with open(filename) as f:
+            history = json.load(f)
+        return history if isinstance(history, list) else []
+    except (IOError, ValueError):
+        return []
+
+
+def append_history(filename, record, limit=50):
+    history = read_history(filename)[-(limit - 1):] + [record]
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(history, f)
+    os.rename(tmp_file, filename)
+
+
+def get_cpu_count():
+    """Number of CPUs available to the container, respecting the cgroup CPU quota"""
+    cpu_count = len(os.sched_getaffinity(0))
+
+    cgroup_v2_cpu_max_path = '/sys/fs/cgroup/cpu.max'
+    cgroup_cpu_quota_path = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+    cgroup_cpu_period_path = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+    try:
+        if os.path.exists(cgroup_v2_cpu_max_path):
+            with open(cgroup_v2_cpu_max_path) as f:
+                quota, period = f.read().split()
+        else:
+            with open(cgroup_cpu_quota_path) as f:
+                quota = f.read().strip()
+            with open(cgroup_cpu_period_path) as f:
+                period = f.read().strip()
+        if quota != 'max' and int(quota) > 0:
+            # round up, 1.5 CPUs allow to run two processes
+            cpu_count = min(cpu_count, -(-int(quota) // int(period)))
+    except Exception:
+        pass
+    return max(1, cpu_count)
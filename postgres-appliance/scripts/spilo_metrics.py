@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# scripts record results of their runs there, the exporter only reads these files
+METRICS_DIR = os.environ.get('SPILO_METRICS_DIR', '/run/postgresql/metrics')
+# written by the in-place upgrade after every phase
+UPGRADE_PROGRESS = 'inplace_upgrade_progress'
+# counters maintained by restore_command.sh without forking any process:
+# fetches, prefetch hits, failures, total and last fetch time in microseconds, timestamp of the last fetch
+RESTORE_COUNTERS = 'restore_command'
+
+DEFAULT_PORT = 9187
+CACHE_SECONDS = 5
+BGMON_URL = 'http://localhost:8080'
+# listing of pg_wal/archive_status stops there, the backlog is reported as "at least"
+MAX_SCAN_ENTRIES = 100000
+
+_values = {}
+
+
+def write(name, data):
+    try:
+        if not os.path.exists(METRICS_DIR):
+            os.makedirs(METRICS_DIR)
+        filename = os.path.join(METRICS_DIR, name + '.json')
+        tmp_file = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_file, filename)
+    except Exception as e:
+        logger.debug('Failed to write metrics of %s: %r', name, e)
+
+
+def read(name):
+    try:
+        with open(os.path.join(METRICS_DIR, name + '.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def observe(name, **values):
+    """Values which are recorded together with the duration of the current run"""
+    _values.setdefault(name, {}).update(values)
+
+
+def record(name, start, success, **values):
+    """Saves the result of the last run, values of the last successful run are kept if the run has failed"""
+    now = time.time()
+    previous = read(name) or {}
+    values = dict(previous.get('values') or {}, **dict(_values.pop(name, {}), **values))
+    write(name, {'timestamp': now, 'duration': now - start, 'success': bool(success),
+                 'last_success': now if success else previous.get('last_success'),
+                 'runs': previous.get('runs', 0) + 1, 'failures': previous.get('failures', 0) + (not success),
+                 'values': values})
+
+
+def instrument(name):
+    """Records the duration of the decorated main() function, which returns 0 or None on success"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            ret = 1
+            try:
+                ret = func(*args, **kwargs)
+            except SystemExit as e:
+                ret = e.code
+                raise
+            finally:
+                record(name, start, not ret)
+            return ret
+        return wrapper
+    return decorator
+
+
+def read_envdir(envdir):
+    ret = {}
+    try:
+        for name in os.listdir(envdir):
+            with open(os.path.join(envdir, name)) as f:
+                ret[name] = f.readline().rstrip('\n')
+    except (IOError, OSError):
+        pass
+    return ret
+
+
+def count_files(directory, suffix=''):
+    """Returns the number of files and the smallest name, WAL segment names are ordered by their LSN"""
+    count, first = 0, None
+    try:
+        with os.scandir(directory) as it:
+            for count, entry in enumerate((e for e in it if e.name.endswith(suffix)), 1):
+                if first is None or entry.name < first:
+                    first = entry.name
+                if count >= MAX_SCAN_ENTRIES:
+                    break
+    except OSError:
+        pass
+    return count, first
+
+
+def file_age(filename, now):
+    try:
+        return now - os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+class Collector(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = (0, '')
+        self._data_dir = None
+
+    @property
+    def data_dir(self):
+        if not self._data_dir:
+            try:
+                from spilo_commons import get_patroni_config
+
+                self._data_dir = get_patroni_config()['postgresql']['data_dir']
+            except Exception:
+                self._data_dir = os.environ.get('PGDATA')
+        return self._data_dir
+
+    @staticmethod
+    def scripts(lines, now):
+        try:
+            names = sorted(f[:-5] for f in os.listdir(METRICS_DIR) if f.endswith('.json'))
+        except OSError:
+            names = []
+        for name in names:
+            data = read(name)
+            if not data:
+                continue
+            if name == UPGRADE_PROGRESS:
+                lines.append(('spilo_upgrade_in_progress', {}, int(bool(data.get('running')))))
+                lines.append(('spilo_upgrade_completed_phases', {}, data.get('completed_phases')))
+                lines.append(('spilo_upgrade_elapsed_seconds', {}, data.get('elapsed')))
+                if data.get('running') and data.get('phase'):
+                    lines.append(('spilo_upgrade_last_completed_phase', {'phase': data['phase']}, 1))
+                continue
+            labels = {'script': name}
+            lines.append(('spilo_script_last_run_timestamp_seconds', labels, data.get('timestamp')))
+            lines.append(('spilo_script_last_run_duration_seconds', labels, data.get('duration')))
+            lines.append(('spilo_script_last_run_success', labels, int(bool(data.get('success')))))
+            lines.append(('spilo_script_last_success_timestamp_seconds', labels, data.get('last_success')))
+            lines.append(('spilo_script_runs_total', labels, data.get('runs')))
+            lines.append(('spilo_script_failures_total', labels, data.get('failures')))
+            values = data.get('values') or {}
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(('spilo_script_value', dict(labels, name=key), value))
+
+            if name == 'postgres_backup' and values.get('last_backup_timestamp'):
+                lines.append(('spilo_basebackup_age_seconds', {}, now - values['last_backup_timestamp']))
+            elif name == 'upload_pg_log_to_s3' and values.get('uploaded_until'):
+                lines.append(('spilo_log_ship_lag_seconds', {}, now - values['uploaded_until']))
+
+    def restore_command(self, lines):
+        try:
+            with open(os.path.join(METRICS_DIR, RESTORE_COUNTERS)) as f:
+                fetches, hits, failures, total, last, timestamp = map(int, f.read().split()[:6])
+        except (IOError, ValueError):
+            return
+        lines.append(('spilo_restore_command_fetches_total', {}, fetches))
+        lines.append(('spilo_restore_command_prefetch_hits_total', {}, hits))
+        lines.append(('spilo_restore_command_failures_total', {}, failures))
+        lines.append(('spilo_restore_command_fetch_seconds_total', {}, total / 1000000.0))
+        lines.append(('spilo_restore_command_last_fetch_seconds', {}, last / 1000000.0))
+        lines.append(('spilo_restore_command_last_fetch_timestamp_seconds', {}, timestamp))
+
+    def wal(self, lines, now):
+        if not self.data_dir:
+            return
+        pg_wal = os.path.join(self.data_dir, 'pg_wal')
+        archive_status = os.path.join(pg_wal, 'archive_status')
+        count, first = count_files(archive_status, '.ready')
+        lines.append(('spilo_wal_archive_ready_files', {}, count))
+        if first:
+            lines.append(('spilo_wal_archive_oldest_ready_age_seconds', {},
+                          file_age(os.path.join(archive_status, first), now)))
+        # segments downloaded in advance and not yet consumed by restore_command.sh
+        for name, directory in (('wal-e', os.path.join(pg_wal, '.wal-e', 'prefetch')),
+                                ('wal-g', os.path.join(pg_wal, '.wal-g', 'prefetch')),
+                                ('wal_fast', os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(pg_wal))),
+                                                          'wal_fast'))):
+            if os.path.isdir(directory):
+                lines.append(('spilo_wal_prefetched_files', {'source': name}, count_files(directory)[0]))
+
+    @staticmethod
+    def log_shipping(lines):
+        log_env = read_envdir(os.environ.get('LOG_ENV_DIR', '/run/etc/log.d/env'))
+        if log_env.get('LOG_TMPDIR'):
+            # compressed logs stay there if the upload has failed
+            lines.append(('spilo_log_ship_pending_files', {}, count_files(log_env['LOG_TMPDIR'], '.csv.gz')[0]))
+
+    @staticmethod
+    def bg_mon(lines):
+        import requests
+
+        try:
+            stats = requests.get(BGMON_URL, timeout=1).json()
+        except Exception:
+            return lines.append(('spilo_bg_mon_up', {}, 0))
+        lines.append(('spilo_bg_mon_up', {}, 1))
+        load_average = stats.get('system_stats', {}).get('load_average') or []
+        if load_average:
+            lines.append(('spilo_load_average_1m', {}, load_average[0]))
+        io = stats.get('disk_stats', {}).get('data', {}).get('device', {}).get('io', {})
+        if 'await' in io:
+            lines.append(('spilo_data_disk_await_milliseconds', {}, io['await']))
+
+    def collect(self):
+        """Returns metrics in the Prometheus text format, results are cached for CACHE_SECONDS"""
+        with self._lock:
+            now = time.time()
+            if now - self._cache[0] < CACHE_SECONDS:
+                return self._cache[1]
+            lines = []
+            for func in (lambda: self.scripts(lines, now), lambda: self.restore_command(lines),
+                         lambda: self.wal(lines, now), lambda: self.log_shipping(lines), lambda: self.bg_mon(lines)):
+                try:
+                    func()
+                except Exception as e:
+                    logger.warning('Failed to collect metrics: %r', e)
+            lines.append(('spilo_metrics_collect_seconds', {}, time.time() - now))
+            self._cache = (now, format_metrics(lines))
+            return self._cache[1]
+
+
+def format_metrics(lines):
+    ret = []
+    for name, labels, value in lines:
+        if value is None:
+            continue
+        if labels:
+            name += '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                   for k, v in sorted(labels.items())) + '}'
+        ret.append('{0} {1}'.format(name, value))
+    return '\n'.join(ret) + '\n'
+
+
+def serve(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    collector = Collector()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                return self.send_error(404)
+            body = collector.collect().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    server.daemon_threads = True
+    logger.info('Listening on port %s', port)
+    server.serve_forever()
+
+
+def read_configuration():
+    parser = argparse.ArgumentParser(description='Exports metrics of Spilo scripts, WAL archiving and log shipping')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    serve = subparsers.add_parser('serve', help='serve metrics over HTTP on /metrics')
+    serve.add_argument('--port', type=int, default=int(os.environ.get('METRICS_PORT') or DEFAULT_PORT))
+
+    subparsers.add_parser('collect', help='print metrics, e.g. for the textfile collector of node_exporter')
+
+    record = subparsers.add_parser('record', help='record the result of a run of a shell script')
+    record.add_argument('name')
+    record.add_argument('--start', type=float, required=True, help='unix timestamp of the start')
+    record.add_argument('--exitcode', type=int, default=0)
+    record.add_argument('--value', action='append', default=[], help='name=number')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    options = read_configuration()
+    if options.action == 'serve':
+        serve(options.port)
+    elif options.action == 'collect':
+        sys.stdout.write(Collector().collect())
+    else:
+        values = {}
+        for value in options.value:
+            name, _, value = value.partition('=')
+            try:
+                values[name] = float(value) if '.' in value else int(value)
+            except ValueError:
+                logger.warning('Ignoring non-numeric value %s=%s', name, value)
+        record(options.name, options.start, options.exitcode == 0, **values)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,8 @@ from datetime import datetime, timedelta
 from boto3.exceptions import S3UploadFailedError
 from boto3.s3.transfer import TransferConfig
 
+from spilo_metrics import instrument, observe
+
 logger = logging.getLogger(__name__)
 
 
@@ -76,12 +78,23 @@ def upload_to_s3(local_file_path):
     return True
 
 
+def uploaded_until():
+    """The end of the interval which was uploaded, used to calculate the lag of log shipping"""
+    now = datetime.now()
+    if os.getenv('LOG_SHIP_HOURLY') == 'true':
+        return now.replace(minute=0, second=0, microsecond=0).timestamp()
+    return now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+@instrument('upload_pg_log_to_s3')
 def main():
     max_retries = 3
     compressed_log = compress_pg_log()
 
     for _ in range(max_retries):
         if upload_to_s3(compressed_log):
+            observe('upload_pg_log_to_s3', uploaded_until=uploaded_until(),
+                    uploaded_bytes=os.path.getsize(compressed_log))
             return os.unlink(compressed_log)
         time.sleep(10)
 
@@ -1,7 +1,6 @@
 #!/bin/bash
 
 RETRIES=2
-THRESHOLD_PERCENTAGE=30
 THRESHOLD_MEGABYTES=10240
 
 export PGOPTIONS="-c search_path=pg_catalog"
@@ -19,7 +18,7 @@ while getopts ":-:" optchar; do
             RETRIES=${OPTARG#*=}
             ;;
         threshold_backup_size_percentage=*|threshold-backup-size-percentage=* )
-            THRESHOLD_PERCENTAGE=${OPTARG#*=}
+            # superseded by the estimates of replica_planner.py
             ;;
         threshold_megabytes=*|threshold-megabytes=* )
             THRESHOLD_MEGABYTES=${OPTARG#*=}
@@ -42,8 +41,11 @@ fi
 ATTEMPT=0
 server_version="-1"
 while true; do
-    [[ -z $wal_segment_backup_start ]] && wal_segment_backup_start=$($WAL_E backup-list 2> /dev/null \
-        | sed '0,/^\(backup_\)\?name\s*\(last_\)\?modified\s*/d' | sort -bk2 | tail -n1 | awk '{print $3;}' | sed 's/_.*$//')
+    if [[ -z $wal_segment_backup_start ]]; then
+        read -r backup_name _ wal_segment_backup_start _ < <($WAL_E backup-list 2> /dev/null \
+            | sed '0,/^\(backup_\)\?name\s*\(last_\)\?modified\s*/d' | sort -bk2 | tail -n1)
+        wal_segment_backup_start=${wal_segment_backup_start%%_*}
+    fi
 
     [[ -n "$CONNSTR" && $server_version == "-1" ]] && server_version=$(psql -d "$CONNSTR" -tAc 'show server_version_num' 2> /dev/null || echo "-1")
 
@@ -57,34 +59,16 @@ done
 [[ -z $NO_MASTER && $server_version == "-1" ]] && echo "Failed to reach master" && exit 1
 
 if [[ $server_version != "-1" ]]; then
-    readonly lsn_segment=$((16#${wal_segment_backup_start:8:8}))
-    readonly lsn_offset=$((16#${wal_segment_backup_start:16:8}))
-    printf -v backup_start_lsn "%X/%X" $lsn_segment $((lsn_offset << 24))
-
-    readonly query="SELECT CASE WHEN pg_is_in_recovery() THEN GREATEST(pg_wal_lsn_diff(COALESCE(pg_last_wal_receive_lsn(), '0/0'), '$backup_start_lsn')::bigint, pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '$backup_start_lsn')::bigint) ELSE pg_wal_lsn_diff(pg_current_wal_lsn(), '$backup_start_lsn')::bigint END"
-
-    ATTEMPT=0
-    while true; do
-        [[ -z $diff_in_bytes ]] && diff_in_bytes=$(psql -d "$CONNSTR" -tAc "$query")
-        [[ -z $cluster_size ]] && cluster_size=$(psql -d "$CONNSTR" -tAc "SELECT SUM(pg_catalog.pg_database_size(datname)) FROM pg_catalog.pg_database")
-        [[ -n $diff_in_bytes && -n $cluster_size ]] && break
-        [[ $((ATTEMPT++)) -ge $RETRIES ]] && break
-        sleep 1
-    done
-    [[ -z $diff_in_bytes || -z $cluster_size ]] && echo "could not determine difference with the master location" && exit 1
-
-    echo "Current cluster size: $cluster_size"
-    echo "Wals generated since the last backup: $diff_in_bytes"
-
-    [[ $diff_in_bytes -gt $((THRESHOLD_MEGABYTES*1048576)) ]] && echo "not restoring from backup because of amount of generated wals exceeds ${THRESHOLD_MEGABYTES}MB" && exit 1
-
-    readonly threshold_bytes=$((cluster_size*THRESHOLD_PERCENTAGE/100))
-    [[ $threshold_bytes -lt $diff_in_bytes ]] && echo "not restoring from backup because of amount of generated wals exceeds $THRESHOLD_PERCENTAGE% of cluster_size" && exit 1
+    python3 /scripts/replica_planner.py plan --datadir="$DATA_DIR" --connstring="$CONNSTR" --backup-name="$backup_name" \
+        --backup-start-segment="$wal_segment_backup_start" --threshold-megabytes="$THRESHOLD_MEGABYTES" || exit 1
 fi
 
 ATTEMPT=0
 while true; do
+    START_TIME=$SECONDS
     if $WAL_E backup-fetch "$DATA_DIR" LATEST; then
+        python3 /scripts/replica_planner.py record --datadir="$DATA_DIR" --method=archive \
+            --bytes="$(du -sb "$DATA_DIR" | cut -f1)" --seconds=$((SECONDS-START_TIME))
         version=$(<"$DATA_DIR/PG_VERSION")
         [[ "$version" =~ \. ]] && wal_name=xlog || wal_name=wal
         readonly wal_dir=$DATA_DIR/pg_$wal_name
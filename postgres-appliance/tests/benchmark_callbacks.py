@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""Measures how long the Spilo side of a failover takes.
+
+Callbacks are executed as separate processes, the same way Patroni does it, against local stand-ins:
+a fake Kubernetes API, a fake EC2 API with the instance metadata service and optionally a throwaway
+Postgres cluster. The stand-ins inject latency and errors, the completion times are reported as
+p50/p99 per scenario. Run it inside the Spilo image (scripts are in /scripts) or pass --scripts-dir."""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+POD_NAME = 'demo-0'
+POD_IP = '10.0.0.1'
+NAMESPACE = 'default'
+CLUSTER = 'demo'
+INSTANCE_ID = 'i-0123456789abcdef0'
+EIP_ALLOCATION = 'eipalloc-0123456789abcdef0'
+EC2_XMLNS = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+
+# executes the script as a separate process with module level constants pointing to the stand-ins
+RUNNER = """
+import json, os, sys
+sys.path.insert(0, os.environ['BENCH_SCRIPTS_DIR'])
+import {0} as module
+for name, value in json.loads(os.environ['BENCH_OVERRIDES']).items():
+    setattr(module, name, value)
+sys.argv = [module.__file__] + sys.argv[1:]
+sys.exit(module.main())
+"""
+
+
+class Faults(object):
+
+    def __init__(self, latency, jitter, error_rate, conflict_rate):
+        self.latency = latency / 1000.0
+        self.jitter = jitter / 1000.0
+        self.error_rate = error_rate
+        self.conflict_rate = conflict_rate
+
+    def delay(self):
+        time.sleep(max(0, random.gauss(self.latency, self.jitter)))
+
+    def error(self):
+        return random.random() < self.error_rate
+
+    def conflict(self):
+        return random.random() < self.conflict_rate
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, faults):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reset()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def reset(self):
+        pass
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+
+
+class KubernetesHandler(Handler):
+    """GET and strategic merge PATCH of pods and endpoints, with resourceVersion preconditions"""
+
+    def find(self):
+        match = re.match(r'^/api/v1/namespaces/[^/]+/(pods|endpoints)/([^/]+)$', self.path)
+        return match and self.server.objects.get((match.group(1), match.group(2)))
+
+    def do_GET(self):
+        self.server.faults.delay()
+        obj = self.find()
+        with self.server.lock:
+            self.server.requests += 1
+            body = json.dumps(obj) if obj else None
+        self.reply(200, body) if body else self.reply(404, '{"reason": "NotFound"}')
+
+    def do_PATCH(self):
+        faults = self.server.faults
+        faults.delay()
+        patch = json.loads(self.read_body())
+        obj = self.find()
+        with self.server.lock:
+            self.server.requests += 1
+            if not obj:
+                return self.reply(404, '{"reason": "NotFound"}')
+            if faults.error():
+                return self.reply(503, '{"reason": "ServiceUnavailable"}')
+            if faults.conflict():  # somebody else modified the object in the meantime
+                obj['metadata']['resourceVersion'] = str(int(obj['metadata']['resourceVersion']) + 1)
+            metadata = patch.get('metadata', {})
+            if metadata.get('resourceVersion', obj['metadata']['resourceVersion']) != \
+                    obj['metadata']['resourceVersion']:
+                return self.reply(409, '{"reason": "Conflict"}')
+            for name, value in metadata.get('labels', {}).items():
+                if value is None:
+                    obj['metadata']['labels'].pop(name, None)
+                else:
+                    obj['metadata']['labels'][name] = value
+            if 'subsets' in patch:
+                obj['subsets'] = patch['subsets']
+            obj['metadata']['resourceVersion'] = str(int(obj['metadata']['resourceVersion']) + 1)
+            self.reply(200, json.dumps(obj))
+
+
+class KubernetesStandIn(StandIn):
+
+    def __init__(self, faults):
+        StandIn.__init__(self, KubernetesHandler, faults)
+
+    def reset(self):
+        with self.lock:
+            self.objects = {
+                ('pods', POD_NAME): {'metadata': {'name': POD_NAME, 'resourceVersion': '1',
+                                                  'labels': {'spilo-role': 'replica'}}},
+                ('endpoints', CLUSTER): {'metadata': {'name': CLUSTER, 'resourceVersion': '1'},
+                                         'subsets': [{'addresses': [{'ip': '10.0.0.2'}],
+                                                      'ports': [{'name': 'postgresql', 'port': 5432}]}]}}
+
+    def converged(self, role):
+        with self.lock:
+            label = self.objects[('pods', POD_NAME)]['metadata']['labels'].get('spilo-role')
+            ips = [a['ip'] for s in self.objects[('endpoints', CLUSTER)]['subsets'] for a in s['addresses']]
+        return label == role and (role != 'master' or ips == [POD_IP])
+
+
+class Ec2Handler(Handler):
+    """A subset of the EC2 query API and the instance metadata service"""
+
+    def do_PUT(self):
+        self.reply(200, 'token', 'text/plain')
+
+    def do_GET(self):
+        self.server.faults.delay()
+        if self.path.endswith('instance-identity/document'):
+            return self.reply(200, json.dumps({'instanceId': INSTANCE_ID, 'region': 'eu-central-1'}))
+        self.reply(404, '')
+
+    def do_POST(self):
+        faults = self.server.faults
+        faults.delay()
+        params = {k: v[0] for k, v in parse_qs(self.read_body()).items()}
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.actions.append(params.get('Action'))
+        if faults.error():
+            return self.reply(503, '<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Slow down'
+                                   '</Message></Error></Errors><RequestID>0</RequestID></Response>', 'text/xml')
+        action = params.get('Action')
+        body = getattr(self, 'action_' + action, lambda _: '')(params)
+        self.reply(200, '<{0}Response xmlns="{1}"><requestId>0</requestId>{2}</{0}Response>'
+                        .format(action, EC2_XMLNS, body), 'text/xml')
+
+    def action_AssociateAddress(self, params):
+        return '<return>true</return><associationId>eipassoc-0</associationId>'
+
+    def action_CreateTags(self, params):
+        return '<return>true</return>'
+
+    def action_DescribeInstances(self, params):
+        return ('<reservationSet><item><reservationId>r-0</reservationId><instancesSet><item>'
+                '<instanceId>{0}</instanceId><rootDeviceName>/dev/xvda</rootDeviceName>'
+                '</item></instancesSet></item></reservationSet>').format(INSTANCE_ID)
+
+    def action_DescribeVolumes(self, params):
+        volume = ('<item><volumeId>vol-{0}</volumeId><attachmentSet><item><volumeId>vol-{0}</volumeId>'
+                  '<instanceId>{1}</instanceId><device>/dev/xvd{0}</device></item></attachmentSet>'
+                  '<tagSet/></item>')
+        return '<volumeSet>{0}</volumeSet>'.format(''.join(volume.format(d, INSTANCE_ID) for d in 'abc'))
+
+
+class Ec2StandIn(StandIn):
+
+    def __init__(self, faults):
+        StandIn.__init__(self, Ec2Handler, faults)
+
+    def reset(self):
+        self.actions = []
+
+
+class ThrowawayPostgres(object):
+    """initdb + pg_ctl start in a temporary directory, listening only on a Unix socket"""
+
+    def __init__(self, bin_dir):
+        self.bin_dir = bin_dir
+        self.dir = tempfile.mkdtemp(prefix='bench_pg_')
+        self.data_dir = os.path.join(self.dir, 'data')
+        subprocess.check_call([os.path.join(bin_dir, 'initdb'), '-D', self.data_dir, '-A', 'trust', '-U', 'postgres'],
+                              stdout=subprocess.DEVNULL)
+        subprocess.check_call([os.path.join(bin_dir, 'pg_ctl'), 'start', '-w', '-D', self.data_dir,
+                               '-l', os.path.join(self.dir, 'log'),
+                               '-o', "-c listen_addresses='' -c unix_socket_directories='{0}'".format(self.dir)],
+                              stdout=subprocess.DEVNULL)
+
+    @property
+    def env(self):
+        return {'PGHOST': self.dir, 'PGUSER': 'postgres', 'PATH': self.bin_dir + ':' + os.environ['PATH']}
+
+    def stop(self):
+        subprocess.call([os.path.join(self.bin_dir, 'pg_ctl'), 'stop', '-m', 'immediate', '-D', self.data_dir],
+                        stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def find_bin_dir():
+    paths = [os.path.dirname(shutil.which('initdb') or '')]
+    if os.path.isdir('/usr/lib/postgresql'):
+        paths += sorted((os.path.join('/usr/lib/postgresql', v, 'bin') for v in os.listdir('/usr/lib/postgresql')),
+                        key=lambda p: int(p.split('/')[-2]) if p.split('/')[-2].isdigit() else 0, reverse=True)
+    return next((p for p in paths if p and os.path.exists(os.path.join(p, 'initdb'))), None)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))] if values else 0
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.faults = Faults(options.latency, options.jitter, options.error_rate, options.conflict_rate)
+        self.tmp_dir = tempfile.mkdtemp(prefix='bench_')
+        self.token_file = os.path.join(self.tmp_dir, 'token')
+        with open(self.token_file, 'w') as f:
+            f.write('token\n')
+        self.results = {}
+
+    def runner(self, module, overrides, args, env=None):
+        env = dict(os.environ, BENCH_SCRIPTS_DIR=self.options.scripts_dir, BENCH_OVERRIDES=json.dumps(overrides),
+                   HOSTNAME=POD_NAME, POD_IP=POD_IP, POD_NAMESPACE=NAMESPACE,
+                   SPILO_METRICS_DIR=os.path.join(self.tmp_dir, 'metrics'), **(env or {}))
+        return [sys.executable, '-c', RUNNER.format(module)] + args, env
+
+    def k8s_overrides(self, k8s):
+        return {'KUBE_API_URL': k8s.url + '/api/v1/namespaces', 'KUBE_TOKEN_FILENAME': self.token_file,
+                'SOCKET_PATH': os.path.join(self.tmp_dir, 'callback_role.sock')}
+
+    def measure(self, name, iterations, func):
+        times, errors = [], 0
+        for _ in range(iterations):
+            start = time.time()
+            try:
+                ok = func()
+            except Exception as e:
+                print('{0}: {1!r}'.format(name, e), file=sys.stderr)
+                ok = False
+            times.append(time.time() - start)
+            errors += 0 if ok else 1
+        self.results[name] = {'iterations': iterations, 'errors': errors, 'p50': percentile(times, 50),
+                              'p99': percentile(times, 99), 'max': max(times)}
+
+    def run_callback_role(self, k8s, role, action='on_role_change'):
+        k8s.reset()
+        cmd, env = self.runner('callback_role', self.k8s_overrides(k8s), [action, role, CLUSTER])
+        return subprocess.call(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0 \
+            and k8s.converged(role)
+
+    def run_flap(self, k8s):
+        """on_stop -> on_start -> on_role_change in quick succession, done when the final state is applied"""
+        k8s.reset()
+        procs = []
+        for action, role in (('on_stop', 'replica'), ('on_start', 'replica'), ('on_role_change', 'master')):
+            cmd, env = self.runner('callback_role', self.k8s_overrides(k8s), [action, role, CLUSTER])
+            procs.append(subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            time.sleep(0.01)
+        while not k8s.converged('master') or any(p.poll() is None for p in procs):
+            if all(p.poll() is not None for p in procs):
+                return False
+            time.sleep(0.005)
+        return True
+
+    def start_service(self, k8s):
+        cmd, env = self.runner('callback_role', self.k8s_overrides(k8s), ['--serve'])
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        sock_path = self.k8s_overrides(k8s)['SOCKET_PATH']
+        for _ in range(100):
+            if os.path.exists(sock_path):
+                return proc
+            time.sleep(0.05)
+        proc.kill()
+        raise Exception('callback service did not start')
+
+    def run_callback_aws(self, ec2):
+        ec2.reset()
+        overrides = {'IMDS_URL': ec2.url + '/latest/',
+                     'TOPOLOGY_CACHE': os.path.join(self.tmp_dir, 'callback_aws.json')}
+        cmd, env = self.runner('callback_aws', overrides, [EIP_ALLOCATION, 'on_role_change', 'primary', CLUSTER],
+                               {'AWS_ENDPOINT_URL_EC2': ec2.url, 'AWS_ACCESS_KEY_ID': 'bench',
+                                'AWS_SECRET_ACCESS_KEY': 'bench', 'AWS_EC2_METADATA_DISABLED': 'true'})
+        return subprocess.call(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0 \
+            and 'AssociateAddress' in ec2.actions
+
+    def run_script(self, postgres, args):
+        env = dict(os.environ, **postgres.env)
+        return subprocess.call(args, env=env, cwd=self.options.scripts_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def run(self):
+        n = self.options.iterations
+        scenarios = self.options.scenario
+
+        k8s = KubernetesStandIn(self.faults)
+        if 'k8s' in scenarios:
+            self.measure('callback_role', n, lambda: self.run_callback_role(k8s, 'master'))
+        if 'k8s-service' in scenarios:
+            service = self.start_service(k8s)
+            try:
+                self.measure('callback_role via service', n, lambda: self.run_callback_role(k8s, 'master'))
+                if 'flap' in scenarios:
+                    self.measure('flap via service', n, lambda: self.run_flap(k8s))
+            finally:
+                service.kill()
+        if 'flap' in scenarios:
+            self.measure('flap', n, lambda: self.run_flap(k8s))
+        k8s.shutdown()
+
+        if 'aws' in scenarios:
+            ec2 = Ec2StandIn(self.faults)
+            self.measure('callback_aws', n, lambda: self.run_callback_aws(ec2))
+            ec2.shutdown()
+
+        if 'postgres' in scenarios:
+            bin_dir = find_bin_dir()
+            if not bin_dir:
+                print('initdb not found, skipping postgres scenarios', file=sys.stderr)
+                return
+            postgres = ThrowawayPostgres(bin_dir)
+            try:
+                script = os.path.join(self.options.scripts_dir, '{0}')
+                self.measure('post_init.sh', n, lambda: self.run_script(
+                    postgres, [script.format('post_init.sh'), 'zalandos', 'postgres']))
+                self.measure('on_role_change.sh', n, lambda: self.run_script(
+                    postgres, [script.format('on_role_change.sh'), 'master', 'true', 'on_role_change', 'primary',
+                               CLUSTER]))
+                self.measure('analyze_scheduler.py', n, lambda: self.run_script(
+                    postgres, [sys.executable, script.format('analyze_scheduler.py')]))
+            finally:
+                postgres.stop()
+
+    def report(self):
+        print('{0:<28} {1:>6} {2:>7} {3:>9} {4:>9} {5:>9}'.format('scenario', 'runs', 'errors', 'p50', 'p99', 'max'))
+        for name, r in self.results.items():
+            print('{0:<28} {1:>6} {2:>7} {3:>8.3f}s {4:>8.3f}s {5:>8.3f}s'.format(
+                name, r['iterations'], r['errors'], r['p50'], r['p99'], r['max']))
+        if self.options.json:
+            with open(self.options.json, 'w') as f:
+                json.dump({'options': vars(self.options), 'results': self.results}, f, indent=2)
+
+    def cleanup(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def read_configuration():
+    scenarios = ('k8s', 'k8s-service', 'flap', 'aws', 'postgres')
+    parser = argparse.ArgumentParser(description='Benchmark of failover callbacks against local stand-ins')
+    parser.add_argument('--scripts-dir', default='/scripts', help='directory with Spilo scripts')
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('-s', '--scenario', action='append', choices=scenarios,
+                        help='scenarios to run, all by default')
+    parser.add_argument('--latency', type=float, default=5, help='mean latency of API requests, ms')
+    parser.add_argument('--jitter', type=float, default=2, help='standard deviation of the latency, ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of failed requests (503)')
+    parser.add_argument('--conflict-rate', type=float, default=0,
+                        help='fraction of Kubernetes PATCH requests racing with a concurrent modification')
+    parser.add_argument('--seed', type=int, help='random seed for reproducible fault injection')
+    parser.add_argument('--json', help='write results into the file')
+    options = parser.parse_args()
+    options.scenario = options.scenario or list(scenarios)
+    options.scripts_dir = os.path.abspath(options.scripts_dir)
+    return options
+
+
+def main():
+    options = read_configuration()
+    random.seed(options.seed)
+    socket.setdefaulttimeout(30)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(1))
+    benchmark = Benchmark(options)
+    try:
+        benchmark.run()
+    finally:
+        benchmark.cleanup()
+    benchmark.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -131,6 +131,10 @@ function test_inplace_upgrade_wrong_capacity() {
     docker_exec "$1" "PGVERSION=14 $UPGRADE_SCRIPT 4" 2>&1 | grep 'number of replicas does not match'
 }
 
+function test_inplace_upgrade_dry_run() {
+    docker_exec "$1" "PGVERSION=14 $UPGRADE_SCRIPT 3 --dry-run" 2>&1 | grep 'Estimated downtime'
+}
+
 function test_successful_inplace_upgrade_to_14() {
     docker_exec "$1" "PGVERSION=14 $UPGRADE_SCRIPT 3"
 }
@@ -277,6 +281,7 @@ function test_spilo() {
     log_info "[TS1] Testing wrong upgrade setups"
     run_test test_inplace_upgrade_wrong_version "$container"
     run_test test_inplace_upgrade_wrong_capacity "$container"
+    run_test test_inplace_upgrade_dry_run "$container"
 
     wait_all_streaming "$container"
     create_schema "$container" || exit 1 # incompatible upgrade exts, custom tbl with statistics and data